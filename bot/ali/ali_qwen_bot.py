@@ -10,6 +10,7 @@ import broadscope_bailian
 from broadscope_bailian import ChatQaMessage
 
 from bot.bot import Bot
+from bot.retry import get_retry_policy
 from bot.ali.ali_qwen_session import AliQwenSession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
@@ -93,14 +94,13 @@ class AliQwenBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: AliQwenSession, retry_count=0) -> dict:
+    def reply_text(self, session: AliQwenSession) -> dict:
         """
         call bailian's ChatCompletion to get the answer
         :param session: a conversation session
-        :param retry_count: retry count
         :return: {}
         """
-        try:
+        def attempt():
             prompt, history = self.convert_messages_format(session.messages)
             self.update_api_key_if_expired()
             # NOTE 阿里百炼的call()函数未提供temperature参数，考虑到temperature和top_p参数作用相同，取两者较小的值作为top_p参数传入，详情见文档 https://help.aliyun.com/document_detail/2587502.htm
@@ -112,38 +112,32 @@ class AliQwenBot(Bot):
                 "completion_tokens": completion_tokens,
                 "content": completion_content,
             }
-        except Exception as e:
-            need_retry = retry_count < 2
+
+        def on_error(e, retry_count):
+            retry_delay = None
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[QWEN] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                retry_delay = 20
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[QWEN] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                retry_delay = 5
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[QWEN] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                retry_delay = 10
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[QWEN] APIConnectionError: {}".format(e))
-                need_retry = False
                 result["content"] = "我连接不到你的网络"
             else:
                 logger.exception("[QWEN] Exception: {}".format(e))
-                need_retry = False
                 self.sessions.clear_session(session.session_id)
 
-            if need_retry:
-                logger.warn("[QWEN] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
-            else:
-                return result
+            return result, retry_delay
+
+        return get_retry_policy("QWEN").call(attempt, on_error)
 
     def set_api_key(self):
         api_key, expired_time = self.api_key_client().create_token(agent_key=self.agent_key())
@@ -1,13 +1,15 @@
 # encoding:utf-8
 
-import requests
+from common import http_client
 import json
 from common import const
 from bot.bot import Bot
+from bot.retry import RetryableError, get_retry_policy
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.token_manager import baidu_token_manager
 from config import conf
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
@@ -74,8 +76,8 @@ class BaiduWenxinBot(Bot):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
-    def reply_text(self, session: BaiduWenxinSession, retry_count=0):
-        try:
+    def reply_text(self, session: BaiduWenxinSession):
+        def attempt():
             logger.info("[BAIDU] model={}".format(session.model))
             access_token = self.get_access_token()
             if access_token == 'None':
@@ -90,9 +92,17 @@ class BaiduWenxinBot(Bot):
                 'Content-Type': 'application/json'
             }
             payload = {'messages': session.messages, 'system': self.prompt} if self.prompt_enabled else {'messages': session.messages}
-            response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+            response = http_client.request("POST", url, headers=headers, data=json.dumps(payload))
             response_text = json.loads(response.text)
             logger.info(f"[BAIDU] response text={response_text}")
+            error_code = response_text.get("error_code")
+            if error_code in (110, 111):
+                # access token失效或过期，作废缓存，重试时重新获取
+                baidu_token_manager(BAIDU_API_KEY, BAIDU_SECRET_KEY).invalidate(access_token)
+                raise RetryableError({"total_tokens": 0, "completion_tokens": 0, "content": "出错了: access token已失效"}, 1, response)
+            if error_code in (18, 336100):
+                # QPS超限或服务繁忙
+                raise RetryableError({"total_tokens": 0, "completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}, 3, response)
             res_content = response_text["result"]
             total_tokens = response_text["usage"]["total_tokens"]
             completion_tokens = response_text["usage"]["completion_tokens"]
@@ -102,19 +112,18 @@ class BaiduWenxinBot(Bot):
                 "completion_tokens": completion_tokens,
                 "content": res_content,
             }
-        except Exception as e:
-            need_retry = retry_count < 2
+
+        def on_error(e, retry_count):
             logger.warn("[BAIDU] Exception: {}".format(e))
-            need_retry = False
             self.sessions.clear_session(session.session_id)
             result = {"total_tokens": 0, "completion_tokens": 0, "content": "出错了: {}".format(e)}
-            return result
+            return result, None
+
+        return get_retry_policy("BAIDU").call(attempt, on_error)
 
     def get_access_token(self):
         """
-        使用 AK，SK 生成鉴权签名（Access Token）
+        使用 AK，SK 生成鉴权签名（Access Token），过期前复用缓存
         :return: access_token，或是None(如果错误)
         """
-        url = "https://aip.baidubce.com/oauth/2.0/token"
-        params = {"grant_type": "client_credentials", "client_id": BAIDU_API_KEY, "client_secret": BAIDU_SECRET_KEY}
-        return str(requests.post(url, params=params).json().get("access_token"))
+        return str(baidu_token_manager(BAIDU_API_KEY, BAIDU_SECRET_KEY).get())
@@ -5,6 +5,7 @@ Auto-replay chat robot abstract class
 
 from bridge.context import Context
 from bridge.reply import Reply
+from common.event_loop import run_sync
 
 
 class Bot(object):
@@ -15,3 +16,12 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def async_reply(self, query, context: Context = None) -> Reply:
+        """
+        async version of reply, used by the async pipeline
+        bots without native async support run reply() in the adapter thread pool
+        :param req: received message
+        :return: reply content
+        """
+        return await run_sync(self.reply, query, context)
@@ -1,22 +1,28 @@
 # encoding:utf-8
 
-import time
+import hashlib
+import threading
 
 import openai
 import openai.error
 import requests
+from common import http_client
 from common import const
 from bot.bot import Bot
-from bot.chatgpt.chat_gpt_session import ChatGPTSession
+from bot.chatgpt.chat_gpt_session import ChatGPTSession, preload_encodings
 from bot.openai.open_ai_image import OpenAIImage
+from bot.retry import get_retry_policy
+from bot.upstream_pool import UpstreamPool, get_upstream_pool
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.event_loop import run_sync
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common.rate_limiter import get_rate_limiter
 from config import conf, load_config
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
+
 # OpenAI对话模型API (可用)
 class ChatGPTBot(Bot, OpenAIImage):
     def __init__(self):
@@ -28,10 +34,9 @@ class ChatGPTBot(Bot, OpenAIImage):
         proxy = conf().get("proxy")
         if proxy:
             openai.proxy = proxy
-        if conf().get("rate_limit_chatgpt"):
-            self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
         conf_model = conf().get("model") or "gpt-3.5-turbo"
         self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
+        threading.Thread(target=preload_encodings, daemon=True).start()  # 后台加载tiktoken编码器
         # o1相关模型不支持system prompt，暂时用文心模型的session
 
         self.args = {
@@ -55,53 +60,15 @@ class ChatGPTBot(Bot, OpenAIImage):
     def reply(self, query, context=None):
         # acquire reply content
         if context.type == ContextType.TEXT:
-            logger.info("[CHATGPT] query={}".format(query))
-
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply, session, api_key, new_args = self._prepare_text_query(query, context)
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[CHATGPT] session query={}".format(session.messages))
-
-            api_key = context.get("openai_api_key")
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
+            if context.get("stream"):
+                # 流式回复，channel逐段发送生成器产出的文本
+                return Reply(ReplyType.TEXT_STREAM, self.reply_text_stream(session, api_key, args=new_args))
 
             reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            return self._build_text_reply(session, reply_content)
 
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
@@ -115,61 +82,208 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+    async def async_reply(self, query, context=None):
+        # 文本消息使用openai的异步接口，其它类型和流式回复仍在线程池中执行
+        if context.type != ContextType.TEXT or context.get("stream"):
+            return await super().async_reply(query, context)
+        # 清除记忆、更新配置和计算token可能阻塞，不在事件循环线程中执行
+        reply, session, api_key, new_args = await run_sync(self._prepare_text_query, query, context)
+        if reply:
+            return reply
+        reply_content = await self.async_reply_text(session, api_key, args=new_args)
+        return await run_sync(self._build_text_reply, session, reply_content)
+
+    def _prepare_text_query(self, query, context):
+        """
+        处理清除记忆等指令，并将query加入会话
+        :return: (指令的回复, session, api_key, args)，指令的回复不为空时无需再请求模型
+        """
+        logger.info("[CHATGPT] query={}".format(query))
+
+        session_id = context["session_id"]
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除"), None, None, None
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除"), None, None, None
+        elif query == "#更新配置":
+            load_config()
+            return Reply(ReplyType.INFO, "配置已更新"), None, None, None
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[CHATGPT] session query={}".format(session.messages))
+
+        api_key = context.get("openai_api_key")
+        model = context.get("gpt_model")
+        new_args = None
+        if model:
+            new_args = self.args.copy()
+            new_args["model"] = model
+        return None, session, api_key, new_args
+
+    def _build_text_reply(self, session: ChatGPTSession, reply_content: dict) -> Reply:
+        session_id = session.session_id
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def reply_text(self, session: ChatGPTSession, api_key=None, args=None) -> dict:
         """
-        call openai's ChatCompletion to get the answer
+        call openai's ChatCompletion to get the answer, retry by the shared retry policy
         :param session: a conversation session
-        :param session_id: session id
-        :param retry_count: retry count
         :return: {}
         """
-        try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+        if args is None:
+            args = self.args
+
+        def send(kwargs):
+            limiter = get_rate_limiter("chatgpt", conf().get("rate_limit_chatgpt"))
+            if limiter and not limiter.acquire(self._rate_limit_key(kwargs["api_key"], args)):
                 raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
+            return openai.ChatCompletion.create(messages=session.messages, **dict(args, **kwargs))
+
+        def attempt():
+            response = self._request(api_key, args, send)
+            # logger.debug("[CHATGPT] response={}".format(response))
+            return self._parse_response(response)
+
+        return get_retry_policy("CHATGPT").call(attempt, lambda e, retry_count: self._handle_reply_error(e, session))
+
+    def reply_text_stream(self, session: ChatGPTSession, api_key=None, args=None):
+        """
+        call openai's ChatCompletion with stream=True, yield the answer piece by piece
+        the full answer is saved to the session after the stream ends
+        :param session: a conversation session
+        :return: generator of text chunks
+        """
+        contents = []
+        try:
             if args is None:
                 args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            # logger.debug("[CHATGPT] response={}".format(response))
-            logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+
+            def send(kwargs):
+                limiter = get_rate_limiter("chatgpt", conf().get("rate_limit_chatgpt"))
+                if limiter and not limiter.acquire(self._rate_limit_key(kwargs["api_key"], args)):
+                    raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+                return openai.ChatCompletion.create(messages=session.messages, stream=True, **dict(args, **kwargs))
+
+            # 上游池只统计到开始返回内容为止的耗时
+            response = self._request(api_key, args, send, failover=False)
+            for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].get("delta", {}).get("content")
+                if delta:
+                    contents.append(delta)
+                    yield delta
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
-            else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+            # 已经输出的内容无法撤回，不再重试，也不把不完整的回复写入会话
+            result, _ = self._handle_reply_error(e, session)
+            if not contents:
+                yield result["content"]
+            return
+        content = "".join(contents)
+        logger.info("[ChatGPT] stream reply={}".format(content))
+        if content:
+            self.sessions.session_reply(content, session.session_id)
 
-            if need_retry:
-                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
-                return result
+    async def async_reply_text(self, session: ChatGPTSession, api_key=None, args=None) -> dict:
+        """
+        reply_text的异步版本，等待接口返回和重试前的等待都不占用线程
+        """
+        if args is None:
+            args = self.args
+
+        async def send(kwargs):
+            limiter = get_rate_limiter("chatgpt", conf().get("rate_limit_chatgpt"))
+            if limiter and not await limiter.async_acquire(self._rate_limit_key(kwargs["api_key"], args)):
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            return await openai.ChatCompletion.acreate(messages=session.messages, **dict(args, **kwargs))
+
+        async def attempt():
+            response = await self._async_request(api_key, args, send)
+            return self._parse_response(response)
+
+        return await get_retry_policy("CHATGPT").async_call(attempt, lambda e, retry_count: self._handle_reply_error(e, session))
+
+    def _upstream_pool(self) -> UpstreamPool:
+        return get_upstream_pool("openai")
+
+    def _request(self, api_key, args, send, failover=True):
+        """
+        用户设置了自己的api_key时直接使用，否则由上游池选择api_key和接口地址
+        :param send: send(kwargs)发起请求，kwargs为api_key、api_base等接口参数
+        :param failover: 上游出错时是否换一个上游重试，流式回复无法重试
+        """
+        if api_key:
+            return send({"api_key": api_key})
+        return self._upstream_pool().request(args.get("model"), send, failover)
+
+    async def _async_request(self, api_key, args, send):
+        if api_key:
+            return await send({"api_key": api_key})
+        return await self._upstream_pool().async_request(args.get("model"), send, True)
+
+    def _rate_limit_key(self, api_key, args) -> str:
+        """
+        rate_limit_chatgpt的计算范围，api_key只保存摘要
+        """
+        scope = conf().get("rate_limit_chatgpt_scope", "global")
+        if scope == "api_key":
+            return hashlib.sha256((api_key or openai.api_key or "").encode("utf-8")).hexdigest()[:16]
+        if scope == "model":
+            return args.get("model") or ""
+        return ""
+
+    def _parse_response(self, response) -> dict:
+        logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": response.choices[0]["message"]["content"],
+        }
+
+    def _handle_reply_error(self, e: Exception, session: ChatGPTSession):
+        """
+        :return: (错误时的回复, 重试的基础等待秒数)，不需要重试时等待秒数为None，实际等待时间由重试策略计算
+        """
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        retry_delay = None
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            retry_delay = 20
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            retry_delay = 5
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            retry_delay = 10
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+            retry_delay = 5
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            self.sessions.clear_session(session.session_id)
+        return result, retry_delay
 
 
 class AzureChatGPTBot(ChatGPTBot):
@@ -179,6 +293,9 @@ class AzureChatGPTBot(ChatGPTBot):
         openai.api_version = conf().get("azure_api_version", "2023-06-01-preview")
         self.args["deployment_id"] = conf().get("azure_deployment_id")
 
+    def _upstream_pool(self) -> UpstreamPool:
+        return get_upstream_pool("azure", api_type="azure", api_version=conf().get("azure_api_version", "2023-06-01-preview"))
+
     def create_img(self, query, retry_count=0, api_key=None):
         text_to_image_model = conf().get("text_to_image")
         if text_to_image_model == "dall-e-2":
@@ -192,13 +309,13 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 operation_location = submission.headers['operation-location']
                 status = ""
                 while (status != "succeeded"):
                     if retry_count > 3:
                         return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
+                    response = http_client.get(operation_location, headers=headers)
                     status = response.json()['status']
                     retry_count += 1
                 image_url = response.json()['result']['data'][0]['url']
@@ -217,7 +334,7 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "1024x1024"), "quality": conf().get("dalle3_image_quality", "standard")}
-                response = requests.post(url, headers=headers, json=body)
+                response = http_client.post(url, headers=headers, json=body)
                 response.raise_for_status()  # 检查请求是否成功
                 data = response.json()
 
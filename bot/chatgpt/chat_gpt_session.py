@@ -1,3 +1,5 @@
+import threading
+
 from bot.session_manager import Session
 from common.log import logger
 from common import const
@@ -29,13 +31,9 @@ class ChatGPTSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                cur_tokens = self.pop_message(1, cur_tokens, precise, max_tokens)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
-                if precise:
-                    cur_tokens = self.calc_tokens()
-                else:
-                    cur_tokens = cur_tokens - max_tokens
+                cur_tokens = self.pop_message(1, cur_tokens, precise, max_tokens)
                 break
             elif len(self.messages) == 2 and self.messages[1]["role"] == "user":
                 logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
@@ -43,57 +41,136 @@ class ChatGPTSession(Session):
             else:
                 logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
                 break
-            if precise:
-                cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = cur_tokens - max_tokens
         return cur_tokens
 
+    def count_message_tokens(self, message):
+        return num_tokens_from_message(message, self.model)
+
+    def count_messages_tokens(self, messages):
+        return num_tokens_per_message(messages, self.model)
+
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        return super().calc_tokens() + num_tokens_for_reply(self.model)
+
+
+CHARACTER = "character"  # 按字符数估算token的模型
+
+# 模型 -> token计算规则的族，未列出的模型按gpt-3.5-turbo计算
+MODEL_FAMILY = {
+    "wenxin": CHARACTER,
+    "xunfei": CHARACTER,
+    "gpt-3.5-turbo": "gpt-3.5-turbo",
+    "gpt-3.5-turbo-0301": "gpt-3.5-turbo",
+    "gpt-35-turbo": "gpt-3.5-turbo",
+    "gpt-3.5-turbo-1106": "gpt-3.5-turbo",
+    "moonshot": "gpt-3.5-turbo",
+    const.LINKAI_35: "gpt-3.5-turbo",
+}
+for _model in ["gpt-4", "gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+               "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
+               "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
+               const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO, const.GPT_5, const.GPT_5_MINI, const.GPT_5_NANO]:
+    MODEL_FAMILY[_model] = "gpt-4"
+
+# 族 -> (tiktoken模型名, tokens_per_message, tokens_per_name)
+FAMILY_RULES = {
+    "gpt-3.5-turbo": ("gpt-3.5-turbo", 4, -1),  # every message follows <|start|>{role/name}\n{content}<|end|>\n, if there's a name, the role is omitted
+    "gpt-4": ("gpt-4", 3, 1),
+}
+
+_family_cache = {}
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def model_family(model):
+    family = _family_cache.get(model)
+    if family is None:
+        family = MODEL_FAMILY.get(model)
+        if family is None:
+            if model.startswith(const.GEMINI):
+                family = CHARACTER
+            else:  # claude-3及其它未知模型按gpt-3.5-turbo计算
+                family = "gpt-3.5-turbo"
+        _family_cache[model] = family
+    return family
+
+
+def get_encoding(family):
+    """
+    获取族对应的tiktoken编码器，每个编码器只加载一次，线程安全
+    """
+    encoding = _encodings.get(family)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(family)
+            if encoding is None:
+                import tiktoken
+
+                try:
+                    encoding = tiktoken.encoding_for_model(FAMILY_RULES[family][0])
+                except KeyError:
+                    logger.debug("Warning: model not found. Using cl100k_base encoding.")
+                    encoding = tiktoken.get_encoding("cl100k_base")
+                _encodings[family] = encoding
+    return encoding
+
+
+def preload_encodings():
+    """
+    预加载所有编码器，避免首条消息时加载编码文件的延迟
+    """
+    for family in FAMILY_RULES:
+        try:
+            get_encoding(family)
+        except Exception as e:
+            logger.debug("[CHATGPT] preload tiktoken encoding failed: {}".format(e))
+
+
+def count_by_character(model):
+    return model_family(model) == CHARACTER
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
+    return sum(num_tokens_per_message(messages, model)) + num_tokens_for_reply(model)
+
+
+def num_tokens_for_reply(model):
+    if count_by_character(model):
+        return 0
+    return 3  # every reply is primed with <|start|>assistant<|message|>
+
+
+def num_tokens_from_message(message, model):
+    """Returns the number of tokens used by a single message, excluding the reply priming tokens."""
+    return num_tokens_per_message([message], model)[0]
 
-    if model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI):
-        return num_tokens_by_character(messages)
-
-    import tiktoken
-
-    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
-                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
-                   "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
-                   const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO, const.GPT_5, const.GPT_5_MINI, const.GPT_5_NANO]:
-        return num_tokens_from_messages(messages, model="gpt-4")
-    elif model.startswith("claude-3"):
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
-        tokens_per_message = 3
-        tokens_per_name = 1
+
+def num_tokens_per_message(messages, model):
+    """Returns the number of tokens used by each message, all contents are encoded in one batch."""
+    family = model_family(model)
+    if family == CHARACTER:
+        return [len(message["content"]) for message in messages]
+    encoding = get_encoding(family)
+    _, tokens_per_message, tokens_per_name = FAMILY_RULES[family]
+    values = [value for message in messages for value in message.values()]
+    if len(values) > 16 and hasattr(encoding, "encode_batch"):
+        lengths = [len(tokens) for tokens in encoding.encode_batch(values, disallowed_special=())]
     else:
-        logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
+        lengths = [len(encoding.encode(value, disallowed_special=())) for value in values]
+    result = []
+    i = 0
     for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+        num_tokens = tokens_per_message
+        for key in message:
+            num_tokens += lengths[i]
+            i += 1
             if key == "name":
                 num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+        result.append(num_tokens)
+    return result
 
 
 def num_tokens_by_character(messages):
@@ -102,3 +179,36 @@ def num_tokens_by_character(messages):
     for msg in messages:
         tokens += len(msg["content"])
     return tokens
+
+
+if __name__ == "__main__":
+    # 裁剪历史的基准测试: python -m bot.chatgpt.chat_gpt_session [模型] [轮数]
+    import sys
+    import timeit
+
+    model = sys.argv[1] if len(sys.argv) > 1 else "gpt-3.5-turbo"
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    history = [{"role": "user" if i % 2 else "assistant", "content": "消息内容 message content {} ".format(i) * 20} for i in range(49)]
+
+    def full_recount():
+        # 旧实现: 每删除一条消息都重新计算整个会话
+        messages = [{"role": "system", "content": "You are a helpful assistant."}] + [dict(m) for m in history]
+        max_tokens = num_tokens_from_messages(messages, model) // 4
+        while num_tokens_from_messages(messages, model) > max_tokens and len(messages) > 2:
+            messages.pop(1)
+
+    session = ChatGPTSession("bench", "You are a helpful assistant.", model=model)
+
+    def incremental():
+        session.reset()
+        session.messages.extend(dict(m) for m in history)
+        max_tokens = session.calc_tokens() // 4
+        session.discard_exceeding(max_tokens)
+
+    for name, func in [("full recount", full_recount), ("incremental", incremental)]:
+        cost = timeit.timeit(func, number=number)
+        print("{:<14} {:.3f} ms/trim".format(name, cost / number * 1000))
+    # 单次调用的固定开销: 模型族查找和编码器获取
+    message = {"role": "user", "content": "hi"}
+    cost = timeit.timeit(lambda: num_tokens_from_messages([message], model), number=number * 100)
+    print("{:<14} {:.2f} us/call".format("per call", cost / number / 100 * 1000 * 1000))
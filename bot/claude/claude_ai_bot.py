@@ -1,9 +1,9 @@
 import re
-import time
 import json
 import uuid
 from curl_cffi import requests
 from bot.bot import Bot
+from bot.retry import RetryableError, get_retry_policy
 from bot.claude.claude_ai_session import ClaudeAiSession
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
@@ -118,20 +118,14 @@ class ClaudeAIBot(Bot, OpenAIImage):
         # Returns JSON of the newly created conversation information
         return response.json()
         
-    def _chat(self, query, context, retry_count=0) -> Reply:
+    def _chat(self, query, context) -> Reply:
         """
-        发起对话请求
+        发起对话请求，失败时按重试策略重试
         :param query: 请求提示词
         :param context: 对话上下文
-        :param retry_count: 当前递归重试次数
         :return: 回复
         """
-        if retry_count >= 2:
-            # exit from retry 2 times
-            logger.warn("[CLAUDEAI] failed after maximum number of retry times")
-            return Reply(ReplyType.ERROR, "请再问我一次吧")
-
-        try:
+        def attempt():
             session_id = context["session_id"]
             if self.org_uuid is None:
                 return Reply(ReplyType.ERROR, self.error)
@@ -209,14 +203,11 @@ class ClaudeAIBot(Bot, OpenAIImage):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[CLAUDE] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+                    raise RetryableError(Reply(ReplyType.ERROR, "请再问我一次吧"), 2, res)
                 return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
 
-        except Exception as e:
+        def on_error(e, retry_count):
             logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[CLAUDE] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            return Reply(ReplyType.ERROR, "请再问我一次吧"), 2
+
+        return get_retry_policy("CLAUDEAI").call(attempt, on_error)
@@ -1,12 +1,11 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 import anthropic
 
 from bot.bot import Bot
+from bot.retry import get_retry_policy
 from bot.openai.open_ai_image import OpenAIImage
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 from bot.session_manager import SessionManager
@@ -73,8 +72,8 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
-    def reply_text(self, session: BaiduWenxinSession, retry_count=0):
-        try:
+    def reply_text(self, session: BaiduWenxinSession):
+        def attempt():
             actual_model = self._model_mapping(conf().get("model"))
             response = self.claudeClient.messages.create(
                 model=actual_model,
@@ -92,33 +91,28 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 "completion_tokens": completion_tokens,
                 "content": res_content,
             }
-        except Exception as e:
-            need_retry = retry_count < 2
+
+        def on_error(e, retry_count):
+            retry_delay = None
             result = {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                retry_delay = 20
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[CLAUDE_API] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                retry_delay = 5
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
-                need_retry = False
                 result["content"] = "我连接不到你的网络"
             else:
                 logger.warn("[CLAUDE_API] Exception: {}".format(e))
-                need_retry = False
                 self.sessions.clear_session(session.session_id)
 
-            if need_retry:
-                logger.warn("[CLAUDE_API] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
-            else:
-                return result
+            return result, retry_delay
+
+        return get_retry_policy("CLAUDE_API").call(attempt, on_error)
 
     def _model_mapping(self, model) -> str:
         if model == "claude-3-opus":
@@ -1,6 +1,7 @@
 # encoding:utf-8
 
 from bot.bot import Bot
+from bot.retry import RetryableError, get_retry_policy
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
@@ -73,15 +74,14 @@ class DashscopeBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: DashscopeSession, retry_count=0) -> dict:
+    def reply_text(self, session: DashscopeSession) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
-        :param retry_count: retry count
         :return: {}
         """
-        try:
+        def attempt():
             dashscope.api_key = self.api_key
             response = self.client.call(
                 dashscope_models[self.model_name],
@@ -101,17 +101,12 @@ class DashscopeBot(Bot):
                     response.code, response.message
                 ))
                 result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-                need_retry = retry_count < 2
-                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-                if need_retry:
-                    return self.reply_text(session, retry_count + 1)
-                else:
-                    return result
-        except Exception as e:
-            logger.exception(e)
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, retry_count + 1)
-            else:
+                if response.status_code >= 500 or response.status_code == HTTPStatus.TOO_MANY_REQUESTS:
+                    raise RetryableError(result, 1)
                 return result
+
+        def on_error(e, retry_count):
+            logger.exception(e)
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}, 1
+
+        return get_retry_policy("DASHSCOPE").call(attempt, on_error)
@@ -7,6 +7,7 @@ Google gemini bot
 # encoding:utf-8
 
 from bot.bot import Bot
+from bot.retry import get_retry_policy
 import google.generativeai as genai
 from bot.session_manager import SessionManager
 from bridge.context import ContextType, Context
@@ -16,6 +17,7 @@ from config import conf
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from google.api_core.exceptions import DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable
 
 
 # OpenAI对话模型API (可用)
@@ -51,10 +53,12 @@ class GoogleGeminiBot(Bot):
             }
             
             # 生成回复，包含安全设置
-            response = model.generate_content(
-                gemini_messages,
-                safety_settings=safety_settings
+            response = get_retry_policy("Gemini").call(
+                lambda: model.generate_content(gemini_messages, safety_settings=safety_settings),
+                self._on_error,
             )
+            if isinstance(response, Exception):
+                raise response
             if response.candidates and response.candidates[0].content:
                 reply_text = response.candidates[0].content.parts[0].text
                 logger.info(f"[Gemini] reply={reply_text}")
@@ -76,6 +80,13 @@ class GoogleGeminiBot(Bot):
             self.sessions.session_reply(error_message, session_id)
             return Reply(ReplyType.ERROR, error_message)
             
+    def _on_error(self, e, retry_count):
+        # 限流、服务端暂时不可用时重试，放弃重试时把异常交给reply处理
+        if isinstance(e, (ResourceExhausted, ServiceUnavailable, InternalServerError, DeadlineExceeded)):
+            logger.warn(f"[Gemini] {type(e).__name__}: {e}")
+            return e, 5
+        return e, None
+
     def _convert_to_gemini_messages(self, messages: list):
         res = []
         for msg in messages:
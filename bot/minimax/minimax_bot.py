@@ -1,10 +1,9 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
+from bot.retry import RetryableError, get_retry_policy
 from bot.minimax.minimax_session import MinimaxSession
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
@@ -12,7 +11,7 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from config import conf, load_config
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
-import requests
+from common import http_client
 from common import const
 
 
@@ -94,20 +93,19 @@ class MinimaxBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: MinimaxSession, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: MinimaxSession, args=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
-        :param retry_count: retry count
         :return: {}
         """
-        try:
+        def attempt():
             headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
             self.request_body["messages"].extend(session.messages)
             logger.info("[Minimax_AI] request_body={}".format(self.request_body))
             # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(self.base_url, headers=headers, json=self.request_body)
+            res = http_client.post(self.base_url, headers=headers, json=self.request_body)
 
             # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
             if res.status_code == 200:
@@ -123,29 +121,17 @@ class MinimaxBot(Bot):
                 logger.error(f"[Minimax_AI] chat failed, status_code={res.status_code}, " f"msg={error.get('message')}, type={error.get('type')}")
 
                 result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[Minimax_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
+                if res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
-                else:
-                    need_retry = False
+                if res.status_code >= 500 or res.status_code == 429:
+                    # 服务端错误或请求过于频繁，需要重试
+                    raise RetryableError(result, 3, res)
+                return result
 
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
-        except Exception as e:
+        def on_error(e, retry_count):
             logger.exception(e)
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, args, retry_count + 1)
-            else:
-                return result
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}, 3
+
+        return get_retry_policy("Minimax_AI").call(attempt, on_error)
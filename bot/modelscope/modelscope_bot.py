@@ -1,17 +1,17 @@
 # encoding:utf-8
 
-import time
 import json
 import openai
 import openai.error
 from bot.bot import Bot
+from bot.retry import RetryableError, get_retry_policy
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from config import conf, load_config
 from .modelscope_session import ModelScopeSession
-import requests
+from common import http_client
 
 
 # ModelScope对话模型API
@@ -99,15 +99,14 @@ class ModelScopeBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ModelScopeSession, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: ModelScopeSession, args=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
-        :param retry_count: retry count
         :return: {}
         """
-        try:
+        def attempt():
             headers = {
                 "Content-Type": "application/json",
                 "Authorization": "Bearer " + self.api_key
@@ -115,7 +114,7 @@ class ModelScopeBot(Bot):
             
             body = args
             body["messages"] = session.messages
-            res = requests.post(
+            res = http_client.post(
                 self.base_url,
                 headers=headers,
                 data=json.dumps(body)
@@ -140,42 +139,29 @@ class ModelScopeBot(Bot):
                              f"msg={error.get('message')}, type={error.get('type')}")
 
                 result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[MODELSCOPE_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
+                if res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
-                else:
-                    need_retry = False
+                if res.status_code >= 500 or res.status_code == 429:
+                    # 服务端错误或请求过于频繁，需要重试
+                    raise RetryableError(result, 3, res)
+                return result
 
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
-        except Exception as e:
+        def on_error(e, retry_count):
             logger.exception(e)
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, args, retry_count + 1)
-            else:
-                return result
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}, 3
+
+        return get_retry_policy("MODELSCOPE_AI").call(attempt, on_error)
 
-    def reply_text_stream(self, session: ModelScopeSession, args=None, retry_count=0) -> dict:
+    def reply_text_stream(self, session: ModelScopeSession, args=None) -> dict:
         """
         call ModelScope's ChatCompletion to get the answer with stream response
         :param session: a conversation session
         :param session_id: session id
-        :param retry_count: retry count
         :return: {}
         """
-        try:
+        def attempt():
             headers = {
                 "Content-Type": "application/json",
                 "Authorization": "Bearer " + self.api_key
@@ -185,7 +171,7 @@ class ModelScopeBot(Bot):
             body["messages"] = session.messages
             body["stream"] = True  # 启用流式响应
 
-            res = requests.post(
+            res = http_client.post(
                 self.base_url,
                 headers=headers,
                 data=json.dumps(body),
@@ -221,32 +207,20 @@ class ModelScopeBot(Bot):
                              f"msg={error.get('message')}, type={error.get('type')}")
 
                 result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[MODELSCOPE_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
+                if res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
-                else:
-                    need_retry = False
+                if res.status_code >= 500 or res.status_code == 429:
+                    # 服务端错误或请求过于频繁，需要重试
+                    raise RetryableError(result, 3, res)
+                return result
 
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text_stream(session, args, retry_count + 1)
-                else:
-                    return result
-        except Exception as e:
+        def on_error(e, retry_count):
             logger.exception(e)
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text_stream(session, args, retry_count + 1)
-            else:
-                return result
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}, 3
+
+        return get_retry_policy("MODELSCOPE_AI").call(attempt, on_error)
     def create_img(self, query, retry_count=0):
         try:
             logger.info("[ModelScopeImage] image_query={}".format(query))
@@ -265,7 +239,7 @@ class ModelScopeBot(Bot):
             json_payload = json.dumps(payload, ensure_ascii=False).encode('utf-8')
             
             # 使用 data 参数发送原始字符串（requests 会自动处理编码）
-            res = requests.post(url, headers=headers, data=json_payload)
+            res = http_client.post(url, headers=headers, data=json_payload)
             
             response_data = res.json()
             image_url = response_data['images'][0]['url']
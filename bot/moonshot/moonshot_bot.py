@@ -1,17 +1,16 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
+from bot.retry import RetryableError, get_retry_policy
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from config import conf, load_config
 from .moonshot_session import MoonshotSession
-import requests
+from common import http_client
 
 
 # ZhipuAI对话模型API
@@ -82,15 +81,14 @@ class MoonshotBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: MoonshotSession, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: MoonshotSession, args=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
-        :param retry_count: retry count
         :return: {}
         """
-        try:
+        def attempt():
             headers = {
                 "Content-Type": "application/json",
                 "Authorization": "Bearer " + self.api_key
@@ -99,7 +97,7 @@ class MoonshotBot(Bot):
             body["messages"] = session.messages
             # logger.debug("[MOONSHOT_AI] response={}".format(response))
             # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(
+            res = http_client.post(
                 self.base_url,
                 headers=headers,
                 json=body
@@ -118,29 +116,17 @@ class MoonshotBot(Bot):
                              f"msg={error.get('message')}, type={error.get('type')}")
 
                 result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[MOONSHOT_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
+                if res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
-                else:
-                    need_retry = False
+                if res.status_code >= 500 or res.status_code == 429:
+                    # 服务端错误或请求过于频繁，需要重试
+                    raise RetryableError(result, 3, res)
+                return result
 
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
-        except Exception as e:
+        def on_error(e, retry_count):
             logger.exception(e)
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, args, retry_count + 1)
-            else:
-                return result
+            return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}, 3
+
+        return get_retry_policy("MOONSHOT_AI").call(attempt, on_error)
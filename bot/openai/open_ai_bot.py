@@ -1,11 +1,11 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 
 from bot.bot import Bot
+from bot.retry import get_retry_policy
+from bot.upstream_pool import get_upstream_pool
 from bot.openai.open_ai_image import OpenAIImage
 from bot.openai.open_ai_session import OpenAISession
 from bot.session_manager import SessionManager
@@ -81,9 +81,13 @@ class OpenAIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
-    def reply_text(self, session: OpenAISession, retry_count=0):
-        try:
-            response = openai.Completion.create(prompt=str(session), **self.args)
+    def reply_text(self, session: OpenAISession):
+        def attempt():
+            response = get_upstream_pool("openai").request(
+                self.args.get("model"),
+                lambda kwargs: openai.Completion.create(prompt=str(session), **dict(self.args, **kwargs)),
+                True,
+            )
             res_content = response.choices[0]["text"].strip().replace("<|endoftext|>", "")
             total_tokens = response["usage"]["total_tokens"]
             completion_tokens = response["usage"]["completion_tokens"]
@@ -93,30 +97,25 @@ class OpenAIBot(Bot, OpenAIImage):
                 "completion_tokens": completion_tokens,
                 "content": res_content,
             }
-        except Exception as e:
-            need_retry = retry_count < 2
+
+        def on_error(e, retry_count):
+            retry_delay = None
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[OPEN_AI] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                retry_delay = 20
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[OPEN_AI] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                retry_delay = 5
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[OPEN_AI] APIConnectionError: {}".format(e))
-                need_retry = False
                 result["content"] = "我连接不到你的网络"
             else:
                 logger.warn("[OPEN_AI] Exception: {}".format(e))
-                need_retry = False
                 self.sessions.clear_session(session.session_id)
 
-            if need_retry:
-                logger.warn("[OPEN_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
-            else:
-                return result
+            return result, retry_delay
+
+        return get_retry_policy("OPEN_AI").call(attempt, on_error)
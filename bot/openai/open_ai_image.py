@@ -1,10 +1,10 @@
-import time
-
 import openai
 import openai.error
 
+from bot.retry import get_retry_policy
+from bot.upstream_pool import get_upstream_pool
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common.rate_limiter import get_rate_limiter
 from config import conf
 
 
@@ -12,32 +12,42 @@ from config import conf
 class OpenAIImage(object):
     def __init__(self):
         openai.api_key = conf().get("open_ai_api_key")
-        if conf().get("rate_limit_dalle"):
-            self.tb4dalle = TokenBucket(conf().get("rate_limit_dalle", 50))
 
     def create_img(self, query, retry_count=0, api_key=None, api_base=None):
-        try:
-            if conf().get("rate_limit_dalle") and not self.tb4dalle.get_token():
-                return False, "请求太快了，请休息一下再问我吧"
-            logger.info("[OPEN_AI] image_query={}".format(query))
-            response = openai.Image.create(
-                api_key=api_key,
+        """
+        :param retry_count: 保留参数，重试由重试策略控制
+        """
+        limiter = get_rate_limiter("dalle", conf().get("rate_limit_dalle"))
+        if limiter and not limiter.acquire():
+            return False, "请求太快了，请休息一下再问我吧"
+
+        model = conf().get("text_to_image") or "dall-e-2"
+
+        def send(kwargs):
+            return openai.Image.create(
                 prompt=query,  # 图片描述
                 n=1,  # 每次生成图片的数量
-                model=conf().get("text_to_image") or "dall-e-2",
+                model=model,
                 # size=conf().get("image_create_size", "256x256"),  # 图片大小,可选有 256x256, 512x512, 1024x1024
+                **kwargs,
             )
+
+        def attempt():
+            logger.info("[OPEN_AI] image_query={}".format(query))
+            if api_key:
+                # 用户自己设置的api_key不经过上游池
+                response = send({"api_key": api_key, "api_base": api_base} if api_base else {"api_key": api_key})
+            else:
+                response = get_upstream_pool("openai").request(model, send, True)
             image_url = response["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
             return True, image_url
-        except openai.error.RateLimitError as e:
-            logger.warn(e)
-            if retry_count < 1:
-                time.sleep(5)
-                logger.warn("[OPEN_AI] ImgCreate RateLimit exceed, 第{}次重试".format(retry_count + 1))
-                return self.create_img(query, retry_count + 1)
-            else:
-                return False, "画图出现问题，请休息一下再问我吧"
-        except Exception as e:
+
+        def on_error(e, retry_count):
+            if isinstance(e, openai.error.RateLimitError):
+                logger.warn(e)
+                return (False, "画图出现问题，请休息一下再问我吧"), 5
             logger.exception(e)
-            return False, "画图出现问题，请休息一下再问我吧"
+            return (False, "画图出现问题，请休息一下再问我吧"), None
+
+        return get_retry_policy("OPEN_AI_IMAGE").call(attempt, on_error)
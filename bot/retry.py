@@ -0,0 +1,228 @@
+"""
+bot调用模型接口的重试策略，所有bot共用：
+    等待时间按指数退避并加随机抖动，多个请求同时失败时不会在同一时刻一起重试
+    接口返回Retry-After时至少等待到该时间
+    每次请求有总时长上限(deadline)，剩余时间不够再等一次时直接放弃，返回错误提示
+    上游池切换到另一个上游时抛出FailoverError，立即重试且不计入重试次数，放弃时按原始错误生成提示
+    async_call在事件循环的定时器上等待，不占用线程；同步的call只能在当前线程中sleep
+每个策略记录请求、重试、放弃的次数，可通过#pool命令查看
+"""
+
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from common.log import logger
+from config import conf
+
+
+class RetryableError(Exception):
+    """
+    接口返回了可以重试的错误(如429、5xx)，由bot在一次请求中抛出
+    :param result: 放弃重试时返回的结果
+    :param delay: 建议的基础等待秒数，None表示使用默认值
+    :param response: 接口的响应，用于读取Retry-After
+    """
+
+    def __init__(self, result, delay=None, response=None):
+        super().__init__(result.get("content") if isinstance(result, dict) else getattr(result, "content", result))
+        self.result = result
+        self.delay = delay
+        self.response = response
+
+
+class FailoverError(Exception):
+    """
+    出错的上游已进入冷却且还有其它可用上游，由上游池抛出
+    :param error: 原始错误，超出总时长放弃时按该错误处理
+    :param delay: 换上游重试前的等待秒数
+    """
+
+    def __init__(self, error: Exception, delay):
+        super().__init__(str(error))
+        self.error = error
+        self.delay = delay
+
+
+def retry_after(e: Exception):
+    """
+    从异常携带的响应头中读取Retry-After
+    :return: 需要等待的秒数，没有时返回None
+    """
+    headers = getattr(e, "headers", None)
+    response = getattr(e, "response", None)
+    if not headers and response is not None:
+        headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        value = headers.get("retry-after-ms")
+        if value:
+            return float(value) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except Exception:
+        return None
+
+
+class RetryPolicy(object):
+    def __init__(self, name, max_retries=None, base_delay=1, max_delay=None, deadline=None):
+        """
+        :param max_retries: 最多重试次数，默认使用bot_retry_max配置
+        :param base_delay: 第一次重试的基础等待秒数，on_error可以按错误类型给出不同的值
+        :param max_delay: 单次等待的上限，默认使用bot_retry_max_delay配置
+        :param deadline: 从第一次请求开始的总时长上限，默认使用bot_retry_deadline配置
+        """
+        self.name = name
+        self.max_retries = conf().get("bot_retry_max", 2) if max_retries is None else max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay or conf().get("bot_retry_max_delay", 30)
+        self.deadline = deadline or conf().get("bot_retry_deadline", 60)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.recovered = 0  # 重试后成功的请求数
+        self.failovers = 0  # 换上游重试的次数，不计入retries
+        self.gave_up = 0
+        self.waited = 0.0
+
+    def backoff(self, retry_count, base_delay=None, error=None) -> float:
+        """
+        第retry_count+1次重试前等待的秒数，在[delay/2, delay]之间随机
+        """
+        delay = min(self.max_delay, (base_delay or self.base_delay) * (2 ** retry_count))
+        delay = random.uniform(delay / 2, delay)
+        after = retry_after(error) if error is not None else None
+        if after is not None:
+            delay = max(delay, after)
+        return delay
+
+    def _failover_delay(self, e, started):
+        """
+        :return: 换上游重试前的等待秒数，不是FailoverError或超出总时长时返回None
+        """
+        if isinstance(e, FailoverError) and time.monotonic() - started + e.delay <= self.deadline:
+            return e.delay
+        return None
+
+    def _next_delay(self, e, retry_count, started, on_error):
+        """
+        :return: (放弃重试时的结果, 等待秒数)，不再重试时等待秒数为None
+        """
+        if isinstance(e, FailoverError):
+            e = e.error
+        if isinstance(e, RetryableError):
+            result, base_delay = e.result, e.delay or self.base_delay
+            logger.warn("[{}] retryable error: {}".format(self.name, e))
+        else:
+            result, base_delay = on_error(e, retry_count)
+        if base_delay is None or retry_count >= self.max_retries:
+            return result, None
+        delay = self.backoff(retry_count, base_delay, e)
+        if time.monotonic() - started + delay > self.deadline:
+            logger.warn("[{}] retry after {:.1f}s exceeds deadline {}s, give up".format(self.name, delay, self.deadline))
+            return result, None
+        return result, delay
+
+    def _count(self, field, delay=0.0):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+            self.waited += delay
+
+    def call(self, attempt, on_error):
+        """
+        执行请求，失败时按策略重试
+        :param attempt: attempt()执行一次请求并返回结果，可以抛出RetryableError
+        :param on_error: on_error(e, retry_count)返回(放弃重试时的结果, 建议的基础等待秒数)，不应重试时等待秒数为None
+        """
+        started = time.monotonic()
+        retry_count = 0
+        self._count("requests")
+        while True:
+            try:
+                result = attempt()
+            except Exception as e:
+                delay = self._failover_delay(e, started)
+                if delay is not None:
+                    self._count("failovers", delay)
+                    time.sleep(delay)
+                    continue
+                result, delay = self._next_delay(e, retry_count, started, on_error)
+                if delay is None:
+                    self._count("gave_up")
+                    return result
+                self._count("retries", delay)
+                logger.warn("[{}] 第{}次重试，等待{:.1f}秒".format(self.name, retry_count + 1, delay))
+                time.sleep(delay)
+                retry_count += 1
+                continue
+            if retry_count:
+                self._count("recovered")
+            return result
+
+    async def async_call(self, attempt, on_error):
+        """
+        call的异步版本，attempt()返回awaitable，重试前的等待由事件循环定时唤醒
+        """
+        started = time.monotonic()
+        retry_count = 0
+        self._count("requests")
+        while True:
+            try:
+                result = await attempt()
+            except Exception as e:
+                delay = self._failover_delay(e, started)
+                if delay is not None:
+                    self._count("failovers", delay)
+                    await asyncio.sleep(delay)
+                    continue
+                result, delay = self._next_delay(e, retry_count, started, on_error)
+                if delay is None:
+                    self._count("gave_up")
+                    return result
+                self._count("retries", delay)
+                logger.warn("[{}] 第{}次重试，等待{:.1f}秒".format(self.name, retry_count + 1, delay))
+                await asyncio.sleep(delay)
+                retry_count += 1
+                continue
+            if retry_count:
+                self._count("recovered")
+            return result
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "recovered": self.recovered,
+                "failovers": self.failovers,
+                "gave_up": self.gave_up,
+                "waited": self.waited,
+            }
+
+
+_policies = {}
+_lock = threading.Lock()
+
+
+def get_retry_policy(name, base_delay=1) -> RetryPolicy:
+    """
+    按名称获取共享的重试策略，同一个bot的多个实例共用统计
+    """
+    with _lock:
+        policy = _policies.get(name)
+        if policy is None:
+            policy = _policies[name] = RetryPolicy(name, base_delay=base_delay)
+        return policy
+
+
+def all_retry_policies() -> dict:
+    with _lock:
+        return dict(_policies)
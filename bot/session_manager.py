@@ -1,3 +1,6 @@
+import time
+
+from bot.session_store import get_session_store
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from config import conf
@@ -7,6 +10,8 @@ class Session(object):
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
         self.messages = []
+        self.token_cache = {}  # id(message) -> (message, tokens)，每条消息的token数只计算一次
+        self.store_updated = None  # 最后一次从持久化存储加载或写入的修改时间
         if system_prompt is None:
             self.system_prompt = conf().get("character_desc", "")
         else:
@@ -16,6 +21,7 @@ class Session(object):
     def reset(self):
         system_item = {"role": "system", "content": self.system_prompt}
         self.messages = [system_item]
+        self.token_cache = {}
 
     def set_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
@@ -33,18 +39,71 @@ class Session(object):
         raise NotImplementedError
 
     def calc_tokens(self):
+        self.cache_message_tokens(self.messages)
+        return sum(self.token_cache[id(message)][1] for message in self.messages)
+
+    def count_message_tokens(self, message) -> int:
+        """
+        计算单条消息的token数，由子类实现
+        """
         raise NotImplementedError
 
+    def count_messages_tokens(self, messages) -> list:
+        """
+        批量计算多条消息的token数，子类可覆盖为一次调用完成
+        """
+        return [self.count_message_tokens(message) for message in messages]
+
+    def cache_message_tokens(self, messages):
+        """
+        计算并缓存尚未计算过的消息的token数，已缓存的消息不会重复计算
+        """
+        uncached = []
+        for message in messages:
+            cached = self.token_cache.get(id(message))
+            if cached is None or cached[0] is not message:
+                uncached.append(message)
+        if not uncached:
+            return
+        counts = self.count_messages_tokens(uncached)
+        if len(self.token_cache) + len(uncached) > 2 * len(self.messages) + 16:  # 清理已不在会话中的消息
+            live_ids = {id(m) for m in self.messages}
+            self.token_cache = {k: v for k, v in self.token_cache.items() if k in live_ids}
+        for message, tokens in zip(uncached, counts):
+            self.token_cache[id(message)] = (message, tokens)
+
+    def message_tokens(self, message) -> int:
+        """
+        获取单条消息的token数，结果按消息缓存，裁剪历史时无需重新计算整个会话
+        """
+        self.cache_message_tokens([message])
+        return self.token_cache[id(message)][1]
+
+    def pop_message(self, index, cur_tokens, precise=True, max_tokens=0):
+        """
+        删除一条消息，并返回删除后的token数
+        :param precise: token数是否精确计算，不精确时按原有方式粗略扣减max_tokens
+        """
+        message = self.messages.pop(index)
+        if not precise:
+            return cur_tokens - max_tokens
+        cached = self.token_cache.pop(id(message), None)
+        if cached is not None and cached[0] is message:
+            return cur_tokens - cached[1]
+        return cur_tokens - self.count_message_tokens(message)
+
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
         if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
+            sessions = ExpiredDict(conf().get("expires_in_seconds"), max_size=conf().get("session_cache_size") or None)
         else:
             sessions = dict()
         self.sessions = sessions
         self.sessioncls = sessioncls
         self.session_args = session_args
+        self.store = get_session_store()  # 为None时会话只保存在内存中
+        self.store_prefix = sessioncls.__name__ + ":"
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -54,13 +113,68 @@ class SessionManager(object):
         if session_id is None:
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
+        if session_id in self.sessions and self.is_stale(self.sessions[session_id]):
+            del self.sessions[session_id]
         if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+            session = self.load_session(session_id)
+            if session is None:
+                self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+            else:
+                self.sessions[session_id] = session
+                if system_prompt is not None:
+                    session.set_system_prompt(system_prompt)
+                    self.save_session(session)
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
             self.sessions[session_id].set_system_prompt(system_prompt)
+            self.save_session(self.sessions[session_id])
         session = self.sessions[session_id]
         return session
 
+    def is_stale(self, session):
+        """
+        多个进程共享存储时，内存中的会话可能已被其它进程更新或清除，修改时间与存储中不一致时需要重新加载
+        """
+        if self.store is None:
+            return False
+        try:
+            version = self.store.version(self.store_prefix + str(session.session_id))
+        except Exception as e:
+            logger.warning("[SessionManager] check session {} failed: {}".format(session.session_id, e))
+            return False
+        return version != session.store_updated
+
+    def load_session(self, session_id):
+        """
+        从持久化存储中加载会话，不存在或已过期时返回None
+        """
+        if self.store is None:
+            return None
+        try:
+            data = self.store.load(self.store_prefix + str(session_id))
+        except Exception as e:
+            logger.warning("[SessionManager] load session {} failed: {}".format(session_id, e))
+            return None
+        if not data:
+            return None
+        expires_in_seconds = conf().get("expires_in_seconds")
+        if expires_in_seconds and time.time() - data.get("updated", 0) > expires_in_seconds:
+            self.store.delete(self.store_prefix + str(session_id))  # 不等定期清理，直接删除过期的记录
+            return None
+        session = self.sessioncls(session_id, data.get("system_prompt"), **self.session_args)
+        session.messages = data.get("messages", [])
+        session.store_updated = data.get("updated")
+        return session
+
+    def save_session(self, session):
+        """
+        将会话写入持久化存储，由存储在后台批量落盘
+        """
+        if self.store is None or session.session_id is None:
+            return
+        data = {"system_prompt": session.system_prompt, "messages": list(session.messages), "updated": time.time()}
+        session.store_updated = data["updated"]
+        self.store.save(self.store_prefix + str(session.session_id), data)
+
     def session_query(self, query, session_id):
         session = self.build_session(session_id)
         session.add_query(query)
@@ -70,6 +184,7 @@ class SessionManager(object):
             logger.debug("prompt tokens used={}".format(total_tokens))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self.save_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
@@ -81,11 +196,16 @@ class SessionManager(object):
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.save_session(session)
         return session
 
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+        if self.store is not None:
+            self.store.delete(self.store_prefix + str(session_id))
 
     def clear_all_session(self):
         self.sessions.clear()
+        if self.store is not None:
+            self.store.clear(self.store_prefix)
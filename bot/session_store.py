@@ -0,0 +1,338 @@
+"""
+会话持久化存储，SessionManager在内存缓存未命中时从这里加载会话
+写入先进入待写队列，由后台线程批量落盘(write-behind)，不会在每条消息上同步写磁盘
+每条会话记录带有最后修改时间，多个进程共享存储时SessionManager据此判断内存中的会话是否已被其它进程更新
+配置了expires_in_seconds时，后台落盘时定期删除超过该时间未修改的会话，存储不会无限增长
+"""
+
+import atexit
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows下没有fcntl，log存储只支持单进程
+    fcntl = None
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+PURGE_INTERVAL = 600  # 清理过期会话的间隔秒数
+
+
+class SessionStore(object):
+    def __init__(self, flush_interval=1.0, expires_in_seconds=None):
+        """
+        :param expires_in_seconds: 会话超过该时间未修改时删除，为空时一直保留
+        """
+        self.flush_interval = flush_interval
+        self.expires_in_seconds = expires_in_seconds
+        self.last_purge = 0
+        self.pending = {}  # key -> data，None表示删除，同一key只保留最后一次写入
+        self.pending_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        if flush_interval and flush_interval > 0:
+            _thread = threading.Thread(target=self._flush_loop, name="session-store", daemon=True)
+            _thread.start()
+        atexit.register(self.flush)
+
+    def load(self, key):
+        """
+        :return: 会话数据dict，不存在时返回None
+        """
+        with self.pending_lock:
+            if key in self.pending:
+                return self.pending[key]
+        return self._load(key)
+
+    def version(self, key):
+        """
+        :return: 会话最后修改的时间，不存在时返回None
+        """
+        with self.pending_lock:
+            if key in self.pending:
+                data = self.pending[key]
+                return data.get("updated") if data else None
+        return self._version(key)
+
+    def save(self, key, data: dict):
+        with self.pending_lock:
+            self.pending[key] = data
+        if not self.flush_interval or self.flush_interval <= 0:
+            self.flush()
+
+    def delete(self, key):
+        with self.pending_lock:
+            self.pending[key] = None
+        if not self.flush_interval or self.flush_interval <= 0:
+            self.flush()
+
+    def clear(self, prefix):
+        """
+        删除key以prefix开头的所有会话
+        """
+        with self.flush_lock:
+            with self.pending_lock:
+                self.pending = {k: v for k, v in self.pending.items() if not k.startswith(prefix)}
+            self._clear(prefix)
+
+    def flush(self):
+        with self.flush_lock:
+            self._purge_expired()
+            with self.pending_lock:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return
+            records = {}
+            for key, data in batch.items():
+                # 逐条序列化，单个会话无法序列化时只丢弃这一条，不影响其它会话落盘
+                try:
+                    records[key] = None if data is None else (json.dumps(data, ensure_ascii=False), data.get("updated") or time.time())
+                except Exception as e:
+                    logger.error("[session_store] drop session {}, serialize failed: {}".format(key, e))
+            if not records:
+                return
+            try:
+                self._write_batch(records)
+            except Exception as e:
+                logger.exception("[session_store] flush {} sessions failed: {}".format(len(records), e))
+                with self.pending_lock:  # 写入失败时放回队列，未被新数据覆盖的下次重试
+                    for key in records:
+                        self.pending.setdefault(key, batch[key])
+
+    def _purge_expired(self):
+        # 调用方持有flush_lock，每PURGE_INTERVAL秒最多清理一次，启动后的第一次落盘会先清理
+        if not self.expires_in_seconds or time.time() - self.last_purge < PURGE_INTERVAL:
+            return
+        self.last_purge = time.time()
+        try:
+            count = self._purge(time.time() - self.expires_in_seconds)
+            if count:
+                logger.info("[session_store] purge {} expired sessions".format(count))
+        except Exception as e:
+            logger.exception("[session_store] purge expired sessions failed: {}".format(e))
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _load(self, key):
+        raise NotImplementedError
+
+    def _version(self, key):
+        raise NotImplementedError
+
+    def _write_batch(self, records: dict):
+        """
+        :param records: key -> (序列化后的json, 修改时间)，None表示删除
+        """
+        raise NotImplementedError
+
+    def _clear(self, prefix):
+        raise NotImplementedError
+
+    def _purge(self, before) -> int:
+        """
+        删除修改时间早于before的会话
+        :return: 删除的会话数
+        """
+        raise NotImplementedError
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    SQLite存储，开启WAL模式，多个进程可以共享同一个数据库文件
+    """
+
+    def __init__(self, path, flush_interval=1.0, expires_in_seconds=None):
+        self.path = path
+        self.local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+        conn.commit()
+        super().__init__(flush_interval, expires_in_seconds)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # WAL模式下只在checkpoint时fsync
+            self.local.conn = conn
+        return conn
+
+    def _load(self, key):
+        row = self._conn().execute("SELECT data FROM sessions WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _version(self, key):
+        row = self._conn().execute("SELECT updated FROM sessions WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _write_batch(self, records: dict):
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sessions (key, data, updated) VALUES (?, ?, ?)",
+                [(key, record[0], record[1]) for key, record in records.items() if record is not None],
+            )
+            conn.executemany("DELETE FROM sessions WHERE key = ?", [(key,) for key, record in records.items() if record is None])
+
+    def _clear(self, prefix):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+    def _purge(self, before) -> int:
+        conn = self._conn()
+        with conn:
+            return conn.execute("DELETE FROM sessions WHERE updated < ?", (before,)).rowcount
+
+
+class LogSessionStore(SessionStore):
+    """
+    追加写日志存储，每行一条json记录，启动时回放日志建立索引
+    其它进程追加的记录在读取时增量加载，日志过大时自动压缩
+    追加和压缩持有同一个文件锁(fcntl.flock)，多个进程的写入不会交错，压缩时也不会丢失其它进程的追加
+    没有fcntl的平台(Windows)只能在单进程中使用
+    """
+
+    def __init__(self, path, flush_interval=1.0, expires_in_seconds=None, compact_threshold=10000):
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self.index = {}
+        self.offset = 0
+        self.inode = None
+        self.lines = 0
+        self.file_lock = threading.Lock()
+        with self.file_lock:
+            self._refresh()
+        super().__init__(flush_interval, expires_in_seconds)
+
+    def _refresh(self):
+        # 读取上次之后新增的日志，文件被压缩替换时重新读取
+        if not os.path.exists(self.path):
+            return
+        stat = os.stat(self.path)
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.index, self.offset, self.lines, self.inode = {}, 0, 0, stat.st_ino
+        if stat.st_size == self.offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):  # 其它进程正在写入的行，下次再读
+                    break
+                self.offset += len(line)
+                self.lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("op") == "clear":
+                    self.index = {k: v for k, v in self.index.items() if not k.startswith(record["key"])}
+                elif record.get("data") is None:
+                    self.index.pop(record["key"], None)
+                else:
+                    self.index[record["key"]] = record["data"]
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # 线程锁之外再加进程间的文件锁，锁文件与日志分开，压缩替换日志文件时锁不受影响
+        with self.file_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.path + ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _append(self, lines):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+            f.flush()
+        self._refresh()
+
+    def _load(self, key):
+        with self.file_lock:
+            self._refresh()
+            return self.index.get(key)
+
+    def _version(self, key):
+        with self.file_lock:
+            self._refresh()
+            data = self.index.get(key)
+            return data.get("updated") if data else None
+
+    def _write_batch(self, records: dict):
+        lines = []
+        for key, record in records.items():
+            data = "null" if record is None else record[0]
+            lines.append('{{"key": {}, "data": {}}}\n'.format(json.dumps(key, ensure_ascii=False), data))
+        with self._locked():
+            self._append(lines)
+            if self.lines > self.compact_threshold and self.lines > 4 * len(self.index):
+                self._compact()
+
+    def _clear(self, prefix):
+        with self._locked():
+            self._append([json.dumps({"op": "clear", "key": prefix}, ensure_ascii=False) + "\n"])
+
+    def _purge(self, before) -> int:
+        with self._locked():
+            self._refresh()
+            expired = [key for key, data in self.index.items() if data.get("updated", 0) < before]
+            if expired:
+                self._compact()  # 压缩时跳过过期的会话
+            return len(expired)
+
+    def _compact(self):
+        # 调用方持有文件锁，_append之后的索引已包含所有进程写入的记录
+        before = time.time() - self.expires_in_seconds if self.expires_in_seconds else 0
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, data in self.index.items():
+                if data.get("updated", 0) < before:
+                    continue
+                f.write(json.dumps({"key": key, "data": data}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+        lines = self.lines
+        self.inode = None
+        self._refresh()
+        logger.info("[session_store] compact log {}, {} lines -> {} sessions".format(self.path, lines, len(self.index)))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_session_store():
+    """
+    根据配置获取会话存储，memory类型返回None，即只保存在进程内存中
+    """
+    store_type = conf().get("session_store", "memory")
+    if not store_type or store_type == "memory":
+        return None
+    with _stores_lock:
+        if store_type not in _stores:
+            flush_interval = conf().get("session_store_flush_interval", 1)
+            expires_in_seconds = conf().get("expires_in_seconds")
+            path = conf().get("session_store_path")
+            if store_type == "sqlite":
+                _stores[store_type] = SqliteSessionStore(path or os.path.join(get_appdata_dir(), "sessions.db"), flush_interval, expires_in_seconds)
+            elif store_type == "log":
+                _stores[store_type] = LogSessionStore(path or os.path.join(get_appdata_dir(), "sessions.log"), flush_interval, expires_in_seconds)
+            else:
+                raise RuntimeError("unknown session_store type: {}".format(store_type))
+            logger.info("[session_store] use {} session store".format(store_type))
+        return _stores[store_type]
@@ -0,0 +1,264 @@
+"""
+OpenAI兼容接口的上游池，多个(api_key, api_base, 模型, 权重)之间分摊请求，单个key的RPM/TPM额度不再限制整个服务
+    选择上游时按 权重 / ((处理中的请求数+1) * 平均延迟) 加权随机，请求少、响应快、权重高的上游分到更多请求，
+    较慢的上游也会按比例分到请求，延迟数据持续更新，额度在所有上游之间分摊
+    只处理指定模型的上游不会分到其它模型的请求，没有上游处理某个模型时该模型的请求分配到所有上游
+    返回429、5xx、鉴权失败或连接超时的上游进入冷却，冷却期间不再分配请求，连续失败时冷却时间翻倍
+    每个上游记录请求数、失败数和消耗的token，可通过#upstream命令查看
+未配置open_ai_upstreams时只有一个由open_ai_api_key、open_ai_api_base组成的上游，行为与之前一致
+"""
+
+import json
+import random
+import threading
+import time
+
+from bot.retry import FailoverError, retry_after
+from common.log import logger
+from config import conf
+
+LATENCY_ALPHA = 0.3  # 延迟的指数移动平均系数
+FAILOVER_DELAY = 0.1  # 换一个上游重试前的等待秒数
+UPSTREAM_KEYS = ["api_key", "api_base", "weight", "name", "api_type", "api_version", "deployment_id"]
+
+
+class Upstream(object):
+    def __init__(self, api_key, api_base=None, models=None, weight=1, name=None, api_type=None, api_version=None, deployment_id=None):
+        """
+        :param models: 只处理这些模型的请求，为空时处理所有模型
+        """
+        self.api_key = api_key
+        self.api_base = api_base
+        if isinstance(models, str):
+            models = [models]
+        self.models = models or []
+        self.weight = weight if weight and weight > 0 else 1
+        self.name = name or "{}#{}".format(api_base or "default", (api_key or "")[-4:])
+        self.api_type = api_type
+        self.api_version = api_version
+        self.deployment_id = deployment_id
+        self.outstanding = 0
+        self.latency = None
+        self.cooldown_until = 0.0
+        self.failures = 0  # 连续失败次数
+        # 用量记录
+        self.requests = 0
+        self.errors = 0
+        self.cooldowns = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+
+    def serves(self, model) -> bool:
+        return not self.models or not model or model in self.models
+
+    def kwargs(self) -> dict:
+        """
+        :return: 传给openai接口的参数
+        """
+        kwargs = {"api_key": self.api_key}
+        if self.api_base:
+            kwargs["api_base"] = self.api_base
+        if self.api_type:
+            kwargs["api_type"] = self.api_type
+        if self.api_version:
+            kwargs["api_version"] = self.api_version
+        if self.deployment_id:
+            kwargs["deployment_id"] = self.deployment_id
+        return kwargs
+
+
+def _usage(result):
+    try:
+        usage = result.get("usage") if isinstance(result, dict) else None
+    except Exception:
+        usage = None
+    return usage if isinstance(usage, dict) else None
+
+
+def _status(error):
+    status = getattr(error, "http_status", None)
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    return status
+
+
+class UpstreamPool(object):
+    def __init__(self, name, upstreams: list):
+        self.name = name
+        self.upstreams = upstreams
+        self.lock = threading.Lock()
+        self.cooldown = conf().get("upstream_cooldown", 30)
+        self.cooldown_max = conf().get("upstream_cooldown_max", 600)
+
+    def acquire(self, model=None) -> Upstream:
+        """
+        选择一个上游，请求结束后必须调用release
+        """
+        with self.lock:
+            now = time.monotonic()
+            candidates = [u for u in self.upstreams if u.serves(model)]
+            if not candidates:
+                logger.debug("[upstream] no upstream configured for model {}, use all upstreams".format(model))
+                candidates = self.upstreams
+            ready = [u for u in candidates if u.cooldown_until <= now]
+            if ready:
+                # 还没有延迟数据的上游按最快的上游估计，保证新上游能被选到
+                known = [u.latency for u in ready if u.latency is not None]
+                default = min(known) if known else 1.0
+                scores = [u.weight / ((u.outstanding + 1) * max(u.latency or default, 0.001)) for u in ready]
+                upstream = random.choices(ready, weights=scores)[0]
+            else:
+                # 全部在冷却时选择最早恢复的上游，不直接拒绝请求
+                upstream = min(candidates, key=lambda u: u.cooldown_until)
+            upstream.outstanding += 1
+            upstream.requests += 1
+            return upstream
+
+    def release(self, upstream: Upstream, latency=None, error=None, status=None, usage=None):
+        """
+        :param latency: 请求耗时，出错时不计入平均延迟
+        :param error: 请求抛出的异常
+        :param status: 没有异常时接口返回的HTTP状态码
+        :param usage: 接口返回的usage
+        """
+        if status is None and error is not None:
+            status = _status(error)
+        failed = error is not None or (status is not None and status >= 400)
+        with self.lock:
+            upstream.outstanding -= 1
+            if not failed:
+                upstream.failures = 0
+                if latency is not None:
+                    upstream.latency = latency if upstream.latency is None else upstream.latency * (1 - LATENCY_ALPHA) + latency * LATENCY_ALPHA
+                if usage:
+                    upstream.prompt_tokens += usage.get("prompt_tokens", 0) or 0
+                    upstream.completion_tokens += usage.get("completion_tokens", 0) or 0
+                    upstream.total_tokens += usage.get("total_tokens", 0) or 0
+                return
+            upstream.errors += 1
+            seconds = self._cooldown_seconds(upstream, error, status)
+            if seconds:
+                upstream.failures += 1
+                upstream.cooldowns += 1
+                upstream.cooldown_until = max(upstream.cooldown_until, time.monotonic() + seconds)
+        if seconds:
+            logger.warn("[upstream] {} cool down {:.0f}s, status={}, error={}".format(upstream.name, seconds, status, error))
+
+    def _cooldown_seconds(self, upstream: Upstream, error, status):
+        if status in (401, 403):
+            return self.cooldown_max
+        network_error = status is None and error is not None and ("Timeout" in type(error).__name__ or "Connection" in type(error).__name__)
+        if status == 429 or (status is not None and status >= 500) or network_error:
+            seconds = min(self.cooldown_max, self.cooldown * (2 ** upstream.failures))
+            after = retry_after(error) if error is not None else None
+            return max(seconds, after) if after is not None else seconds
+        return 0
+
+    def request(self, model, send, failover=False):
+        """
+        选择上游执行send(kwargs)，kwargs为该上游的openai接口参数，记录耗时、用量和错误
+        :param failover: 为True时，上游出错进入冷却且还有其它可用上游则抛出FailoverError，由重试策略立即换一个上游重试
+        """
+        upstream = self.acquire(model)
+        start = time.monotonic()
+        try:
+            result = send(upstream.kwargs())
+        except Exception as e:
+            self.release(upstream, error=e)
+            if failover and self.failover(upstream, model):
+                raise FailoverError(e, FAILOVER_DELAY) from e
+            raise
+        self.release(upstream, time.monotonic() - start, status=getattr(result, "status_code", None), usage=_usage(result))
+        return result
+
+    async def async_request(self, model, send, failover=False):
+        """
+        request的异步版本，send(kwargs)返回awaitable
+        """
+        upstream = self.acquire(model)
+        start = time.monotonic()
+        try:
+            result = await send(upstream.kwargs())
+        except Exception as e:
+            self.release(upstream, error=e)
+            if failover and self.failover(upstream, model):
+                raise FailoverError(e, FAILOVER_DELAY) from e
+            raise
+        self.release(upstream, time.monotonic() - start, status=getattr(result, "status_code", None), usage=_usage(result))
+        return result
+
+    def failover(self, upstream: Upstream, model=None) -> bool:
+        """
+        :return: 上游刚进入冷却且还有其它可用上游时返回True，调用方可以立即换一个上游重试
+        """
+        with self.lock:
+            now = time.monotonic()
+            if upstream.cooldown_until <= now:
+                return False
+            return any(u is not upstream and u.serves(model) and u.cooldown_until <= now for u in self.upstreams)
+
+    def stats(self) -> list:
+        with self.lock:
+            now = time.monotonic()
+            return [
+                {
+                    "name": u.name,
+                    "weight": u.weight,
+                    "outstanding": u.outstanding,
+                    "latency": u.latency or 0,
+                    "cooldown": max(u.cooldown_until - now, 0),
+                    "requests": u.requests,
+                    "errors": u.errors,
+                    "cooldowns": u.cooldowns,
+                    "prompt_tokens": u.prompt_tokens,
+                    "completion_tokens": u.completion_tokens,
+                    "total_tokens": u.total_tokens,
+                }
+                for u in self.upstreams
+            ]
+
+
+def _build_upstreams(default: dict) -> list:
+    upstreams = []
+    for entry in conf().get("open_ai_upstreams") or []:
+        if not entry.get("api_key"):
+            logger.warn("[upstream] skip upstream without api_key: {}".format(entry.get("name") or entry.get("api_base")))
+            continue
+        kwargs = dict(default)
+        kwargs.update({k: v for k, v in entry.items() if k in UPSTREAM_KEYS})
+        kwargs["models"] = entry.get("models") or entry.get("model")
+        upstreams.append(Upstream(**kwargs))
+    if not upstreams:
+        upstreams.append(Upstream(conf().get("open_ai_api_key"), conf().get("open_ai_api_base") or None, **default))
+    return upstreams
+
+
+_pools = {}
+_signatures = {}
+_lock = threading.Lock()
+
+
+def get_upstream_pool(name="openai", **default) -> UpstreamPool:
+    """
+    按名称获取共享的上游池，相关配置变化后重新创建
+    :param default: 每个上游的默认参数，如azure的api_type、api_version
+    """
+    signature = json.dumps(
+        [conf().get("open_ai_upstreams"), conf().get("open_ai_api_key"), conf().get("open_ai_api_base"), default],
+        sort_keys=True,
+        default=str,
+    )
+    with _lock:
+        pool = _pools.get(name)
+        if pool is None or _signatures.get(name) != signature:
+            pool = _pools[name] = UpstreamPool(name, _build_upstreams(default))
+            _signatures[name] = signature
+            logger.info("[upstream] {} pool: {}".format(name, ", ".join(u.name for u in pool.upstreams)))
+        return pool
+
+
+def all_upstream_pools() -> dict:
+    with _lock:
+        return dict(_pools)
@@ -0,0 +1,154 @@
+# encoding:utf-8
+
+import base64
+import hashlib
+import hmac
+import json
+import ssl
+import threading
+import time
+from collections import deque
+from urllib.parse import urlencode, urlparse
+from wsgiref.handlers import format_date_time
+
+import websocket
+
+from common.log import logger
+
+
+class SparkError(Exception):
+    def __init__(self, code, message):
+        super().__init__("code={}, message={}".format(code, message))
+        self.code = code
+
+
+class SparkClient(object):
+    """
+    讯飞星火websocket客户端
+    请求在调用线程中发送，收到一段回复就产出一段，不需要额外线程和轮询；
+    鉴权url在有效期内复用，服务端在回复结束后未关闭的连接放回连接池供下次请求使用
+    """
+
+    URL_TTL = 240  # 鉴权url中的date与服务端时间相差不能超过300秒
+    IDLE_TIMEOUT = 50  # 空闲连接超过这个时间不再复用
+
+    def __init__(self, app_id, api_key, api_secret, spark_url, domain, pool_size=4, timeout=180):
+        """
+        :param timeout: 两段回复之间的最长等待时间，而不是整个回复的总耗时
+        """
+        self.app_id = app_id
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.spark_url = spark_url
+        self.domain = domain
+        self.host = urlparse(spark_url).netloc
+        self.path = urlparse(spark_url).path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = deque()  # (websocket, 放回时间)
+        self.url = None
+        self.url_time = 0
+        self.reusable = True  # 服务端每次回复后都关闭连接时不再尝试复用
+
+    def signed_url(self):
+        with self.lock:
+            now = time.time()
+            if self.url and now - self.url_time < self.URL_TTL:
+                return self.url
+            # 生成RFC1123格式的时间戳
+            date = format_date_time(now)
+            signature_origin = "host: {}\ndate: {}\nGET {} HTTP/1.1".format(self.host, date, self.path)
+            signature_sha = hmac.new(self.api_secret.encode("utf-8"), signature_origin.encode("utf-8"), digestmod=hashlib.sha256).digest()
+            signature = base64.b64encode(signature_sha).decode(encoding="utf-8")
+            authorization_origin = f'api_key="{self.api_key}", algorithm="hmac-sha256", headers="host date request-line", signature="{signature}"'
+            authorization = base64.b64encode(authorization_origin.encode("utf-8")).decode(encoding="utf-8")
+            self.url = self.spark_url + "?" + urlencode({"authorization": authorization, "date": date, "host": self.host})
+            self.url_time = now
+            return self.url
+
+    def _acquire(self):
+        """
+        :return: (websocket, 是否为复用的连接)
+        """
+        with self.lock:
+            while self.idle:
+                ws, released_at = self.idle.pop()
+                if ws.connected and time.time() - released_at < self.IDLE_TIMEOUT:
+                    return ws, True
+                ws.close()
+        ws = websocket.create_connection(self.signed_url(), timeout=self.timeout, sslopt={"cert_reqs": ssl.CERT_NONE})
+        return ws, False
+
+    def _release(self, ws):
+        with self.lock:
+            if self.reusable and ws.connected and len(self.idle) < self.pool_size:
+                self.idle.append((ws, time.time()))
+                return
+        ws.close()
+
+    def gen_params(self, messages, temperature=0.5, max_tokens=2048):
+        return {
+            "header": {"app_id": self.app_id, "uid": "1234"},
+            "parameter": {
+                "chat": {
+                    "domain": self.domain,
+                    "temperature": temperature,
+                    "max_tokens": max_tokens,
+                    "auditing": "default",
+                }
+            },
+            "payload": {"message": {"text": messages}},
+        }
+
+    def stream(self, messages, result=None, **kwargs):
+        """
+        逐段产出回复内容
+        :param result: 传入dict时，回复结束后写入usage
+        """
+        data = json.dumps(self.gen_params(messages, **kwargs))
+        ws, reused = self._acquire()
+        received = False
+        try:
+            while True:
+                try:
+                    if not received:
+                        ws.send(data)
+                    message = ws.recv()
+                    if not message:
+                        raise websocket.WebSocketConnectionClosedException("connection closed")
+                except (websocket.WebSocketConnectionClosedException, ConnectionError, BrokenPipeError):
+                    if not (reused and not received):
+                        raise
+                    # 复用的连接已被服务端关闭，之后不再复用，换新连接重发
+                    logger.debug("[XunFei] pooled connection closed by server, disable reuse")
+                    self.reusable = False
+                    ws.close()
+                    ws, reused = self._acquire()
+                    continue
+                received = True
+                response = json.loads(message)
+                code = response["header"]["code"]
+                if code != 0:
+                    raise SparkError(code, response["header"].get("message"))
+                choices = response["payload"]["choices"]
+                content = choices["text"][0]["content"]
+                if content:
+                    yield content
+                if choices["status"] == 2:
+                    if result is not None:
+                        result["usage"] = response["payload"].get("usage", {}).get("text", {})
+                    break
+        except BaseException:
+            # 出错或调用方提前停止读取时，连接上可能还有未读完的回复，不能复用
+            ws.close()
+            raise
+        self._release(ws)
+
+    def chat(self, messages, **kwargs):
+        """
+        :return: (完整回复, usage)
+        """
+        result = {}
+        content = "".join(self.stream(messages, result, **kwargs))
+        return content, result.get("usage", {})
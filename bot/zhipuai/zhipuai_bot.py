@@ -1,10 +1,9 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
+from bot.retry import get_retry_policy
 from bot.zhipuai.zhipu_ai_session import ZhipuAISession
 from bot.zhipuai.zhipu_ai_image import ZhipuAIImage
 from bot.session_manager import SessionManager
@@ -90,20 +89,20 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ZhipuAISession, api_key=None, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: ZhipuAISession, api_key=None, args=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
-        :param retry_count: retry count
         :return: {}
         """
-        try:
+        if args is None:
+            args = self.args
+
+        def attempt():
             # if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
             #     raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
             # if api_key == None, the default openai.api_key will be used
-            if args is None:
-                args = self.args
             # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
             response = self.client.chat.completions.create(messages=session.messages, **args)
             # logger.debug("[ZHIPU_AI] response={}".format(response))
@@ -114,36 +113,30 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
                 "completion_tokens": response.usage.completion_tokens,
                 "content": response.choices[0].message.content,
             }
-        except Exception as e:
-            need_retry = retry_count < 2
+
+        def on_error(e, retry_count):
+            retry_delay = None
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                retry_delay = 20
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                retry_delay = 5
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                retry_delay = 10
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
                 result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
+                retry_delay = 5
             else:
                 logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
-                need_retry = False
                 self.sessions.clear_session(session.session_id)
 
-            if need_retry:
-                logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
-                return result
+            return result, retry_delay
+
+        return get_retry_policy("ZHIPU_AI").call(attempt, on_error)
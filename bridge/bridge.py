@@ -1,6 +1,7 @@
 from bot.bot_factory import create_bot
 from bridge.context import Context
 from bridge.reply import Reply
+from bridge.reply_cache import get_reply_cache
 from common import const
 from common.log import logger
 from common.singleton import singleton
@@ -83,8 +84,17 @@ class Bridge(object):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
+        cache = get_reply_cache()
+        if cache:
+            return cache.fetch(self.get_bot("chat"), self.btype["chat"], query, context)
         return self.get_bot("chat").reply(query, context)
 
+    async def async_fetch_reply_content(self, query, context: Context) -> Reply:
+        cache = get_reply_cache()
+        if cache:
+            return await cache.async_fetch(self.get_bot("chat"), self.btype["chat"], query, context)
+        return await self.get_bot("chat").async_reply(query, context)
+
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
 
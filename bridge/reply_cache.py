@@ -0,0 +1,187 @@
+"""
+bot文本回复缓存，位于Bridge和bot之间，相同的问题在有效期内直接返回上次的回复，不再调用模型接口
+缓存key由(bot类型, 模型, 系统提示词, 最近几条历史消息, 当前问题)组成，消息内容先做归一化，
+scope为session时再加上会话id，即每个会话单独缓存
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+
+from bot.session_manager import SessionManager
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf
+
+_PUNCTUATION = re.compile(r"[\s?？!！。.,，~～]+$")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(text) -> str:
+    # 忽略大小写、多余空白和句尾标点，"今天天气？"和"今天天气"视为同一个问题
+    text = _SPACES.sub(" ", str(text).strip().lower())
+    return _PUNCTUATION.sub("", text)
+
+
+class ReplyCache(object):
+    def __init__(self):
+        self.ttl = conf().get("reply_cache_ttl", 3600)
+        self.scope = conf().get("reply_cache_scope", "global")
+        self.context_messages = conf().get("reply_cache_context_messages", 2)
+        self.bypass_patterns = [re.compile(p) for p in conf().get("reply_cache_bypass_patterns", ["^#"])]
+        # ExpiredDict按最后访问时间淘汰，回复内容本身的有效期由created_at单独判断
+        self.cache = ExpiredDict(self.ttl, max_size=conf().get("reply_cache_max_size", 1000))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.saved_tokens = 0
+        self.saved_seconds = 0.0
+
+    def _sessions(self, bot):
+        sessions = getattr(bot, "sessions", None)
+        return sessions if isinstance(sessions, SessionManager) else None
+
+    def make_key(self, bot, bot_type, query, context: Context):
+        """
+        :return: 缓存key，不应使用缓存时返回None
+        """
+        if context.type != ContextType.TEXT or any(p.search(query) for p in self.bypass_patterns):
+            return None
+        session_id = context.get("session_id")
+        sessions = self._sessions(bot)
+        system_prompt = conf().get("character_desc", "")
+        history = []
+        if sessions is not None and session_id is not None:
+            session = sessions.build_session(session_id)
+            system_prompt = session.system_prompt
+            if self.context_messages:
+                messages = [m for m in session.messages if m.get("role") != "system"]
+                history = [(m.get("role"), normalize(m.get("content", ""))) for m in messages[-self.context_messages:]]
+        model = context.get("gpt_model") or conf().get("model")
+        parts = [bot_type, model, system_prompt, history, normalize(query)]
+        if self.scope == "session":
+            parts.append(session_id)
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key, bot, query, context: Context):
+        entry = self.cache.get(key)
+        if entry is not None and time.time() - entry["created_at"] > self.ttl:
+            self.cache.pop(key, None)
+            entry = None
+        if entry is None:
+            return None
+        with self.lock:
+            self.hits += 1
+            self.saved_tokens += entry["tokens"]
+            self.saved_seconds += entry["latency"]
+        # 命中时也要把问答写入会话，保证后续对话的上下文和调用模型时一致
+        sessions = self._sessions(bot)
+        if sessions is not None and context.get("session_id") is not None:
+            sessions.session_query(query, context["session_id"])
+            sessions.session_reply(entry["content"], context["session_id"])
+        logger.info("[reply_cache] hit, query={}".format(query))
+        return Reply(ReplyType.TEXT, entry["content"])
+
+    def put(self, key, bot, content, context: Context, latency):
+        tokens = 0
+        sessions = self._sessions(bot)
+        if sessions is not None and context.get("session_id") is not None:
+            try:
+                tokens = sessions.build_session(context["session_id"]).calc_tokens()
+            except Exception:
+                tokens = 0
+        self.cache[key] = {"content": content, "created_at": time.time(), "latency": latency, "tokens": tokens or len(content)}
+
+    def _stream(self, key, bot, chunks, context: Context, start):
+        contents = []
+        for chunk in chunks:
+            contents.append(chunk)
+            yield chunk
+        content = "".join(contents)
+        if self._committed(bot, content, context):
+            self.put(key, bot, content, context, time.time() - start)
+
+    def _committed(self, bot, content, context: Context) -> bool:
+        """
+        bot只在正常回复时才把回复写入会话，"请再问我一次吧"等出错提示同样是TEXT类型但不会写入，
+        以会话最后一条消息是否为这条回复区分两者，无法判断时不缓存
+        """
+        sessions = self._sessions(bot)
+        if not content or sessions is None or context.get("session_id") is None:
+            return False
+        messages = sessions.build_session(context["session_id"]).messages
+        return bool(messages) and messages[-1].get("role") == "assistant" and messages[-1].get("content") == content
+
+    def _lookup(self, bot, bot_type, query, context: Context):
+        key = self.make_key(bot, bot_type, query, context)
+        if key is None:
+            with self.lock:
+                self.bypassed += 1
+            return None, None
+        reply = self.get(key, bot, query, context)
+        if reply is None:
+            with self.lock:
+                self.misses += 1
+        return key, reply
+
+    def _save(self, key, bot, reply: Reply, context: Context, start):
+        if key is None or reply is None:
+            return reply
+        if reply.type == ReplyType.TEXT and self._committed(bot, reply.content, context):
+            self.put(key, bot, reply.content, context, time.time() - start)
+        elif reply.type == ReplyType.TEXT_STREAM:
+            reply.content = self._stream(key, bot, reply.content, context, start)
+        return reply
+
+    def fetch(self, bot, bot_type, query, context: Context) -> Reply:
+        key, reply = self._lookup(bot, bot_type, query, context)
+        if reply is not None:
+            return reply
+        start = time.time()
+        return self._save(key, bot, bot.reply(query, context), context, start)
+
+    async def async_fetch(self, bot, bot_type, query, context: Context) -> Reply:
+        key, reply = self._lookup(bot, bot_type, query, context)
+        if reply is not None:
+            return reply
+        start = time.time()
+        return self._save(key, bot, await bot.async_reply(query, context), context, start)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": self.hits / total if total else 0,
+                "saved_tokens": self.saved_tokens,
+                "saved_seconds": self.saved_seconds,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_reply_cache():
+    """
+    :return: 未开启reply_cache时返回None
+    """
+    global _cache
+    if not conf().get("reply_cache"):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ReplyCache()
+    return _cache
@@ -3,13 +3,19 @@ import re
 import threading
 import time
 from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import Future
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.handler_pool import get_handler_pool
+from channel.outbox import Outbox, register_outbox
 from common.dequeue import Dequeue
 from common import memory
+from common.event_loop import run_coroutine, run_sync
+from common.rate_limiter import get_rate_limiter
+from config import conf, get_appdata_dir
 from plugins import *
 
 try:
@@ -17,7 +23,8 @@ try:
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+
+STREAM_ORDER_TIMEOUT = 60  # 流式回复等待之前的回复发送完成的最长秒数
 
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
@@ -27,8 +34,17 @@ class ChatChannel(Channel):
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
     lock = threading.Lock()  # 用于控制对sessions的访问
+    ready_cond = threading.Condition(lock)  # 有待处理任务时唤醒消费线程
+    ready_sessions = deque()  # 有待处理任务的session_id队列，消费线程只访问这些session
+    ready_set = set()  # 用于ready_sessions去重
+    handler_pool_name = "default"  # 处理消息的线程池名称，相同名称的channel共享线程池，子类可覆盖以使用独立线程池
+    use_outbox = True  # 是否通过outbox异步发送回复，需要在处理线程内同步完成发送的channel设为False
+    send_rate_limit = 0  # 发送接口的配额，每分钟最多发送的消息数，0表示不限制，可通过outbox_rate_limit配置覆盖
+    receiver_rate_limit = 0  # 每个接收者每分钟最多发送的消息数，0表示不限制
+    outbox = None
 
     def __init__(self):
+        self.handler_pool = get_handler_pool(self.handler_pool_name)
         _thread = threading.Thread(target=self.consume)
         _thread.setDaemon(True)
         _thread.start()
@@ -48,7 +64,8 @@ class ChatChannel(Channel):
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
             config = conf()
             cmsg = context["msg"]
-            user_data = conf().get_user_data(cmsg.from_user_id)
+            # 只读取，不为每个发消息的用户创建空的user_data，避免web等channel的临时会话id无限累积
+            user_data = conf().user_datas.get(cmsg.from_user_id) or {}
             context["openai_api_key"] = user_data.get("openai_api_key")
             context["gpt_model"] = user_data.get("gpt_model")
             if context.get("isgroup", False):
@@ -158,6 +175,8 @@ class ChatChannel(Channel):
             context.content = content.strip()
             if "desire_rtype" not in context and conf().get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
+            if "stream" not in context and conf().get("stream_reply") and self.SUPPORT_STREAM and context.get("desire_rtype") != ReplyType.VOICE:
+                context["stream"] = True  # 请求bot流式回复
         elif context.type == ContextType.VOICE:
             if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
@@ -180,60 +199,114 @@ class ChatChannel(Channel):
             self._send_reply(context, reply)
 
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
-        e_context = PluginManager().emit_event(
+        e_context = self._emit_handle_context(context, reply)
+        if e_context.is_pass():
+            return e_context["reply"]
+        logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
+        if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
+            return self._before_build_reply(context, e_context) or super().build_reply_content(context.content, context)
+        if context.type == ContextType.VOICE:  # 语音消息
+            new_context, reply = self._voice_to_text(context, self._recognize_voice(context))
+            return self._generate_reply(new_context) if new_context else reply
+        return self._handle_other_context(context, e_context["reply"])
+
+    # 以下几个方法由_generate_reply和_async_generate_reply共用，两者只在调用bot和语音识别的方式上不同
+    def _emit_handle_context(self, context: Context, reply: Reply) -> EventContext:
+        return PluginManager().emit_event(
             EventContext(
                 Event.ON_HANDLE_CONTEXT,
                 {"channel": self, "context": context, "reply": reply},
             )
         )
-        reply = e_context["reply"]
-        if not e_context.is_pass():
-            logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
-            if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
-                context["channel"] = e_context["channel"]
-                reply = super().build_reply_content(context.content, context)
-            elif context.type == ContextType.VOICE:  # 语音消息
-                cmsg = context["msg"]
-                cmsg.prepare()
-                file_path = context.content
-                wav_path = os.path.splitext(file_path)[0] + ".wav"
-                try:
-                    any_to_wav(file_path, wav_path)
-                except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
-                    logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
-                    wav_path = file_path
-                # 语音识别
-                reply = super().build_voice_to_text(wav_path)
-                # 删除临时文件
-                try:
-                    os.remove(file_path)
-                    if wav_path != file_path:
-                        os.remove(wav_path)
-                except Exception as e:
-                    pass
-                    # logger.warning("[chat_channel]delete temp file error: " + str(e))
 
-                if reply.type == ReplyType.TEXT:
-                    new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
-                    if new_context:
-                        reply = self._generate_reply(new_context)
-                    else:
-                        return
-            elif context.type == ContextType.IMAGE:  # 图片消息，当前仅做下载保存到本地的逻辑
-                memory.USER_IMAGE_CACHE[context["session_id"]] = {
-                    "path": context.content,
-                    "msg": context.get("msg")
-                }
-            elif context.type == ContextType.SHARING:  # 分享信息，当前无默认逻辑
-                pass
-            elif context.type == ContextType.FUNCTION or context.type == ContextType.FILE:  # 文件消息及函数调用等，当前无默认逻辑
-                pass
-            else:
-                logger.warning("[chat_channel] unknown context type: {}".format(context.type))
-                return
+    def _before_build_reply(self, context: Context, e_context: EventContext) -> Reply:
+        """
+        文字和图片消息调用bot前的处理
+        :return: 不需要调用bot时的回复，为None时继续调用bot
+        """
+        context["channel"] = e_context["channel"]
+        if not self._check_rate_limit(context):
+            return Reply(ReplyType.ERROR, "请求太快了，请休息一下再问我吧")
+        return None
+
+    def _voice_to_text(self, context: Context, reply: Reply):
+        """
+        :param reply: 语音识别的结果
+        :return: (文字消息的context, 回复)，识别成功时返回新的context，由调用方按文字消息继续生成回复
+        """
+        if reply.type != ReplyType.TEXT:
+            return None, reply
+        return self._compose_context(ContextType.TEXT, reply.content, **context.kwargs), None
+
+    def _handle_other_context(self, context: Context, reply: Reply) -> Reply:
+        if context.type == ContextType.IMAGE:  # 图片消息，当前仅做下载保存到本地的逻辑
+            memory.USER_IMAGE_CACHE[context["session_id"]] = {
+                "path": context.content,
+                "msg": context.get("msg")
+            }
+        elif context.type == ContextType.SHARING:  # 分享信息，当前无默认逻辑
+            pass
+        elif context.type == ContextType.FUNCTION or context.type == ContextType.FILE:  # 文件消息及函数调用等，当前无默认逻辑
+            pass
+        else:
+            logger.warning("[chat_channel] unknown context type: {}".format(context.type))
+            return
+        return reply
+
+    def _check_rate_limit(self, context: Context) -> bool:
+        """
+        按会话和用户限制调用bot的频率，超出时直接拒绝，避免个别群或用户占满模型接口的额度
+        #开头的指令和清除记忆指令不受限制；依次扣除额度，后面的限流器拒绝时退还前面已扣除的，被拒绝的请求不占用额度
+        """
+        query = context.content if isinstance(context.content, str) else ""
+        if query.startswith("#") or query in conf().get("clear_memory_commands", ["#清除记忆"]):
+            return True
+        limits = []
+        session_limiter = get_rate_limiter("session", conf().get("rate_limit_session"))
+        if session_limiter:
+            limits.append(("session", session_limiter, context["session_id"]))
+        user_limiter = get_rate_limiter("user", conf().get("rate_limit_user"))
+        if user_limiter:
+            cmsg = context.get("msg")
+            user_id = (cmsg.actual_user_id if context.get("isgroup") else cmsg.from_user_id) if cmsg else None
+            limits.append(("user", user_limiter, user_id or context["session_id"]))
+        acquired = []
+        for scope, limiter, key in limits:
+            if not limiter.try_acquire(key):
+                logger.warning("[chat_channel] {} {} exceeds rate limit".format(scope, key))
+                for acquired_limiter, acquired_key in acquired:
+                    acquired_limiter.refund(acquired_key)
+                return False
+            acquired.append((limiter, key))
+        return True
+
+    # 语音消息转文字
+    def _recognize_voice(self, context: Context) -> Reply:
+        cmsg = context["msg"]
+        cmsg.prepare()
+        file_path = context.content
+        wav_path = os.path.splitext(file_path)[0] + ".wav"
+        try:
+            any_to_wav(file_path, wav_path)
+        except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
+            logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
+            wav_path = file_path
+        # 语音识别
+        reply = super().build_voice_to_text(wav_path)
+        # 删除临时文件
+        try:
+            os.remove(file_path)
+            if wav_path != file_path:
+                os.remove(wav_path)
+        except Exception as e:
+            pass
+            # logger.warning("[chat_channel]delete temp file error: " + str(e))
         return reply
 
     def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
+        if reply and reply.type == ReplyType.TEXT_STREAM and (not self.SUPPORT_STREAM or context.get("desire_rtype") == ReplyType.VOICE):
+            # 不能逐段发送时，等待生成完毕后作为普通文本处理
+            reply = Reply(ReplyType.TEXT, "".join(reply.content))
         if reply and reply.type:
             e_context = PluginManager().emit_event(
                 EventContext(
@@ -261,6 +334,16 @@ class ChatChannel(Channel):
                     else:
                         reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
                     reply.content = reply_text
+                elif reply.type == ReplyType.TEXT_STREAM:
+                    if context.get("isgroup", False):
+                        prefix = conf().get("group_chat_reply_prefix", "")
+                        if not context.get("no_need_at", False):
+                            prefix += "@" + context["msg"].actual_user_nickname + "\n"
+                        suffix = conf().get("group_chat_reply_suffix", "")
+                    else:
+                        prefix = conf().get("single_chat_reply_prefix", "")
+                        suffix = conf().get("single_chat_reply_suffix", "")
+                    reply.content = _wrap_stream(reply.content, prefix, suffix)
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
                 elif reply.type == ReplyType.IMAGE_URL or reply.type == ReplyType.VOICE or reply.type == ReplyType.IMAGE or reply.type == ReplyType.FILE or reply.type == ReplyType.VIDEO or reply.type == ReplyType.VIDEO_URL:
@@ -283,8 +366,47 @@ class ChatChannel(Channel):
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
                 logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
+                outbox = self.get_outbox()
+                # 流式回复边生成边发送，在处理线程中直接发送，不占用outbox的发送线程
+                if outbox and reply.type != ReplyType.TEXT_STREAM:
+                    outbox.put(reply, context)
+                    return
+                # 先等待同一接收者排队中的回复发送完成，保证回复按顺序到达
+                if outbox and not outbox.wait_idle(context.get("receiver"), STREAM_ORDER_TIMEOUT):
+                    logger.warning("[chat_channel] outbox of {} is still busy, send stream reply anyway".format(context.get("receiver")))
                 self._send(reply, context)
 
+    def _split_reply(self, reply: Reply) -> list:
+        """
+        把一条回复拆成多条消息，由outbox逐条按顺序、按配额发送，子类按各自接口的长度限制覆盖
+        """
+        return [reply]
+
+    def get_outbox(self) -> Outbox:
+        """
+        第一次发送回复时创建，此时channel已经可以正常发送，开启spool时会先重发上次未发送完成的回复
+        :return: 未开启outbox时返回None
+        """
+        if not self.use_outbox or not conf().get("outbox", True):
+            return None
+        if self.outbox is None:
+            with self.lock:
+                if self.outbox is None:
+                    name = self.channel_type or conf().get("channel_type") or type(self).__name__
+                    spool_path = os.path.join(get_appdata_dir(), "outbox_{}.db".format(name)) if conf().get("outbox_spool") else None
+                    self.outbox = Outbox(
+                        name,
+                        self.send,
+                        split=self._split_reply,
+                        rate=conf().get("outbox_rate_limit") or self.send_rate_limit,
+                        receiver_rate=self.receiver_rate_limit,
+                        max_retries=conf().get("outbox_max_retries", 2),
+                        workers=conf().get("outbox_workers", 4),
+                        spool_path=spool_path,
+                    )
+                    register_outbox(self.outbox)
+        return self.outbox
+
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
             self.send(reply, context)
@@ -293,10 +415,46 @@ class ChatChannel(Channel):
             if isinstance(e, NotImplementedError):
                 return
             logger.exception(e)
+            if reply.type == ReplyType.TEXT_STREAM:  # 流式回复可能已发出一部分，且生成器无法重放
+                return
             if retry_cnt < 2:
                 time.sleep(3 + 3 * retry_cnt)
                 self._send(reply, context, retry_cnt + 1)
 
+    # 以下为异步流水线(async_pipeline)使用的方法，在全局事件循环中执行，等待模型回复时不占用线程
+    async def _async_handle(self, context: Context):
+        if context is None or not context.content:
+            return
+        logger.debug("[chat_channel] ready to handle context: {}".format(context))
+        reply = await self._async_generate_reply(context)
+
+        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+
+        if reply and reply.content:
+            reply = await self._async_decorate_reply(context, reply)
+
+            await self._async_send_reply(context, reply)
+
+    async def _async_generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
+        # 插件、限流和语音识别可能阻塞，放到线程池中执行，只有bot调用在事件循环中等待
+        e_context = await run_sync(self._emit_handle_context, context, reply)
+        if e_context.is_pass():
+            return e_context["reply"]
+        logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
+        if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
+            return await run_sync(self._before_build_reply, context, e_context) or await super().async_build_reply_content(context.content, context)
+        if context.type == ContextType.VOICE:  # 语音消息
+            new_context, reply = self._voice_to_text(context, await run_sync(self._recognize_voice, context))
+            return await self._async_generate_reply(new_context) if new_context else reply
+        return self._handle_other_context(context, e_context["reply"])
+
+    async def _async_decorate_reply(self, context: Context, reply: Reply) -> Reply:
+        # 包装步骤只有插件和语音合成可能耗时，整体放到线程池中执行
+        return await run_sync(self._decorate_reply, context, reply)
+
+    async def _async_send_reply(self, context: Context, reply: Reply):
+        await run_sync(self._send_reply, context, reply)
+
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
         logger.debug("Worker return success, session_id = {}".format(session_id))
 
@@ -317,9 +475,17 @@ class ChatChannel(Channel):
                 logger.exception("Worker raise exception: {}".format(e))
             with self.lock:
                 self.sessions[session_id][1].release()
+                self._mark_ready(session_id)  # 信号量释放后，唤醒消费线程处理后续消息或清理session
 
         return func
 
+    # 将session_id加入待处理队列并唤醒消费线程，调用方需持有self.lock
+    def _mark_ready(self, session_id):
+        if session_id not in self.ready_set:
+            self.ready_set.add(session_id)
+            self.ready_sessions.append(session_id)
+            self.ready_cond.notify()
+
     def produce(self, context: Context):
         session_id = context["session_id"]
         with self.lock:
@@ -332,39 +498,49 @@ class ChatChannel(Channel):
                 self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
             else:
                 self.sessions[session_id][0].put(context)
+            self._mark_ready(session_id)
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 消费者函数，单独线程，阻塞等待有任务的session，取出消息并提交到线程池处理
     def consume(self):
         while True:
+            with self.ready_cond:
+                while not self.ready_sessions:
+                    self.ready_cond.wait()
+                session_id = self.ready_sessions.popleft()
+                self.ready_set.discard(session_id)
+                if session_id not in self.sessions:
+                    continue
+                context_queue, semaphore = self.sessions[session_id]
+                if not semaphore.acquire(blocking=False):  # 并发已满，等回调释放信号量时会再次唤醒
+                    continue
+                if context_queue.empty():
+                    semaphore.release()
+                    if semaphore._initial_value == semaphore._value:  # 没有任务持有信号量，说明所有任务都处理完毕
+                        self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+                        assert len(self.futures[session_id]) == 0, "thread pool error"
+                        del self.futures[session_id]
+                        del self.sessions[session_id]
+                    continue
+                context = context_queue.get()
+            logger.debug("[chat_channel] consume context: {}".format(context))
+            # 在锁外提交，future已完成时add_done_callback会在当前线程直接执行回调
+            if conf().get("async_pipeline", False):
+                future: Future = run_coroutine(self._async_handle(context))
+            else:
+                future: Future = self.handler_pool.submit(self._handle, context, context_type=context.type)
             with self.lock:
-                session_ids = list(self.sessions.keys())
-            for session_id in session_ids:
-                with self.lock:
-                    context_queue, semaphore = self.sessions[session_id]
-                if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                    if not context_queue.empty():
-                        context = context_queue.get()
-                        logger.debug("[chat_channel] consume context: {}".format(context))
-                        future: Future = handler_pool.submit(self._handle, context)
-                        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                        with self.lock:
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                    elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                        with self.lock:
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                    else:
-                        semaphore.release()
-            time.sleep(0.2)
+                if session_id not in self.futures:
+                    self.futures[session_id] = []
+                self.futures[session_id].append(future)
+                if not self.sessions[session_id][0].empty():  # 同一session还有排队的消息，继续尝试调度
+                    self._mark_ready(session_id)
+            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in self.futures.get(session_id, []):
                     future.cancel()
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
@@ -374,7 +550,7 @@ class ChatChannel(Channel):
     def cancel_all_session(self):
         with self.lock:
             for session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in self.futures.get(session_id, []):
                     future.cancel()
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
@@ -382,6 +558,14 @@ class ChatChannel(Channel):
                 self.sessions[session_id][0] = Dequeue()
 
 
+def _wrap_stream(chunks, prefix, suffix):
+    if prefix:
+        yield prefix
+    yield from chunks
+    if suffix:
+        yield suffix
+
+
 def check_prefix(content, prefix_list):
     if not prefix_list:
         return None
@@ -398,3 +582,36 @@ def check_contain(content, keyword_list):
         if content.find(ky) != -1:
             return True
     return None
+
+
+if __name__ == "__main__":
+    # 调度基准测试: python -m channel.chat_channel [会话数] [每个会话的消息数]
+    import sys
+
+    session_cnt = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    msg_per_session = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    total = session_cnt * msg_per_session
+    latencies = []
+    done = threading.Event()
+
+    class BenchChannel(ChatChannel):
+        def _handle(self, context: Context):
+            with self.lock:
+                latencies.append(time.perf_counter() - context["enqueue_time"])
+                if len(latencies) == total:
+                    done.set()
+
+    channel = BenchChannel()
+    start = time.perf_counter()
+    for i in range(msg_per_session):
+        for session_id in range(session_cnt):
+            channel.produce(Context(ContextType.TEXT, "hello", {"session_id": session_id, "enqueue_time": time.perf_counter()}))
+    done.wait()
+    cost = time.perf_counter() - start
+    latencies.sort()
+    print("sessions={}, messages={}, cost={:.3f}s, throughput={:.0f} msg/s".format(session_cnt, total, cost, total / cost))
+    print(
+        "enqueue-to-handle latency: p50={:.2f}ms, p99={:.2f}ms, max={:.2f}ms".format(
+            latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000
+        )
+    )
@@ -107,6 +107,8 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
         conf()["group_name_white_list"] = ["ALL_GROUP"]
         # 单聊无需前缀
         conf()["single_chat_prefix"] = [""]
+        # 开启AI卡片时可以逐段更新卡片内容
+        self.SUPPORT_STREAM = bool(conf().get("dingtalk_card_enabled"))
 
     def startup(self):
         credential = dingtalk_stream.Credential(self.dingtalk_client_id, self.dingtalk_client_secret)
@@ -187,7 +189,14 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
                 button_list, markdown_content = self.generate_button_markdown_content(context, reply)
                 self.reply_ai_markdown_button(incoming_message, markdown_content, button_list, "", "📌 内容由AI生成", "",[incoming_message.sender_staff_id])
 
-            if reply.type in [ReplyType.IMAGE_URL, ReplyType.IMAGE, ReplyType.TEXT]:
+            def reply_with_ai_stream():
+                self.reply_ai_markdown_stream(incoming_message, reply.content, "📌 内容由AI生成", [incoming_message.sender_staff_id])
+
+            if reply.type == ReplyType.TEXT_STREAM:
+                reply_with_ai_stream()
+                if isgroup:
+                    reply_with_at_text()
+            elif reply.type in [ReplyType.IMAGE_URL, ReplyType.IMAGE, ReplyType.TEXT]:
                 if isgroup:
                     reply_with_ai_markdown()
                     reply_with_at_text()
@@ -196,9 +205,30 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
             else:
                 # 暂不支持其它类型消息回复
                 reply_with_text()
+        elif reply.type == ReplyType.TEXT_STREAM:
+            self.reply_text("".join(reply.content), incoming_message)
         else:
             self.reply_text(reply.content, incoming_message)
 
+    def reply_ai_markdown_stream(self, incoming_message, chunks, title="", recipients=None, interval=0.3):
+        """
+        创建AI卡片并随生成内容逐段更新，每次更新都是一次接口调用，间隔interval秒合并更新
+        """
+        card = self.ai_markdown_card_start(incoming_message, title, "", recipients)
+        markdown = ""
+        last_update = 0
+        try:
+            for chunk in chunks:
+                markdown += chunk
+                if time.time() - last_update >= interval:
+                    card.ai_streaming(markdown=markdown, append=False)
+                    last_update = time.time()
+            card.ai_finish(markdown=markdown)
+        except Exception:
+            card.ai_fail()
+            raise
+        return card
+
 
     def generate_button_markdown_content(self, context, reply):
         image_url = context.kwargs.get("image_url")
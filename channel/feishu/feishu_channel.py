@@ -8,7 +8,7 @@
 # -*- coding=utf-8 -*-
 import uuid
 
-import requests
+from common import http_client
 import web
 from channel.feishu.feishu_message import FeishuMessage
 from bridge.context import Context
@@ -17,8 +17,10 @@ from common.log import logger
 from common.singleton import singleton
 from config import conf
 from common.expired_dict import ExpiredDict
+from common.token_manager import get_token_manager
 from bridge.context import ContextType
 from channel.chat_channel import ChatChannel, check_prefix
+from channel.http_server import run_server
 from common import utils
 import json
 import os
@@ -48,7 +50,7 @@ class FeiShuChanel(ChatChannel):
         )
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("feishu_port", 9891)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        run_server(app.wsgifunc(), port, "feishu")
 
     def send(self, reply: Reply, context: Context):
         msg = context.get("msg")
@@ -80,7 +82,7 @@ class FeiShuChanel(ChatChannel):
                 "msg_type": msg_type,
                 "content": json.dumps({content_key: reply_content})
             }
-            res = requests.post(url=url, headers=headers, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, json=data, timeout=(5, 10))
         else:
             url = "https://open.feishu.cn/open-apis/im/v1/messages"
             params = {"receive_id_type": context.get("receive_id_type") or "open_id"}
@@ -89,7 +91,7 @@ class FeiShuChanel(ChatChannel):
                 "msg_type": msg_type,
                 "content": json.dumps({content_key: reply_content})
             }
-            res = requests.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
         res = res.json()
         if res.get("code") == 0:
             logger.info(f"[FeiShu] send message success")
@@ -98,6 +100,11 @@ class FeiShuChanel(ChatChannel):
 
 
     def fetch_access_token(self) -> str:
+        # tenant_access_token有效期2小时，过期前复用缓存，临近过期时后台刷新
+        manager = get_token_manager(("feishu", self.feishu_app_id), self._request_access_token)
+        return manager.get() or ""
+
+    def _request_access_token(self):
         url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
         headers = {
             "Content-Type": "application/json"
@@ -107,21 +114,22 @@ class FeiShuChanel(ChatChannel):
             "app_secret": self.feishu_app_secret
         }
         data = bytes(json.dumps(req_body), encoding='utf8')
-        response = requests.post(url=url, data=data, headers=headers)
+        response = http_client.post(url=url, data=data, headers=headers)
         if response.status_code == 200:
             res = response.json()
             if res.get("code") != 0:
                 logger.error(f"[FeiShu] get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
-                return ""
+                return None, 0
             else:
-                return res.get("tenant_access_token")
+                return res.get("tenant_access_token"), res.get("expire")
         else:
             logger.error(f"[FeiShu] fetch token error, res={response}")
+            return None, 0
 
 
     def _upload_image_url(self, img_url, access_token):
         logger.debug(f"[WX] start download image, img_url={img_url}")
-        response = requests.get(img_url)
+        response = http_client.get(img_url)
         suffix = utils.get_path_suffix(img_url)
         temp_name = str(uuid.uuid4()) + "." + suffix
         if response.status_code == 200:
@@ -138,7 +146,7 @@ class FeiShuChanel(ChatChannel):
             'Authorization': f'Bearer {access_token}',
         }
         with open(temp_name, "rb") as file:
-            upload_response = requests.post(upload_url, files={"image": file}, data=data, headers=headers)
+            upload_response = http_client.post(upload_url, files={"image": file}, data=data, headers=headers)
             logger.info(f"[FeiShu] upload file, res={upload_response.content}")
             os.remove(temp_name)
             return upload_response.json().get("data").get("image_key")
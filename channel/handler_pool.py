@@ -0,0 +1,135 @@
+"""
+消息处理线程池，按ContextType划分独立的lane，避免慢任务(如图片生成)占满线程导致文本消息排队
+"""
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from common.log import logger
+from config import conf
+
+DEFAULT_LANE = "default"
+
+
+class _Lane(object):
+    def __init__(self, pool_name, lane_name, max_workers):
+        self.name = lane_name
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="{}-{}".format(pool_name, lane_name))
+        self.lock = threading.Lock()
+        self.queued = 0  # 已提交但还未开始执行的任务数
+        self.active = 0  # 正在执行的任务数
+        self.completed = 0
+        self.wait_total = 0.0  # 累计排队时间，单位秒
+        self.wait_max = 0.0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        submit_time = time.monotonic()
+
+        def run():
+            wait = time.monotonic() - submit_time
+            with self.lock:
+                self.queued -= 1
+                self.active += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        with self.lock:
+            self.queued += 1
+        try:
+            future = self.executor.submit(run)
+        except Exception:
+            with self.lock:
+                self.queued -= 1
+            raise
+        # 排队中被取消的任务不会执行run，需要在这里修正计数
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future: Future):
+        if future.cancelled():
+            with self.lock:
+                self.queued -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            started = self.completed + self.active
+            return {
+                "workers": self.max_workers,
+                "queued": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "avg_wait_ms": round(self.wait_total / started * 1000, 2) if started else 0,
+                "max_wait_ms": round(self.wait_max * 1000, 2),
+            }
+
+
+class HandlerPool(object):
+    def __init__(self, name="default", max_workers=8, lanes=None):
+        """
+        :param name: 线程池名称，同名的channel共享同一个线程池
+        :param max_workers: 默认lane的线程数
+        :param lanes: 独立lane配置，key为ContextType名称，value为线程数，如 {"IMAGE_CREATE": 2}
+        """
+        self.name = name
+        self.lanes = {DEFAULT_LANE: _Lane(name, DEFAULT_LANE, max_workers)}
+        for lane_name, workers in (lanes or {}).items():
+            if workers and workers > 0:
+                self.lanes[lane_name.upper()] = _Lane(name, lane_name.upper(), int(workers))
+
+    def get_lane(self, context_type=None) -> _Lane:
+        if context_type is not None:
+            lane = self.lanes.get(str(context_type).upper())
+            if lane:
+                return lane
+        return self.lanes[DEFAULT_LANE]
+
+    def submit(self, fn, *args, context_type=None, **kwargs) -> Future:
+        return self.get_lane(context_type).submit(fn, *args, **kwargs)
+
+    def stats(self) -> dict:
+        return {lane_name: lane.stats() for lane_name, lane in self.lanes.items()}
+
+    def set_initializer(self, initializer, initargs=()):
+        # 只对之后新建的线程生效
+        for lane in self.lanes.values():
+            lane.executor._initializer = initializer
+            lane.executor._initargs = initargs
+
+    def resume(self):
+        # 允许被关闭的线程池重新接收任务
+        for lane in self.lanes.values():
+            lane.executor._shutdown = False
+
+    def shutdown(self, wait=True):
+        for lane in self.lanes.values():
+            lane.executor.shutdown(wait=wait)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_handler_pool(name="default") -> HandlerPool:
+    """
+    获取指定名称的线程池，不存在时按配置创建，不同channel使用相同名称即共享线程池
+    """
+    with _pools_lock:
+        if name not in _pools:
+            max_workers = conf().get("handler_pool_size", 8)
+            lanes = conf().get("handler_pool_lanes", {"VOICE": 2, "IMAGE_CREATE": 2})
+            _pools[name] = HandlerPool(name, max_workers, lanes)
+            logger.info("[handler_pool] create pool {}, lanes={}".format(name, {k: v.max_workers for k, v in _pools[name].lanes.items()}))
+        return _pools[name]
+
+
+def all_handler_pools() -> dict:
+    with _pools_lock:
+        return dict(_pools)
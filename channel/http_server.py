@@ -0,0 +1,242 @@
+"""
+web.py类channel(web、公众号、企微自建应用、飞书)共用的HTTP服务
+http_server配置可选:
+    simple:   web.py自带的runsimple开发服务器，固定10个线程，每个请求都打印到标准输出
+    threaded: cheroot线程池服务器，可配置线程数、连接队列、keep-alive超时，退出时等待处理中的请求完成
+    asgi:     uvicorn事件循环负责连接和keep-alive，web.py处理函数在线程池中执行，需要安装uvicorn和a2wsgi
+"""
+
+import threading
+import time
+
+import web
+
+from common.log import logger
+from config import conf
+
+
+class _TimedResponse(object):
+    # 包装响应体，在服务器关闭响应时记录耗时，流式响应(如SSE)的耗时计算到结束为止
+    def __init__(self, result, on_close):
+        self.result = result
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, "close"):
+                self.result.close()
+        finally:
+            self.on_close()
+
+
+class TimingMiddleware(object):
+    """
+    记录每个请求的耗时，超过http_slow_request_seconds的请求打印警告
+    """
+
+    def __init__(self, app, name):
+        self.app = app
+        self.name = name
+        self.lock = threading.Lock()
+        self.active = 0
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        response_info = {}
+
+        def _start_response(status, headers, exc_info=None):
+            response_info["status"] = status
+            response_info["stream"] = any(k.lower() == "content-type" and "event-stream" in v for k, v in headers)
+            return start_response(status, headers, exc_info)
+
+        with self.lock:
+            self.active += 1
+        try:
+            result = self.app(environ, _start_response)
+        except Exception:
+            response_info["status"] = "500"
+            self._record(environ, response_info, start)
+            raise
+        return _TimedResponse(result, lambda: self._record(environ, response_info, start))
+
+    def _record(self, environ, response_info, start):
+        cost = time.perf_counter() - start
+        with self.lock:
+            self.active -= 1
+            self.count += 1
+            self.total_time += cost
+            self.max_time = max(self.max_time, cost)
+        status = response_info.get("status", "-")
+        logger.debug("[http] {} {} {} {} {:.1f}ms".format(self.name, environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"), status, cost * 1000))
+        if cost > conf().get("http_slow_request_seconds", 5) and not response_info.get("stream"):
+            logger.warning("[http] {} slow request {} {} {}, cost={:.2f}s".format(self.name, environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"), status, cost))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "active": self.active,
+                "count": self.count,
+                "avg_ms": self.total_time / self.count * 1000 if self.count else 0,
+                "max_ms": self.max_time * 1000,
+            }
+
+
+_apps = {}
+
+
+def all_http_stats() -> dict:
+    return {name: app.stats() for name, app in _apps.items()}
+
+
+def run_server(wsgi_func, port, name, host="0.0.0.0"):
+    """
+    按http_server配置启动HTTP服务，阻塞直到服务退出
+    :param wsgi_func: web.application(...).wsgifunc()
+    :param name: 用于日志和统计的channel名称
+    """
+    server_type = conf().get("http_server", "threaded")
+    app = TimingMiddleware(wsgi_func, name)
+    _apps[name] = app
+    logger.info("[http] {} listening on {}:{}, server={}".format(name, host, port, server_type))
+    if server_type == "simple":
+        web.httpserver.runsimple(app, (host, port))
+    elif server_type == "asgi":
+        _run_asgi(web.httpserver.StaticMiddleware(app), host, port)
+    elif server_type == "threaded":
+        _run_threaded(web.httpserver.StaticMiddleware(app), host, port)
+    else:
+        raise RuntimeError("unknown http_server type: {}".format(server_type))
+
+
+def _run_threaded(app, host, port):
+    from cheroot import wsgi
+
+    server = wsgi.Server(
+        (host, port),
+        app,
+        numthreads=conf().get("http_server_threads", 32),
+        server_name="localhost",
+        request_queue_size=conf().get("http_server_backlog", 128),
+        timeout=conf().get("http_keepalive_timeout", 10),
+        shutdown_timeout=conf().get("http_shutdown_timeout", 5),
+    )
+    server.nodelay = True
+    try:
+        server.start()
+    except (KeyboardInterrupt, SystemExit):
+        # stop会等待处理中的请求完成，最多http_shutdown_timeout秒
+        server.stop()
+        raise
+
+
+def _run_asgi(app, host, port):
+    try:
+        import uvicorn
+        from a2wsgi import WSGIMiddleware
+    except ImportError:
+        logger.error("[http] asgi server requires uvicorn and a2wsgi, please run: pip install uvicorn a2wsgi")
+        raise
+    # channel的会话和队列保存在进程内存中，只能使用单进程，并发由处理线程数决定
+    uvicorn.run(
+        WSGIMiddleware(app, workers=conf().get("http_server_threads", 32)),
+        host=host,
+        port=port,
+        backlog=conf().get("http_server_backlog", 128),
+        timeout_keep_alive=conf().get("http_keepalive_timeout", 10),
+        timeout_graceful_shutdown=conf().get("http_shutdown_timeout", 5),
+        log_level="warning",
+        access_log=False,
+    )
+
+
+if __name__ == "__main__":
+    # 压测: python -m channel.http_server [并发数] [请求数] [处理耗时ms]
+    # 依次用simple、threaded、asgi启动同一个web.py应用，比较每秒请求数
+    import http.client
+    import io
+    import multiprocessing
+    import socket
+    import sys
+    from contextlib import redirect_stderr, redirect_stdout
+
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    total = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    handle_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    class PingHandler:
+        def GET(self):
+            time.sleep(handle_ms / 1000)  # 模拟处理函数的耗时，如解析消息和写入队列
+            return "pong"
+
+    def serve(server_type, port):
+        conf()["http_server"] = server_type
+        logger.setLevel("ERROR")
+        app = web.application(("/ping", "PingHandler"), {"PingHandler": PingHandler}, autoreload=False)
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):  # runsimple会打印每个请求
+            run_server(app.wsgifunc(), port, "bench", host="127.0.0.1")
+
+    def free_port():
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+    def bench(port):
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        counter = iter(range(total))
+
+        def worker():
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            while True:
+                with lock:
+                    if next(counter, None) is None:
+                        break
+                start = time.perf_counter()
+                try:
+                    conn.request("GET", "/ping")
+                    conn.getresponse().read()
+                except Exception:
+                    errors[0] += 1
+                    conn.close()
+                    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                    continue
+                cost = time.perf_counter() - start
+                with lock:
+                    latencies.append(cost)
+            conn.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        cost = time.perf_counter() - start
+        latencies.sort()
+        return len(latencies) / cost, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000, errors[0]
+
+    print("concurrency={}, requests={}, handle={}ms".format(concurrency, total, handle_ms))
+    for server_type in ["simple", "threaded", "asgi"]:
+        port = free_port()
+        proc = multiprocessing.Process(target=serve, args=(server_type, port), daemon=True)
+        proc.start()
+        for _ in range(100):  # 等待服务启动
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        try:
+            rps, p50, p99, errors = bench(port)
+            print("{:<9} rps={:>8.0f}  p50={:>7.1f}ms  p99={:>7.1f}ms  errors={}".format(server_type, rps, p50, p99, errors))
+        except Exception as e:
+            print("{:<9} failed: {}".format(server_type, e))
+        proc.terminate()
+        proc.join()
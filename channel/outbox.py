@@ -0,0 +1,218 @@
+"""
+出站消息调度(outbox)，channel生成回复后交给outbox发送，处理线程立即返回
+    每个接收者一个队列，同一接收者的回复逐条按顺序发送，不同接收者之间并发
+    发送速率由限流器控制(channel整体和每个接收者)，需要等待额度或失败重试时由全局事件循环定时唤醒，不占用线程
+    开启spool后，未发送完成的回复保存在sqlite中，重启后继续发送
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common.event_loop import get_event_loop
+from common.log import logger
+from common.rate_limiter import get_rate_limiter
+
+# 内容为字符串、可以写入spool的回复类型，IMAGE等内容为文件对象，TEXT_STREAM为生成器，只能在内存中发送
+SPOOL_REPLY_TYPES = [ReplyType.TEXT, ReplyType.INFO, ReplyType.ERROR, ReplyType.IMAGE_URL, ReplyType.VIDEO_URL, ReplyType.VOICE, ReplyType.FILE]
+
+
+class _Item(object):
+    def __init__(self, reply: Reply, context: Context, spool_id=None):
+        self.reply = reply
+        self.context = context
+        self.spool_id = spool_id
+        self.attempts = 0
+        self.receiver_reserved = False  # 本次发送的接收者额度是否已经预定
+        self.reserved = False  # 本次发送的channel额度是否已经预定
+
+
+class Spool(object):
+    """
+    未发送完成的回复，只保存可以序列化的回复类型和context中的简单字段
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, reply_type TEXT NOT NULL, "
+            "content TEXT NOT NULL, context TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+
+    def add(self, reply: Reply, context: Context):
+        """
+        :return: 记录id，回复不能保存时返回None
+        """
+        if reply.type not in SPOOL_REPLY_TYPES or not isinstance(reply.content, str):
+            return None
+        kwargs = {k: v for k, v in context.kwargs.items() if v is None or isinstance(v, (str, int, float, bool))}
+        data = json.dumps({"type": context.type.name, "content": context.content if isinstance(context.content, str) else "", "kwargs": kwargs}, ensure_ascii=False)
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO outbox (reply_type, content, context, created_at) VALUES (?, ?, ?, ?)",
+                (reply.type.name, reply.content, data, time.time()),
+            )
+            return cursor.lastrowid
+
+    def remove(self, spool_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM outbox WHERE id = ?", (spool_id,))
+
+    def load(self):
+        """
+        :return: [(spool_id, reply, context)]，按写入顺序
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT id, reply_type, content, context FROM outbox ORDER BY id").fetchall()
+        items = []
+        for spool_id, reply_type, content, data in rows:
+            try:
+                data = json.loads(data)
+                items.append((spool_id, Reply(ReplyType[reply_type], content), Context(ContextType[data["type"]], data["content"], data["kwargs"])))
+            except Exception as e:
+                logger.warning("[outbox] drop broken spool record {}: {}".format(spool_id, e))
+                self.remove(spool_id)
+        return items
+
+
+class Outbox(object):
+    def __init__(self, name, send, split=None, rate=0, receiver_rate=0, max_retries=2, workers=4, spool_path=None):
+        """
+        :param send: 实际发送的函数send(reply, context)
+        :param split: 把一条回复拆成多条消息的函数，拆分后的消息作为独立的消息排队和限流
+        :param rate: channel整体每分钟最多发送的消息数，0表示不限制
+        :param receiver_rate: 每个接收者每分钟最多发送的消息数，0表示不限制
+        """
+        self.name = name
+        self.send = send
+        self.split = split
+        self.limiter = get_rate_limiter("outbox_" + name, rate)
+        self.receiver_limiter = get_rate_limiter("outbox_{}_receiver".format(name), receiver_rate)
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbox-" + name)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)  # 某个接收者的回复全部发送完成时通知
+        self.queues = {}  # receiver -> deque[_Item]
+        self.active = set()  # 正在发送或等待定时器唤醒的接收者，同一接收者同时只有一个线程在发送
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self.spool = None
+        if spool_path:
+            self.spool = Spool(spool_path)
+            items = self.spool.load()
+            if items:
+                logger.info("[outbox] {} resend {} spooled replies".format(name, len(items)))
+            for spool_id, reply, context in items:
+                self._put(_Item(reply, context, spool_id))
+
+    def put(self, reply: Reply, context: Context):
+        replies = self.split(reply) if self.split else [reply]
+        for reply in replies:
+            self._put(_Item(reply, context, self.spool.add(reply, context) if self.spool else None))
+
+    def _put(self, item: _Item):
+        receiver = item.context.get("receiver")
+        with self.lock:
+            self.queues.setdefault(receiver, deque()).append(item)
+            if receiver in self.active:
+                return
+            self.active.add(receiver)
+        self.executor.submit(self._drain, receiver)
+
+    def wait_idle(self, receiver, timeout=None) -> bool:
+        """
+        等待发给receiver的回复全部发送完成，不经过outbox直接发送的回复(如流式回复)据此保持与之前回复的顺序
+        :return: 超时返回False
+        """
+        with self.idle:
+            return self.idle.wait_for(lambda: receiver not in self.active, timeout)
+
+    def _later(self, delay, receiver):
+        loop = get_event_loop()
+        loop.call_soon_threadsafe(loop.call_later, delay, self.executor.submit, self._drain, receiver)
+
+    def _reserve(self, receiver, item: _Item):
+        """
+        先预定接收者额度，等到可以发给该接收者时再预定channel额度，避免channel的发送名额在等待接收者额度时被空占
+        :return: 需要等待的秒数，等待后再次调用
+        """
+        if not item.receiver_reserved:
+            item.receiver_reserved = True
+            wait = self.receiver_limiter.reserve(receiver) if self.receiver_limiter else 0
+            if wait > 0:
+                return wait
+        if not item.reserved:
+            item.reserved = True
+            return self.limiter.reserve() if self.limiter else 0
+        return 0
+
+    def _done(self, receiver, item: _Item):
+        with self.lock:
+            self.queues[receiver].popleft()
+        if item.spool_id is not None:
+            self.spool.remove(item.spool_id)
+
+    def _drain(self, receiver):
+        while True:
+            with self.lock:
+                queue = self.queues.get(receiver)
+                if not queue:
+                    self.queues.pop(receiver, None)
+                    self.active.discard(receiver)
+                    self.idle.notify_all()
+                    return
+                item = queue[0]
+            wait = self._reserve(receiver, item)
+            if wait > 0:
+                self._later(wait, receiver)
+                return
+            try:
+                self.send(item.reply, item.context)
+            except Exception as e:
+                logger.error("[outbox] {} send to {} error: {}".format(self.name, receiver, e))
+                # 流式回复可能已发出一部分，且生成器无法重放
+                if not isinstance(e, NotImplementedError) and item.reply.type != ReplyType.TEXT_STREAM and item.attempts < self.max_retries:
+                    logger.exception(e)
+                    item.attempts += 1
+                    item.receiver_reserved = item.reserved = False
+                    self.retried += 1
+                    self._later(3 * item.attempts, receiver)
+                    return
+                self.dropped += 1
+                self._done(receiver, item)
+                continue
+            self.sent += 1
+            self._done(receiver, item)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "receivers": len(self.queues),
+                "pending": sum(len(queue) for queue in self.queues.values()),
+                "sent": self.sent,
+                "retried": self.retried,
+                "dropped": self.dropped,
+            }
+
+
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+
+def all_outboxes() -> dict:
+    with _outboxes_lock:
+        return dict(_outboxes)
+
+
+def register_outbox(outbox: Outbox):
+    with _outboxes_lock:
+        _outboxes[outbox.name] = outbox
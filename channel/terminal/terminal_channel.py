@@ -28,6 +28,7 @@ class TerminalMessage(ChatMessage):
 
 class TerminalChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
+    SUPPORT_STREAM = True
 
     def send(self, reply: Reply, context: Context):
         print("\nBot:")
@@ -42,11 +43,11 @@ class TerminalChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             import io
 
-            import requests
+            from common import http_client
             from PIL import Image
 
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             for block in pic_res.iter_content(1024):
                 image_storage.write(block)
@@ -54,6 +55,10 @@ class TerminalChannel(ChatChannel):
             img = Image.open(image_storage)
             print(img_url)
             img.show()
+        elif reply.type == ReplyType.TEXT_STREAM:
+            for chunk in reply.content:
+                print(chunk, end="", flush=True)
+            print()
         else:
             print(reply.content)
         print("\nUser:", end="")
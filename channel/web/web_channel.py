@@ -8,6 +8,8 @@ from bridge.context import *
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel, check_prefix
 from channel.chat_message import ChatMessage
+from channel.http_server import run_server
+from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
 from config import conf
@@ -37,6 +39,10 @@ class WebMessage(ChatMessage):
 @singleton
 class WebChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
+    SUPPORT_STREAM = True
+    STREAM_TIMEOUT = 60  # SSE连接保持的秒数，到期后浏览器自动重连
+    HEARTBEAT_INTERVAL = 15  # SSE心跳间隔
+    POLL_MAX_WAIT = 30  # 长轮询最长等待秒数
     _instance = None
     
     # def __new__(cls):
@@ -47,12 +53,27 @@ class WebChannel(ChatChannel):
     def __init__(self):
         super().__init__()
         self.msg_id_counter = 0  # 添加消息ID计数器
-        self.session_queues = {}  # 存储session_id到队列的映射
-        self.request_to_session = {}  # 存储request_id到session_id的映射
+        expires_in_seconds = conf().get("web_session_expires_in_seconds", 3600)
+        max_sessions = conf().get("web_session_max_count", 10000)
+        # 存储session_id到队列的映射，超过空闲时间未访问或超出数量上限时淘汰
+        self.session_queues = ExpiredDict(expires_in_seconds, max_size=max_sessions)
+        # 存储request_id到session_id的映射，同一请求可能有多条回复，过期后清理
+        self.request_to_session = ExpiredDict(expires_in_seconds, max_size=max_sessions * 10)
+        self.session_lock = threading.Lock()
+        # SSE和长轮询在等待回复期间一直占用HTTP服务线程，限制同时保持的连接数，给发送消息等普通请求留出线程
+        self.hold_slots = threading.BoundedSemaphore(self._hold_limit())
         # web channel无需前缀
         conf()["single_chat_prefix"] = [""]
 
 
+    def _hold_limit(self):
+        limit = conf().get("web_max_hold_connections", 0)
+        if limit:
+            return limit
+        # simple服务器固定10个线程
+        threads = 10 if conf().get("http_server", "threaded") == "simple" else conf().get("http_server_threads", 32)
+        return max(1, threads * 3 // 4)
+
     def _generate_msg_id(self):
         """生成唯一的消息ID"""
         self.msg_id_counter += 1
@@ -85,7 +106,28 @@ class WebChannel(ChatChannel):
                 return
             
             # 检查是否有会话队列
-            if session_id in self.session_queues:
+            queue = self._get_queue(session_id, create=False)
+            if queue and reply.type == ReplyType.TEXT_STREAM:
+                # 流式回复逐段放入队列，最后放入done标记
+                for chunk in reply.content:
+                    self._enqueue(queue, {
+                        "type": str(reply.type),
+                        "content": chunk,
+                        "timestamp": time.time(),
+                        "request_id": request_id,
+                        "stream": True,
+                        "done": False,
+                    })
+                self._enqueue(queue, {
+                    "type": str(reply.type),
+                    "content": "",
+                    "timestamp": time.time(),
+                    "request_id": request_id,
+                    "stream": True,
+                    "done": True,
+                })
+                logger.debug(f"Stream response sent to queue for session {session_id}, request {request_id}")
+            elif queue:
                 # 创建响应数据，包含请求ID以区分不同请求的响应
                 response_data = {
                     "type": str(reply.type),
@@ -93,7 +135,7 @@ class WebChannel(ChatChannel):
                     "timestamp": time.time(),
                     "request_id": request_id
                 }
-                self.session_queues[session_id].put(response_data)
+                self._enqueue(queue, response_data)
                 logger.debug(f"Response sent to queue for session {session_id}, request {request_id}")
             else:
                 logger.warning(f"No response queue found for session {session_id}, response dropped")
@@ -111,32 +153,7 @@ class WebChannel(ChatChannel):
             json_data = json.loads(data)
             session_id = json_data.get('session_id', f'session_{int(time.time())}')
             prompt = json_data.get('message', '')
-            
-            # 生成请求ID
-            request_id = self._generate_request_id()
-            
-            # 将请求ID与会话ID关联
-            self.request_to_session[request_id] = session_id
-            
-            # 确保会话队列存在
-            if session_id not in self.session_queues:
-                self.session_queues[session_id] = Queue()
-            
-            # 创建消息对象
-            msg = WebMessage(self._generate_msg_id(), prompt)
-            msg.from_user_id = session_id  # 使用会话ID作为用户ID
-            
-            # 创建上下文
-            context = self._compose_context(ContextType.TEXT, prompt, msg=msg)
-
-            # 添加必要的字段
-            context["session_id"] = session_id
-            context["request_id"] = request_id
-            context["isgroup"] = False  # 添加 isgroup 字段
-            context["receiver"] = session_id  # 添加 receiver 字段
-            
-            # 异步处理消息 - 只传递上下文
-            threading.Thread(target=self.produce, args=(context,)).start()
+            request_id = self.handle_message(session_id, prompt)
             
             # 返回请求ID
             return json.dumps({"status": "success", "request_id": request_id})
@@ -145,9 +162,71 @@ class WebChannel(ChatChannel):
             logger.error(f"Error processing message: {e}")
             return json.dumps({"status": "error", "message": str(e)})
 
+    def handle_message(self, session_id, prompt):
+        """
+        构造上下文并放入消息队列，返回请求ID
+        produce只是加锁入队，直接在请求线程中执行，不再为每个请求创建线程
+        """
+        # 生成请求ID
+        request_id = self._generate_request_id()
+        
+        # 将请求ID与会话ID关联
+        self.request_to_session[request_id] = session_id
+        
+        # 确保会话队列存在
+        self._get_queue(session_id)
+        
+        # 创建消息对象
+        msg = WebMessage(self._generate_msg_id(), prompt)
+        msg.from_user_id = session_id  # 使用会话ID作为用户ID
+        
+        # 创建上下文
+        context = self._compose_context(ContextType.TEXT, prompt, msg=msg)
+        if context is None:
+            return request_id
+
+        # 添加必要的字段
+        context["session_id"] = session_id
+        context["request_id"] = request_id
+        context["isgroup"] = False  # 添加 isgroup 字段
+        context["receiver"] = session_id  # 添加 receiver 字段
+        
+        self.produce(context)
+        return request_id
+
+    def _get_queue(self, session_id, create=True):
+        """
+        获取会话的回复队列并刷新其空闲时间，不存在时按需创建
+        """
+        queue = self.session_queues.get(session_id)
+        if queue is None and create:
+            with self.session_lock:
+                queue = self.session_queues.get(session_id)
+                if queue is None:
+                    queue = Queue()
+                    self.session_queues[session_id] = queue
+        return queue
+
+    def _enqueue(self, queue, response):
+        """
+        放入回复，同一请求连续的流式片段合并为一项；队列超过上限时丢弃最旧的回复，避免无人接收的会话持续占用内存
+        """
+        with queue.mutex:
+            last = queue.queue[-1] if queue.queue else None
+            if response.get("stream") and last and last.get("stream") and not last["done"] and last["request_id"] == response["request_id"]:
+                last["content"] += response["content"]
+                last["done"] = response["done"]
+                return
+            max_size = conf().get("web_session_queue_size", 100)
+            while len(queue.queue) >= max_size:
+                dropped = queue.queue.popleft()
+                logger.warning(f"Response queue full, drop response of request {dropped['request_id']}")
+        queue.put(response)
+
     def poll_response(self):
         """
         Poll for responses using the session_id.
+        Long polling: with "wait" in the request body, block up to that many seconds until a response arrives.
         """
         try:
             # 不记录轮询请求的日志
@@ -157,31 +236,106 @@ class WebChannel(ChatChannel):
             json_data = json.loads(data)
             session_id = json_data.get('session_id')
             
-            if not session_id or session_id not in self.session_queues:
+            queue = self._get_queue(session_id, create=False) if session_id else None
+            if queue is None:
                 return json.dumps({"status": "error", "message": "Invalid session ID"})
             
-            # 尝试从队列获取响应，不等待
+            # 长轮询时在队列上阻塞等待，有回复立即返回；未指定wait时不等待
+            wait = min(float(json_data.get('wait') or 0), self.POLL_MAX_WAIT)
+            # 保持的连接数已满时不等待，并通知页面改为间隔轮询
+            busy = wait > 0 and not self.hold_slots.acquire(blocking=False)
+            holding = wait > 0 and not busy
             try:
-                # 使用peek而不是get，这样如果前端没有成功处理，下次还能获取到
-                response = self.session_queues[session_id].get(block=False)
+                response = queue.get(block=holding, timeout=wait if holding else None)
+                if response.get("stream"):
+                    response = self._merge_stream_chunks(queue, response)
                 
                 # 返回响应，包含请求ID以区分不同请求
-                return json.dumps({
-                    "status": "success", 
-                    "has_content": True,
-                    "content": response["content"],
-                    "request_id": response["request_id"],
-                    "timestamp": response["timestamp"]
-                })
+                return json.dumps(self._format_response(response))
                 
             except Empty:
                 # 没有新响应
-                return json.dumps({"status": "success", "has_content": False})
+                return json.dumps({"status": "success", "has_content": False, "busy": busy})
+            finally:
+                if holding:
+                    self.hold_slots.release()
                 
         except Exception as e:
             logger.error(f"Error polling response: {e}")
             return json.dumps({"status": "error", "message": str(e)})
 
+    def stream_response(self):
+        """
+        Push responses with Server-Sent Events.
+        The request blocks on the session queue and sends each response as soon as send() enqueues it.
+        """
+        session_id = web.input(session_id=None).session_id
+        if not session_id:
+            raise web.badrequest()
+        if not self.hold_slots.acquire(blocking=False):
+            # 返回503后浏览器不再重连，页面改用轮询
+            logger.warning("[WebChannel] too many event streams, reject session {}".format(session_id))
+            raise web.HTTPError("503 Service Unavailable", {"Content-Type": "text/plain", "Retry-After": "3"}, "busy")
+        queue = self._get_queue(session_id)
+        web.header("Content-Type", "text/event-stream; charset=utf-8")
+        web.header("Cache-Control", "no-cache")
+        web.header("X-Accel-Buffering", "no")  # 关闭nginx等反向代理的缓冲
+        return self._event_stream(queue)
+
+    def _event_stream(self, queue):
+        # 调用方已获取hold_slots，连接结束或浏览器断开时释放
+        try:
+            # 第一段数据会在发送响应头前生成，这里先告诉浏览器断线后的重连间隔
+            yield "retry: 3000\n\n"
+            # 连接保持一段时间后主动结束，由浏览器自动重连，避免长期占用服务线程
+            deadline = time.time() + self.STREAM_TIMEOUT
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                try:
+                    response = queue.get(timeout=min(remaining, self.HEARTBEAT_INTERVAL))
+                except Empty:
+                    yield ": ping\n\n"  # 心跳，防止代理断开空闲连接，也能及时发现浏览器已断开
+                    continue
+                if response.get("stream"):
+                    response = self._merge_stream_chunks(queue, response)
+                try:
+                    yield "data: " + json.dumps(self._format_response(response)) + "\n\n"
+                except GeneratorExit:
+                    # 浏览器已断开，回复放回队首，重连或轮询时再发送
+                    with queue.mutex:
+                        queue.queue.appendleft(response)
+                    raise
+        finally:
+            self.hold_slots.release()
+
+    def _format_response(self, response):
+        return {
+            "status": "success",
+            "has_content": True,
+            "content": response["content"],
+            "request_id": response["request_id"],
+            "timestamp": response["timestamp"],
+            "stream": response.get("stream", False),
+            "done": response.get("done", True)
+        }
+
+    def _merge_stream_chunks(self, queue, response):
+        """
+        合并队列中同一请求已到达的流式片段，一次返回给前端
+        """
+        response = dict(response)
+        with queue.mutex:
+            while not response["done"] and queue.queue:
+                chunk = queue.queue[0]
+                if not chunk.get("stream") or chunk["request_id"] != response["request_id"]:
+                    break
+                queue.queue.popleft()
+                response["content"] += chunk["content"]
+                response["done"] = chunk["done"]
+        return response
+
     def chat_page(self):
         """Serve the chat HTML page."""
         file_path = os.path.join(os.path.dirname(__file__), 'chat.html')  # 使用绝对路径
@@ -210,6 +364,7 @@ class WebChannel(ChatChannel):
             '/', 'RootHandler',  # 添加根路径处理器
             '/message', 'MessageHandler',
             '/poll', 'PollHandler',  # 添加轮询处理器
+            '/stream', 'StreamHandler',  # SSE推送回复
             '/chat', 'ChatHandler',
             '/assets/(.*)', 'AssetsHandler',  # 匹配 /assets/任何路径
         )
@@ -227,7 +382,7 @@ class WebChannel(ChatChannel):
         
         # 临时重定向标准输出，捕获web.py的启动消息
         with redirect_stdout(io.StringIO()):
-            web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+            run_server(app.wsgifunc(), port, "web")
 
 
 class RootHandler:
@@ -246,6 +401,11 @@ class PollHandler:
         return WebChannel().poll_response()
 
 
+class StreamHandler:
+    def GET(self):
+        return WebChannel().stream_response()
+
+
 class ChatHandler:
     def GET(self):
         # 正常返回聊天页面
@@ -292,3 +452,86 @@ class AssetsHandler:
         except Exception as e:
             logger.error(f"Error serving static file: {e}", exc_info=True)  # 添加更详细的错误信息
             raise web.notfound()
+
+
+if __name__ == "__main__":
+    # 长时间运行测试: python -m channel.web.web_channel [轮数] [每轮新会话数] [同时打开的页面数]
+    # 模拟大量访客各发一条消息，其中一半不再取回复，观察会话数、线程数和内存是否保持平稳
+    # 最后启动HTTP服务，打开超过服务线程数的SSE连接，检查多余的连接被拒绝、发送消息不受影响
+    import http.client
+    import socket
+    import tracemalloc
+
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    sessions_per_round = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    pages = int(sys.argv[3]) if len(sys.argv) > 3 else 40
+    conf()["web_session_expires_in_seconds"] = 2
+    conf()["http_server_threads"] = 16
+    logger.setLevel("WARN")
+    tracemalloc.start()
+
+    channel = WebChannel()
+
+    def fake_handle(context):
+        channel.send(Reply(ReplyType.TEXT, "reply to " + context.content), context)
+
+    channel._handle = fake_handle  # 跳过插件和bot，直接回复
+
+    start = time.time()
+    for i in range(rounds):
+        for j in range(sessions_per_round):
+            channel.handle_message("session_{}_{}".format(i, j), "hello")
+        # 一半会话取走回复，另一半的回复留在队列中等待过期
+        for j in range(0, sessions_per_round, 2):
+            queue = channel._get_queue("session_{}_{}".format(i, j), create=False)
+            if queue:
+                try:
+                    queue.get(timeout=5)
+                except Empty:
+                    pass
+        time.sleep(0.5)
+        current, peak = tracemalloc.get_traced_memory()
+        print("round={:>3} elapsed={:>5.1f}s sessions={:>6} requests={:>6} threads={:>3} memory={:>7.1f}KB".format(
+            i + 1, time.time() - start, len(channel.session_queues), len(channel.request_to_session),
+            threading.active_count(), current / 1024))
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    conf()["web_port"] = port
+    threading.Thread(target=channel.startup, daemon=True).start()
+    for _ in range(100):  # 等待服务启动
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    streams, status = [], {}
+    for i in range(pages):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        conn.request("GET", "/stream?session_id=page_{}".format(i))
+        response = conn.getresponse()
+        status[response.status] = status.get(response.status, 0) + 1
+        if response.status == 200:
+            streams.append(conn)  # 保持连接，不读取
+        else:
+            response.read()
+            conn.close()
+
+    latencies = []
+    for i in range(20):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        begin = time.perf_counter()
+        conn.request("POST", "/message", json.dumps({"session_id": "page_{}".format(i), "message": "hello"}))
+        conn.getresponse().read()
+        # 第一次取走回复，第二次队列为空，保持的连接数已满时应立即返回busy
+        for _ in range(2):
+            conn.request("POST", "/poll", json.dumps({"session_id": "page_{}".format(i), "wait": 25}))
+            busy = json.loads(conn.getresponse().read()).get("busy")
+        latencies.append(time.perf_counter() - begin)
+        conn.close()
+    print("pages={} threads={} hold_limit={} stream_status={} message+poll max={:.1f}ms busy_poll={}".format(
+        pages, conf().get("http_server_threads"), channel._hold_limit(), status, max(latencies) * 1000, busy), file=sys.__stdout__)  # startup重定向了stdout
+    for conn in streams:
+        conn.close()
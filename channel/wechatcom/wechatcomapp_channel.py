@@ -3,7 +3,7 @@ import io
 import os
 import time
 
-import requests
+from common import http_client
 import web
 from wechatpy.enterprise import create_reply, parse_message
 from wechatpy.enterprise.crypto import WeChatCrypto
@@ -13,6 +13,7 @@ from wechatpy.exceptions import InvalidSignatureException, WeChatClientException
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
+from channel.http_server import run_server
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcom.wechatcomapp_message import WechatComAppMessage
 from common.log import logger
@@ -27,6 +28,7 @@ MAX_UTF8_LEN = 2048
 @singleton
 class WechatComAppChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    receiver_rate_limit = 30  # 应用给同一成员发送消息不能超过30次/分钟
 
     def __init__(self):
         super().__init__()
@@ -47,7 +49,15 @@ class WechatComAppChannel(ChatChannel):
         urls = ("/wxcomapp/?", "channel.wechatcom.wechatcomapp_channel.Query")
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("wechatcomapp_port", 9898)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        run_server(app.wsgifunc(), port, "wechatcom_app")
+
+    def _split_reply(self, reply: Reply) -> list:
+        # 超长文本拆成多条消息，由outbox按顺序逐条发送
+        if reply.type not in [ReplyType.TEXT, ReplyType.ERROR, ReplyType.INFO] or len(reply.content.encode("utf8")) <= MAX_UTF8_LEN:
+            return [reply]
+        texts = split_string_by_utf8_length(reply.content, MAX_UTF8_LEN)
+        logger.info("[wechatcom] text too long, split into {} parts".format(len(texts)))
+        return [Reply(reply.type, text) for text in texts]
 
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
@@ -56,10 +66,8 @@ class WechatComAppChannel(ChatChannel):
             texts = split_string_by_utf8_length(reply_text, MAX_UTF8_LEN)
             if len(texts) > 1:
                 logger.info("[wechatcom] text too long, split into {} parts".format(len(texts)))
-            for i, text in enumerate(texts):
+            for text in texts:
                 self.client.message.send_text(self.agent_id, receiver, text)
-                if i != len(texts) - 1:
-                    time.sleep(0.5)  # 休眠0.5秒，防止发送过快乱序
             logger.info("[wechatcom] Do send text to {}: {}".format(receiver, reply_text))
         elif reply.type == ReplyType.VOICE:
             try:
@@ -89,7 +97,7 @@ class WechatComAppChannel(ChatChannel):
             logger.info("[wechatcom] sendVoice={}, receiver={}".format(reply.content, receiver))
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             for block in pic_res.iter_content(1024):
                 image_storage.write(block)
@@ -6,6 +6,10 @@ from wechatpy.utils import check_signature
 from config import conf
 
 MAX_UTF8_LEN = 2048
+REPLY_CACHE_TTL = 3600  # 用户超过该时间未来取的回复会被清理
+RUNNING_TTL = 600  # 处理超过该时间仍未结束的消息不再视为处理中
+REQUEST_CNT_TTL = 60  # 微信服务器对同一消息的重试都在15秒内
+TEMP_MEDIA_TTL = 2 * 24 * 3600  # 临时素材3天后失效，提前一天不再复用
 
 
 class WeChatAPIException(Exception):
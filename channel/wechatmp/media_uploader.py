@@ -0,0 +1,112 @@
+import hashlib
+import imghdr
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from channel.wechatmp.common import *
+from common import http_client
+from common.expired_dict import ExpiredDict
+from common.log import logger
+
+
+class MediaUploader(object):
+    """
+    公众号素材上传，在独立线程池中并发上传，不占用消息处理线程
+    临时素材有效期3天，相同内容的临时素材直接复用之前的media_id
+    永久素材在被动回复发出后会被删除，不能复用
+    """
+
+    def __init__(self, client, max_workers=4):
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="wechatmp-upload")
+        self.media_ids = ExpiredDict(TEMP_MEDIA_TTL)  # (media_type, sha256) -> media_id
+
+    @staticmethod
+    def fetch(url) -> bytes:
+        # 一次读取完整内容，上传时requests同样需要完整的multipart body
+        res = http_client.get(url)
+        res.raise_for_status()
+        return res.content
+
+    @staticmethod
+    def read(storage) -> bytes:
+        storage.seek(0)
+        return storage.read()
+
+    @staticmethod
+    def image_file(name, data):
+        """
+        :return: 上传图片使用的(filename, data, content_type)
+        """
+        image_type = imghdr.what(None, h=data) or "png"
+        return "{}.{}".format(name, image_type), data, "image/" + image_type
+
+    @staticmethod
+    def video_file(name, data):
+        return "{}.mp4".format(name), data, "video/mp4"
+
+    def upload_temp(self, media_type, file) -> str:
+        filename, data, content_type = file
+        key = (media_type, hashlib.sha256(data).hexdigest())
+        media_id = self.media_ids.get(key)
+        if media_id:
+            logger.debug("[wechatmp] reuse {} media_id {}".format(media_type, media_id))
+            return media_id
+        response = self.client.media.upload(media_type, file)
+        logger.debug("[wechatmp] upload {} response: {}".format(media_type, response))
+        self.media_ids[key] = response["media_id"]
+        return response["media_id"]
+
+    def upload_material(self, media_type, file) -> str:
+        response = self.client.material.add(media_type, file)
+        logger.debug("[wechatmp] upload {} response: {}".format(media_type, response))
+        return response["media_id"]
+
+    @staticmethod
+    def file_loader(path, content_type=None):
+        def load():
+            with open(path, "rb") as f:
+                data = f.read()
+            return (os.path.basename(path), data, content_type) if content_type else (os.path.basename(path), data)
+
+        return load
+
+    def _upload_one(self, upload, media_type, loader):
+        file = loader()
+        return upload(media_type, file), len(file[1])
+
+    def _submit_all(self, upload, media_type, loaders):
+        return [self.executor.submit(self._upload_one, upload, media_type, loader) for loader in loaders]
+
+    def upload_all(self, upload, media_type, loaders) -> list:
+        """
+        并发读取(或下载)并上传多个文件，等待全部完成
+        :param upload: upload_temp或upload_material
+        :param loaders: 返回(filename, data[, content_type])的函数列表
+        :return: 与loaders顺序一致的(media_id, 文件大小)列表，任一文件失败时抛出异常
+        """
+        return [future.result() for future in self._submit_all(upload, media_type, loaders)]
+
+    def upload_all_async(self, upload, media_type, loaders, callback):
+        """
+        upload_all的非阻塞版本，全部完成后在上传线程中调用callback(results, error)
+        """
+        futures = self._submit_all(upload, media_type, loaders)
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                results = [future.result() for future in futures]
+            except Exception as e:
+                callback(None, e)
+                return
+            callback(results, None)
+
+        for future in futures:
+            future.add_done_callback(on_done)
@@ -49,7 +49,7 @@ class Query:
 
                 # New request
                 if (
-                    channel.cache_dict.get(from_user) is None
+                    from_user not in channel.cache_dict
                     and from_user not in channel.running
                     or content.startswith("#")
                     and message_id not in channel.request_cnt  # insert the godcmd
@@ -62,7 +62,7 @@ class Query:
                     logger.debug("[wechatmp] context: {} {} {}".format(context, wechatmp_msg, supported))
 
                     if supported and context:
-                        channel.running.add(from_user)
+                        channel._hold(from_user)
                         channel.produce(context)
                     else:
                         trigger_prefix = conf().get("single_chat_prefix", [""])[0]
@@ -91,7 +91,6 @@ class Query:
                         return encrypt_func(replyPost.render())
 
                 # Wechat official server will request 3 times (5 seconds each), with the same message_id.
-                # Because the interval is 5 seconds, here assumed that do not have multithreading problems.
                 request_cnt = channel.request_cnt.get(message_id, 0) + 1
                 channel.request_cnt[message_id] = request_cnt
                 logger.info(
@@ -100,20 +99,15 @@ class Query:
                     )
                 )
 
-                task_running = True
-                waiting_until = request_time + 4
-                while time.time() < waiting_until:
-                    if from_user in channel.running:
-                        time.sleep(0.1)
-                    else:
-                        task_running = False
-                        break
+                # send有回复或消息处理结束时立即唤醒，不再轮询
+                ready = channel.wait_reply(from_user, max(request_time + 4 - time.time(), 0))
 
                 reply_text = ""
-                if task_running:
+                if not ready:
                     if request_cnt < 3:
                         # waiting for timeout (the POST request will be closed by Wechat official server)
-                        time.sleep(2)
+                        # 必须在微信服务器5秒超时之后才能返回，否则不会重试，回复留给下一次重试的请求
+                        time.sleep(max(request_time + 6 - time.time(), 0))
                         # and do nothing, waiting for the next request
                         return "success"
                     else:  # request_cnt == 3:
@@ -123,19 +117,14 @@ class Query:
                         return encrypt_func(replyPost.render())
 
                 # reply is ready
-                channel.request_cnt.pop(message_id)
-
-                # no return because of bandwords or other reasons
-                if from_user not in channel.cache_dict and from_user not in channel.running:
-                    return "success"
+                channel.request_cnt.pop(message_id, None)
 
                 # Only one request can access to the cached data
-                try:
-                    (reply_type, reply_content) = channel.cache_dict[from_user].pop(0)
-                    if not channel.cache_dict[from_user]:  # If popping the message makes the list empty, delete the user entry from cache
-                        del channel.cache_dict[from_user]
-                except IndexError:
+                reply = channel.pop_reply(from_user)
+                if reply is None:
+                    # no return because of bandwords or other reasons
                     return "success"
+                (reply_type, reply_content) = reply
 
                 if reply_type == "text":
                     if len(reply_content.encode("utf8")) <= MAX_UTF8_LEN:
@@ -148,7 +137,7 @@ class Query:
                             max_split=1,
                         )
                         reply_text = splits[0] + continue_text
-                        channel.cache_dict[from_user].append(("text", splits[1]))
+                        channel._cache_reply(from_user, "text", splits[1])
 
                     logger.info(
                         "[wechatmp] Request {} do send to {} {}: {}\n{}".format(
@@ -1,22 +1,21 @@
 # -*- coding: utf-8 -*-
 import asyncio
-import imghdr
-import io
 import os
 import threading
 import time
 
-import requests
 import web
 from wechatpy.crypto import WeChatCrypto
 from wechatpy.exceptions import WeChatClientException
-from collections import defaultdict
 
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
+from channel.http_server import run_server
 from channel.wechatmp.common import *
+from channel.wechatmp.media_uploader import MediaUploader
 from channel.wechatmp.wechatmp_client import WechatMPClient
+from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
 from common.utils import split_string_by_utf8_length, remove_markdown_symbol
@@ -36,22 +35,27 @@ class WechatMPChannel(ChatChannel):
     def __init__(self, passive_reply=True):
         super().__init__()
         self.passive_reply = passive_reply
+        # 被动回复需要在处理线程结束前放入待回复列表，不能交给outbox异步发送
+        self.use_outbox = not passive_reply
         self.NOT_SUPPORT_REPLYTYPE = []
         appid = conf().get("wechatmp_app_id")
         secret = conf().get("wechatmp_app_secret")
         token = conf().get("wechatmp_token")
         aes_key = conf().get("wechatmp_aes_key")
         self.client = WechatMPClient(appid, secret)
+        self.uploader = MediaUploader(self.client, conf().get("wechatmp_upload_workers", 4))
         self.crypto = None
         if aes_key:
             self.crypto = WeChatCrypto(token, aes_key, appid)
         if self.passive_reply:
             # Cache the reply to the user's first message
-            self.cache_dict = defaultdict(list)
-            # Record whether the current message is being processed
-            self.running = set()
+            self.cache_dict = ExpiredDict(REPLY_CACHE_TTL)
+            # Record whether the current message is being processed, user -> 未完成的任务数(消息处理和后台上传)
+            self.running = ExpiredDict(RUNNING_TTL)
             # Count the request from wechat official server by message_id
-            self.request_cnt = dict()
+            self.request_cnt = ExpiredDict(REQUEST_CNT_TTL)
+            # 有新回复或消息处理结束时唤醒等待中的请求
+            self.reply_ready = threading.Condition()
             # The permanent media need to be deleted to avoid media number limit
             self.delete_media_loop = asyncio.new_event_loop()
             t = threading.Thread(target=self.start_loop, args=(self.delete_media_loop,))
@@ -65,7 +69,7 @@ class WechatMPChannel(ChatChannel):
             urls = ("/wx", "channel.wechatmp.active_reply.Query")
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("wechatmp_port", 8080)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        run_server(app.wsgifunc(), port, "wechatmp")
 
     def start_loop(self, loop):
         asyncio.set_event_loop(loop)
@@ -77,104 +81,105 @@ class WechatMPChannel(ChatChannel):
         self.client.material.delete(media_id)
         logger.info("[wechatmp] permanent media {} has been deleted".format(media_id))
 
+    def _cache_reply(self, receiver, reply_type, content):
+        with self.reply_ready:
+            self.cache_dict.setdefault(receiver, []).append((reply_type, content))
+            self.reply_ready.notify_all()
+
+    def pop_reply(self, receiver):
+        """
+        :return: (reply_type, content)，没有待回复的消息时返回None
+        """
+        with self.reply_ready:
+            replies = self.cache_dict.get(receiver)
+            if not replies:
+                return None
+            reply = replies.pop(0)
+            if not replies:  # If popping the message makes the list empty, delete the user entry from cache
+                self.cache_dict.pop(receiver, None)
+            return reply
+
+    def wait_reply(self, receiver, timeout) -> bool:
+        """
+        等待用户有可回复的消息或消息处理结束，超时返回False
+        """
+        with self.reply_ready:
+            return self.reply_ready.wait_for(lambda: receiver in self.cache_dict or receiver not in self.running, timeout)
+
+    def _hold(self, receiver):
+        with self.reply_ready:
+            self.running[receiver] = self.running.get(receiver, 0) + 1
+
+    def _finish(self, receiver):
+        with self.reply_ready:
+            count = self.running.get(receiver, 1) - 1
+            if count > 0:
+                self.running[receiver] = count
+            else:
+                self.running.pop(receiver, None)
+            self.reply_ready.notify_all()
+
+    def _upload_later(self, receiver, media_type, loaders):
+        """
+        在上传线程中上传永久素材，上传完成后才放入待回复列表，期间该用户仍视为处理中
+        """
+        self._hold(receiver)
+
+        def on_uploaded(results, error):
+            if error:
+                logger.error("[wechatmp] upload {} failed: {}".format(media_type, error))
+                self._finish(receiver)
+                return
+            # 上传后等待素材生效再回复，语音按最大的文件计算等待时间，定时回调不占用线程
+            delay = 1.0 + 2 * max(size for _, size in results) / 1024 / 1024 if media_type == "voice" else 0
+            self.delete_media_loop.call_soon_threadsafe(self.delete_media_loop.call_later, delay, self._cache_uploaded, receiver, media_type, results)
+
+        self.uploader.upload_all_async(self.uploader.upload_material, media_type, loaders, on_uploaded)
+
+    def _cache_uploaded(self, receiver, media_type, results):
+        # 多段语音一次性放入，避免等待中的请求只取到其中一段
+        with self.reply_ready:
+            for media_id, _ in results:
+                logger.info("[wechatmp] {} uploaded, receiver {}, media_id {}".format(media_type, receiver, media_id))
+                self._cache_reply(receiver, media_type, media_id)
+            self._finish(receiver)
+
+    def _split_reply(self, reply: Reply) -> list:
+        # 超长文本拆成多条消息，由outbox按顺序逐条发送
+        if reply.type not in [ReplyType.TEXT, ReplyType.ERROR, ReplyType.INFO] or len(reply.content.encode("utf8")) <= MAX_UTF8_LEN:
+            return [reply]
+        texts = split_string_by_utf8_length(reply.content, MAX_UTF8_LEN)
+        logger.info("[wechatmp] text too long, split into {} parts".format(len(texts)))
+        return [Reply(reply.type, text) for text in texts]
+
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
         if self.passive_reply:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
                 reply_text = remove_markdown_symbol(reply.content)
                 logger.info("[wechatmp] text cached, receiver {}\n{}".format(receiver, reply_text))
-                self.cache_dict[receiver].append(("text", reply_text))
+                self._cache_reply(receiver, "text", reply_text)
             elif reply.type == ReplyType.VOICE:
                 voice_file_path = reply.content
                 duration, files = split_audio(voice_file_path, 60 * 1000)
                 if len(files) > 1:
                     logger.info("[wechatmp] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
-
-                for path in files:
-                    # support: <2M, <60s, mp3/wma/wav/amr
-                    try:
-                        with open(path, "rb") as f:
-                            response = self.client.material.add("voice", f)
-                            logger.debug("[wechatmp] upload voice response: {}".format(response))
-                            f_size = os.fstat(f.fileno()).st_size
-                            time.sleep(1.0 + 2 * f_size / 1024 / 1024)
-                            # todo check media_id
-                    except WeChatClientException as e:
-                        logger.error("[wechatmp] upload voice failed: {}".format(e))
-                        return
-                    media_id = response["media_id"]
-                    logger.info("[wechatmp] voice uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                    self.cache_dict[receiver].append(("voice", media_id))
-
+                # support: <2M, <60s, mp3/wma/wav/amr
+                self._upload_later(receiver, "voice", [MediaUploader.file_loader(path) for path in files])
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
-                image_storage = io.BytesIO()
-                for block in pic_res.iter_content(1024):
-                    image_storage.write(block)
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.material.add("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                name = receiver + "-" + str(context["msg"].msg_id)
+                self._upload_later(receiver, "image", [lambda: MediaUploader.image_file(name, MediaUploader.fetch(img_url))])
             elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
-                image_storage = reply.content
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.material.add("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                image = MediaUploader.image_file(receiver + "-" + str(context["msg"].msg_id), MediaUploader.read(reply.content))
+                self._upload_later(receiver, "image", [lambda: image])
             elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
                 video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
-                video_storage = io.BytesIO()
-                for block in video_res.iter_content(1024):
-                    video_storage.write(block)
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.material.add("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
-
+                name = receiver + "-" + str(context["msg"].msg_id)
+                self._upload_later(receiver, "video", [lambda: MediaUploader.video_file(name, MediaUploader.fetch(video_url))])
             elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
-                video_storage = reply.content
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.material.add("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
+                video = MediaUploader.video_file(receiver + "-" + str(context["msg"].msg_id), MediaUploader.read(reply.content))
+                self._upload_later(receiver, "video", [lambda: video])
 
         else:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
@@ -182,10 +187,8 @@ class WechatMPChannel(ChatChannel):
                 texts = split_string_by_utf8_length(reply_text, MAX_UTF8_LEN)
                 if len(texts) > 1:
                     logger.info("[wechatmp] text too long, split into {} parts".format(len(texts)))
-                for i, text in enumerate(texts):
+                for text in texts:
                     self.client.message.send_text(receiver, text)
-                    if i != len(texts) - 1:
-                        time.sleep(0.5)  # 休眠0.5秒，防止发送过快乱序
                 logger.info("[wechatmp] Do send text to {}: {}".format(receiver, reply_text))
             elif reply.type == ReplyType.VOICE:
                 try:
@@ -203,102 +206,51 @@ class WechatMPChannel(ChatChannel):
                         file_name = os.path.basename(file_path)
                         file_type = "audio/mpeg"
                     logger.info("[wechatmp] file_name: {}, file_type: {} ".format(file_name, file_type))
-                    media_ids = []
                     duration, files = split_audio(file_path, 60 * 1000)
                     if len(files) > 1:
                         logger.info("[wechatmp] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
-                    for path in files:
-                        # support: <2M, <60s, AMR\MP3
-                        response = self.client.media.upload("voice", (os.path.basename(path), open(path, "rb"), file_type))
-                        logger.debug("[wechatcom] upload voice response: {}".format(response))
-                        media_ids.append(response["media_id"])
-                        os.remove(path)
+                    # support: <2M, <60s, AMR\MP3
+                    results = self.uploader.upload_all(self.uploader.upload_temp, "voice", [MediaUploader.file_loader(path, file_type) for path in files])
+                    media_ids = [media_id for media_id, _ in results]
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload voice failed: {}".format(e))
                     return
 
-                try:
-                    os.remove(file_path)
-                except Exception:
-                    pass
+                for path in set(files + [file_path]):
+                    try:
+                        os.remove(path)
+                    except Exception:
+                        pass
 
                 for media_id in media_ids:
                     self.client.message.send_voice(receiver, media_id)
                     time.sleep(1)
                 logger.info("[wechatmp] Do send voice to {}".format(receiver))
-            elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
-                img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
-                image_storage = io.BytesIO()
-                for block in pic_res.iter_content(1024):
-                    image_storage.write(block)
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.media.upload("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                self.client.message.send_image(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send image to {}".format(receiver))
-            elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
-                image_storage = reply.content
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.media.upload("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                self.client.message.send_image(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send image to {}".format(receiver))
-            elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
-                video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
-                video_storage = io.BytesIO()
-                for block in video_res.iter_content(1024):
-                    video_storage.write(block)
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.media.upload("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
-                    return
-                self.client.message.send_video(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send video to {}".format(receiver))
-            elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
-                video_storage = reply.content
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
+            elif reply.type in [ReplyType.IMAGE_URL, ReplyType.IMAGE, ReplyType.VIDEO_URL, ReplyType.VIDEO]:
+                name = receiver + "-" + str(context["msg"].msg_id)
+                # IMAGE_URL和VIDEO_URL从网络下载，IMAGE和VIDEO从文件读取
+                data = MediaUploader.fetch(reply.content) if reply.type in [ReplyType.IMAGE_URL, ReplyType.VIDEO_URL] else MediaUploader.read(reply.content)
+                media_type = "image" if reply.type in [ReplyType.IMAGE_URL, ReplyType.IMAGE] else "video"
+                file = MediaUploader.image_file(name, data) if media_type == "image" else MediaUploader.video_file(name, data)
                 try:
-                    response = self.client.media.upload("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
+                    media_id = self.uploader.upload_temp(media_type, file)
                 except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
+                    logger.error("[wechatmp] upload {} failed: {}".format(media_type, e))
                     return
-                self.client.message.send_video(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send video to {}".format(receiver))
+                if media_type == "image":
+                    self.client.message.send_image(receiver, media_id)
+                else:
+                    self.client.message.send_video(receiver, media_id)
+                logger.info("[wechatmp] Do send {} to {}".format(media_type, receiver))
         return
 
     def _success_callback(self, session_id, context, **kwargs):  # 线程异常结束时的回调函数
         logger.debug("[wechatmp] Success to generate reply, msgId={}".format(context["msg"].msg_id))
         if self.passive_reply:
-            self.running.remove(session_id)
+            self._finish(session_id)
 
     def _fail_callback(self, session_id, exception, context, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("[wechatmp] Fail to generate reply to user, msgId={}, exception={}".format(context["msg"].msg_id, exception))
         if self.passive_reply:
             assert session_id not in self.cache_dict
-            self.running.remove(session_id)
+            self._finish(session_id)
@@ -0,0 +1,54 @@
+"""
+异步流水线使用的全局事件循环，在独立的后台线程中运行
+同步的bot、插件等通过run_sync放到线程池中执行，不会阻塞事件循环
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from common.log import logger
+from config import conf
+
+_loop = None
+_sync_executor = None
+_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _sync_executor
+    with _lock:
+        if _loop is None:
+            _sync_executor = ThreadPoolExecutor(max_workers=conf().get("async_sync_workers", 32), thread_name_prefix="async-adapter")
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(_sync_executor)
+            started = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            thread = threading.Thread(target=run, name="async-pipeline", daemon=True)
+            thread.start()
+            started.wait()
+            _loop = loop
+            logger.info("[event_loop] async pipeline event loop started")
+        return _loop
+
+
+def run_coroutine(coro) -> Future:
+    """
+    在全局事件循环中运行协程，可在任意线程调用
+    :return: concurrent.futures.Future，可以add_done_callback和cancel
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    在线程池中执行同步函数并等待结果，用于适配不支持异步的bot和插件
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
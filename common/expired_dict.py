@@ -1,22 +1,71 @@
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+class ExpiredDict(MutableMapping):
+    """
+    带过期时间的字典，每次读写会刷新key的过期时间
+    所有key的过期时长相同，按最后访问时间排序即为按过期时间排序，过期和LRU淘汰都只需要从头部弹出，均摊O(1)
+    """
+
+    def __init__(self, expires_in_seconds, max_size=None):
+        """
+        :param expires_in_seconds: 过期时间，单位秒
+        :param max_size: 最大key数量，超出时淘汰最久未访问的key，None表示不限制
+        """
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size
+        self._data = OrderedDict()  # key -> (value, expiry_time)，按最后访问时间从旧到新排列
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # 超出max_size被淘汰的数量
+        self.expirations = 0  # 过期被清理的数量
+
+    def _sweep(self, now):
+        # 清理头部已过期的key，遇到第一个未过期的key即可停止
+        data = self._data
+        while data:
+            key, (value, expiry_time) = next(iter(data.items()))
+            if expiry_time > now:
+                break
+            del data[key]
+            self.expirations += 1
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
-            raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
-        return value
+        with self._lock:
+            now = time.monotonic()
+            try:
+                value, expiry_time = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            if now > expiry_time:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                raise KeyError("expired {}".format(key))
+            self._data[key] = (value, now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self._lock:
+            now = time.monotonic()
+            self._sweep(now)
+            self._data[key] = (value, now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            if self.max_size is not None:
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
 
     def get(self, key, default=None):
         try:
@@ -25,18 +74,54 @@ class ExpiredDict(dict):
             return default
 
     def __contains__(self, key):
-        try:
-            self[key]
-            return True
-        except KeyError:
-            return False
+        # 只判断是否存在且未过期，不刷新过期时间
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[1] >= time.monotonic()
+
+    def __len__(self):
+        with self._lock:
+            self._sweep(time.monotonic())
+            return len(self._data)
 
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        with self._lock:
+            self._sweep(time.monotonic())
+            return list(self._data.keys())
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        with self._lock:
+            self._sweep(time.monotonic())
+            return [(key, value) for key, (value, _) in self._data.items()]
+
+    def values(self):
+        with self._lock:
+            self._sweep(time.monotonic())
+            return [value for value, _ in self._data.values()]
 
     def __iter__(self):
         return self.keys().__iter__()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def sweep(self):
+        """
+        主动清理所有过期的key，可由定时任务调用
+        """
+        with self._lock:
+            self._sweep(time.monotonic())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def __repr__(self):
+        return "{}({}, expires_in_seconds={})".format(type(self).__name__, dict(self.items()), self.expires_in_seconds)
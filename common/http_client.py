@@ -0,0 +1,78 @@
+"""
+全局共享的HTTP客户端，所有bot、语音引擎和channel通过它发起请求
+按host复用keep-alive连接，避免每次请求都重新建立TCP和TLS连接
+"""
+
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import conf
+
+_session = None
+_lock = threading.Lock()
+
+
+class _Session(requests.Session):
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (conf().get("http_connect_timeout", 10), conf().get("http_read_timeout", 180))
+        return super().request(method, url, **kwargs)
+
+
+def _create_session() -> requests.Session:
+    session = _Session()
+    # 不同用户的请求共用连接池，不保存服务端下发的cookie
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    retries = Retry(
+        total=conf().get("http_max_retries", 2),
+        connect=conf().get("http_max_retries", 2),
+        read=0,  # 已发出的请求不重试，避免重复调用模型接口
+        status=conf().get("http_max_retries", 2),
+        status_forcelist=[502, 503, 504],  # 仅对幂等请求(GET等)生效
+        backoff_factor=0.5,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=conf().get("http_pool_connections", 16),  # 缓存连接池的host数量
+        pool_maxsize=conf().get("http_pool_maxsize", 32),  # 每个host最多保持的连接数
+        max_retries=retries,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def request(method, url, **kwargs) -> requests.Response:
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, params=None, **kwargs) -> requests.Response:
+    return get_session().get(url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs) -> requests.Response:
+    return get_session().post(url, data=data, json=json, **kwargs)
+
+
+def reset():
+    """
+    关闭现有连接，下次请求时按最新配置重新创建
+    """
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
@@ -0,0 +1,195 @@
+"""
+按内容寻址的本地媒体缓存，插件回复的文件、视频等网络资源下载一次后直接从磁盘读取
+文件保存在 缓存目录/内容sha256/原文件名，不同URL内容相同时只保存一份；
+url到文件的索引保存在index.json中，重启后仍然有效
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from urllib.parse import unquote, urlparse
+
+from common import http_client
+from common.log import logger
+
+
+def _file_name(url):
+    name = os.path.basename(unquote(urlparse(url).path)) or "file"
+    return "".join(c for c in name if c not in '\\/:*?"<>|') or "file"
+
+
+class MediaCache(object):
+    INDEX_FILE = "index.json"
+
+    def __init__(self, cache_dir, ttl=86400, max_size=512 * 1024 * 1024):
+        """
+        :param ttl: url缓存的有效期，过期后重新请求，服务端返回304时继续使用本地文件
+        :param max_size: 缓存文件总大小上限，超出时按最近使用时间淘汰
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.fetching = {}  # url -> threading.Event，同一url同时只下载一次
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._load_index()  # url -> {"digest", "name", "size", "fetched_at", "used_at", "etag", "last_modified"}
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.INDEX_FILE), "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {url: entry for url, entry in index.items() if os.path.exists(self._path(entry))}
+
+    def _save_index(self):
+        # 调用方持有self.lock
+        path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(path + ".tmp", path)
+
+    def _path(self, entry):
+        return os.path.join(self.cache_dir, entry["digest"], entry["name"])
+
+    def get(self, url):
+        """
+        只查本地缓存，不发起网络请求
+        :return: 未过期的本地文件路径，没有时返回None
+        """
+        with self.lock:
+            entry = self.index.get(url)
+            if not entry or time.time() - entry["fetched_at"] > self.ttl:
+                return None
+            path = self._path(entry)
+            if not os.path.exists(path):
+                del self.index[url]
+                return None
+            entry["used_at"] = time.time()
+            return path
+
+    def fetch(self, url):
+        """
+        返回url对应的本地文件路径，缓存未命中或过期时下载
+        :return: 本地文件路径，下载失败且没有旧文件时返回None
+        """
+        path = self.get(url)
+        if path:
+            return path
+        with self.lock:
+            event = self.fetching.get(url)
+            owner = event is None
+            if owner:
+                event = self.fetching[url] = threading.Event()
+        if not owner:
+            # 其它线程正在下载同一个url，等待它的结果
+            event.wait()
+            return self.get(url)
+        try:
+            return self._download(url)
+        finally:
+            with self.lock:
+                del self.fetching[url]
+            event.set()
+
+    def prefetch(self, urls):
+        """
+        后台线程预先下载，避免第一次命中时占用处理消息的线程
+        """
+        urls = [url for url in urls if not self.get(url)]
+        if not urls:
+            return
+
+        def run():
+            for url in urls:
+                self.fetch(url)
+
+        threading.Thread(target=run, name="media-prefetch", daemon=True).start()
+
+    def _download(self, url):
+        with self.lock:
+            old = self.index.get(url)
+        headers = {}
+        if old:
+            # 过期的缓存带上校验信息，资源未变化时服务端返回304，不需要重新下载
+            if old.get("etag"):
+                headers["If-None-Match"] = old["etag"]
+            if old.get("last_modified"):
+                headers["If-Modified-Since"] = old["last_modified"]
+        tmp_path = os.path.join(self.cache_dir, "{}-{}.tmp".format(threading.get_ident(), time.time()))
+        try:
+            res = http_client.get(url, headers=headers, stream=True)
+            if res.status_code == 304 and old:
+                res.close()
+                with self.lock:
+                    old["fetched_at"] = old["used_at"] = time.time()
+                    self.index[url] = old
+                    self._save_index()
+                return self._path(old)
+            res.raise_for_status()
+            sha = hashlib.sha256()
+            size = 0
+            with open(tmp_path, "wb") as f:
+                for block in res.iter_content(64 * 1024):
+                    sha.update(block)
+                    size += len(block)
+                    f.write(block)
+        except Exception as e:
+            logger.warn("[media_cache] download {} failed: {}".format(url, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self.lock:
+                # 下载失败时继续使用过期的旧文件
+                return self._path(old) if old and os.path.exists(self._path(old)) else None
+
+        now = time.time()
+        entry = {
+            "digest": sha.hexdigest(),
+            "name": _file_name(url),
+            "size": size,
+            "fetched_at": now,
+            "used_at": now,
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+        }
+        path = self._path(entry)
+        with self.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+            self.index[url] = entry
+            if old and old["digest"] != entry["digest"] and all(e["digest"] != old["digest"] for e in self.index.values()):
+                # url的内容已更新，旧文件不再被引用
+                shutil.rmtree(os.path.join(self.cache_dir, old["digest"]), ignore_errors=True)
+            self._evict(now, entry["digest"])
+            self._save_index()
+        logger.info("[media_cache] cached {}, size={}".format(url, size))
+        return path
+
+    def _evict(self, now, keep):
+        # 调用方持有self.lock，同一内容被多个url引用时只计算一次大小，所有引用都淘汰后才删除文件
+        digests = {}  # digest -> (size, 最近使用时间)
+        for entry in self.index.values():
+            used_at = digests.get(entry["digest"], (0, 0))[1]
+            digests[entry["digest"]] = (entry["size"], max(used_at, entry["used_at"]))
+        total = sum(size for size, _ in digests.values())
+        digests.pop(keep, None)  # 刚下载的文件即使超过上限也要能返回给调用方
+        removed = set()
+        for digest, (size, used_at) in sorted(digests.items(), key=lambda item: item[1][1]):
+            # 超过两个有效期没有使用的文件，以及超出总大小时最久未使用的文件
+            if now - used_at <= self.ttl * 2 and total <= self.max_size:
+                break
+            removed.add(digest)
+            total -= size
+        if not removed:
+            return
+        for url in [url for url, entry in self.index.items() if entry["digest"] in removed]:
+            del self.index[url]
+        for digest in removed:
+            shutil.rmtree(os.path.join(self.cache_dir, digest), ignore_errors=True)
+        logger.debug("[media_cache] evicted {} files".format(len(removed)))
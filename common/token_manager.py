@@ -0,0 +1,121 @@
+"""
+OAuth类接口的access_token缓存，bot、语音引擎和channel共用
+token在过期前一直复用，临近过期时由后台定时器提前刷新，并发获取时只有一个线程真正发起请求
+"""
+
+import threading
+import time
+
+from common import http_client
+from common.log import logger
+
+
+class TokenManager(object):
+    def __init__(self, name, fetch, refresh_ahead=300, retry_interval=30):
+        """
+        :param name: 日志中显示的名称
+        :param fetch: 获取token的函数，返回(token, expires_in)，失败时返回(None, 0)或抛出异常
+        :param refresh_ahead: 距离过期还剩多少秒时开始后台刷新
+        :param retry_interval: 后台刷新失败后的重试间隔
+        """
+        self.name = name
+        self.fetch = fetch
+        self.refresh_ahead = refresh_ahead
+        self.retry_interval = retry_interval
+        self.token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()  # 保证同一时刻只有一个线程在刷新
+        self.timer = None
+
+    def get(self, force=False):
+        """
+        :return: 有效的token，获取失败时返回None
+        """
+        token, expires_at = self.token, self.expires_at
+        if not force and token and time.time() < expires_at:
+            return token
+        with self.lock:
+            # 等锁期间其它线程可能已经刷新完成
+            if not force and self.token and time.time() < self.expires_at:
+                return self.token
+            if force and self.token != token:
+                return self.token
+            return self._refresh()
+
+    def invalidate(self, token=None):
+        """
+        服务端返回token失效时调用，下次get会重新获取
+        :param token: 只有当前token仍是这个值时才作废，避免作废其它线程刚刷新的token
+        """
+        with self.lock:
+            if token is None or token == self.token:
+                self.token, self.expires_at = None, 0
+
+    def _refresh(self):
+        # 调用方持有self.lock
+        try:
+            token, expires_in = self.fetch()
+        except Exception as e:
+            logger.warn("[token] fetch {} token failed: {}".format(self.name, e))
+            token, expires_in = None, 0
+        now = time.time()
+        if token:
+            expires_in = int(expires_in or 0) or 7200
+            self.token = token
+            # 留出一分钟余量，避免拿到的token在请求途中过期
+            self.expires_at = now + max(expires_in - 60, expires_in / 2)
+            self._schedule(max(self.expires_at - self.refresh_ahead - now, expires_in / 2))
+            logger.debug("[token] {} token refreshed, expires_in={}".format(self.name, expires_in))
+            return token
+        if self.token and now < self.expires_at:
+            # 提前刷新失败时继续使用旧token，稍后再试
+            self._schedule(min(self.retry_interval, self.expires_at - now))
+            return self.token
+        self.token, self.expires_at = None, 0
+        return None
+
+    def _schedule(self, delay):
+        if self.timer:
+            self.timer.cancel()
+        self.timer = threading.Timer(max(delay, 1), self._background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _background_refresh(self):
+        with self.lock:
+            self._refresh()
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_token_manager(key, fetch, **kwargs) -> TokenManager:
+    """
+    按key获取共享的TokenManager，同一凭证的多个使用方共用一个token
+    :param key: 凭证标识，如("baidu", api_key)
+    """
+    manager = _managers.get(key)
+    if manager is None:
+        with _managers_lock:
+            manager = _managers.get(key)
+            if manager is None:
+                manager = TokenManager(key[0] if isinstance(key, tuple) else str(key), fetch, **kwargs)
+                _managers[key] = manager
+    return manager
+
+
+def baidu_token_manager(api_key, secret_key) -> TokenManager:
+    """
+    百度智能云的access_token，文心一言和百度语音使用同一套AK/SK时共用
+    """
+
+    def fetch():
+        url = "https://aip.baidubce.com/oauth/2.0/token"
+        params = {"grant_type": "client_credentials", "client_id": api_key, "client_secret": secret_key}
+        res = http_client.post(url, params=params).json()
+        if not res.get("access_token"):
+            logger.error("[token] fetch baidu access_token failed: {}".format(res))
+        return res.get("access_token"), res.get("expires_in", 2592000)
+
+    return get_token_manager(("baidu", api_key, secret_key), fetch)
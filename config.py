@@ -16,6 +16,12 @@ available_setting = {
     # openai apibase，当use_azure_chatgpt为true时，需要设置对应的api base
     "open_ai_api_base": "https://api.openai.com/v1",
     "proxy": "",  # openai使用的代理
+    # 多个OpenAI兼容接口的上游，请求按延迟、处理中的请求数和权重分配，出错的上游自动冷却，为空时只使用open_ai_api_key和open_ai_api_base
+    # 每项格式: {"api_key": "sk-xxx", "api_base": "https://api.openai.com/v1", "model": ["gpt-4o"], "weight": 1}，model为空时处理所有模型
+    # 请求的模型不在任何上游的model中时(如用户切换了模型)，该请求分配到所有上游，不会直接报错
+    "open_ai_upstreams": [],
+    "upstream_cooldown": 30,  # 上游返回429、5xx或连接超时后的冷却秒数，连续出错时翻倍
+    "upstream_cooldown_max": 600,  # 上游冷却的最长秒数，鉴权失败(401、403)时直接冷却该时长
     # chatgpt模型， 当use_azure_chatgpt为true时，其名称为Azure上model deployment名称
     "model": "gpt-3.5-turbo",  # 可选择: gpt-4o, pt-4o-mini, gpt-4-turbo, claude-3-sonnet, wenxin, moonshot, qwen-turbo, xunfei, glm-4, minimax, gemini等模型，全部可选模型详见common/const.py文件
     "bot_type": "",  # 可选配置，使用兼容openai格式的三方服务时候，需填"chatGPT"。bot具体名称详见common/const.py文件列出的bot_type，如不填根据model名称判断，
@@ -49,16 +55,44 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "handler_pool_size": 8,  # 处理消息的线程数
+    "handler_pool_lanes": {"VOICE": 2, "IMAGE_CREATE": 2},  # 按消息类型划分的独立线程池及线程数，避免慢任务阻塞文本消息
+    "async_pipeline": False,  # 是否使用异步流水线处理消息，支持异步的bot在同一个事件循环中并发请求，不再每条消息占用一个线程
+    "async_sync_workers": 32,  # 异步流水线中执行同步bot和插件的线程数
+    "stream_reply": False,  # 是否流式回复，web、terminal和钉钉AI卡片会逐段展示，其它channel仍等待完整回复
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
-    "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "expires_in_seconds": 3600,  # 无操作会话的过期时间，使用sqlite或log会话存储时过期的会话会从存储中删除
+    "session_store": "memory",  # 会话存储方式，支持memory(仅内存)，sqlite，log(追加写日志，Windows下只支持单进程)，后两者重启后会话不丢失，且可在多进程间共享
+    "session_store_path": "",  # 会话存储文件路径，默认保存在数据目录下的sessions.db或sessions.log
+    "session_store_flush_interval": 1,  # 会话批量写入存储的间隔，单位秒，为0时每次修改立即写入
+    "session_cache_size": 0,  # 内存中最多缓存的会话数，超出时淘汰最久未使用的会话(仍保留在存储中)，0表示不限制
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
     # chatgpt限流配置
-    "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
-    "rate_limit_dalle": 50,  # openai dalle的调用频率限制
+    "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制，每分钟请求数
+    "rate_limit_chatgpt_scope": "global",  # rate_limit_chatgpt的计算范围，global(全局共用)，api_key(每个key单独计算)，model(每个模型单独计算)
+    "bot_retry_max": 2,  # 调用模型接口失败(限流、超时、服务端错误)时的最多重试次数
+    "bot_retry_max_delay": 30,  # 单次重试前最多等待的秒数，等待时间按指数退避并加随机抖动，接口返回Retry-After时至少等待到该时间
+    "bot_retry_deadline": 60,  # 一次请求(含重试)的总时长上限，剩余时间不够再等一次时直接返回错误提示
+    "rate_limit_dalle": 50,  # openai dalle的调用频率限制，每分钟请求数
+    "rate_limit_session": 0,  # 每个会话每分钟最多调用bot的次数，群聊共享会话时即每个群，超出时直接拒绝，0表示不限制
+    "rate_limit_user": 0,  # 每个用户每分钟最多调用bot的次数，0表示不限制
+    "rate_limit_backend": "memory",  # 限流额度的存储方式，memory(进程内)，sqlite(多个进程共享同一份额度)
+    "rate_limit_path": "",  # sqlite限流数据库路径，默认保存在数据目录下的rate_limit.db
+    "outbox": True,  # 回复交给出站队列(outbox)发送，同一接收者按顺序发送，失败由定时器重试，不占用消息处理线程
+    "outbox_workers": 4,  # outbox发送线程数，不同接收者之间并发发送
+    "outbox_rate_limit": 0,  # channel每分钟最多发送的消息数，0表示使用channel的默认配额
+    "outbox_max_retries": 2,  # 发送失败的重试次数，分别在3秒、6秒后重试
+    "outbox_spool": False,  # 是否把未发送完成的回复保存在数据目录，重启后继续发送
+    "reply_cache": False,  # 是否缓存bot的文本回复，有效期内相同的问题直接返回缓存的回复，不再调用模型
+    "reply_cache_scope": "global",  # 缓存范围，global(所有会话共用)，session(每个会话单独缓存)
+    "reply_cache_ttl": 3600,  # 缓存回复的有效期，单位秒
+    "reply_cache_max_size": 1000,  # 最多缓存的回复数量，超出时淘汰最久未使用的
+    "reply_cache_context_messages": 2,  # 缓存key包含的最近历史消息条数，默认为上一轮问答，避免"为什么"、"继续"等追问在不同对话间串用；0表示只按系统提示词和当前问题匹配
+    "reply_cache_bypass_patterns": ["^#"],  # 问题匹配其中任一正则时不使用缓存，默认跳过#开头的指令
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
     "top_p": 1,
@@ -66,6 +100,12 @@ available_setting = {
     "presence_penalty": 0,
     "request_timeout": 180,  # chatgpt请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
     "timeout": 120,  # chatgpt重试超时时间，在这个时间内，将会自动重试
+    # 共享HTTP连接池配置，bot、语音和channel的http请求复用keep-alive连接
+    "http_pool_connections": 16,  # 缓存连接池的host数量
+    "http_pool_maxsize": 32,  # 每个host最多保持的连接数
+    "http_connect_timeout": 10,  # 未指定超时时间的请求使用的连接超时，单位秒
+    "http_read_timeout": 180,  # 未指定超时时间的请求使用的读取超时，单位秒
+    "http_max_retries": 2,  # 连接失败时的重试次数，GET等幂等请求遇到502/503/504也会重试
     # Baidu 文心一言参数
     "baidu_wenxin_model": "eb-instant",  # 默认使用ERNIE-Bot-turbo模型
     "baidu_wenxin_api_key": "",  # Baidu api key
@@ -100,6 +140,8 @@ available_setting = {
     "voice_reply_voice": False,  # 是否使用语音回复语音，需要设置对应语音合成引擎的api key
     "always_reply_voice": False,  # 是否一直使用语音回复
     "voice_to_text": "openai",  # 语音识别引擎，支持openai,baidu,google,azure,xunfei,ali
+    "voice_sample_rate": 16000,  # 语音识别前转换成wav的采样率，百度、阿里、讯飞需要16000
+    "audio_convert_workers": 0,  # 同时运行的ffmpeg转换进程数，0表示等于CPU核数，超出时发起转换的消息处理线程会阻塞等待
     "text_to_voice": "openai",  # 语音合成引擎，支持openai,baidu,google,azure,xunfei,ali,pytts(offline),elevenlabs,edge(online)
     "text_to_voice_model": "tts-1",
     "tts_voice_id": "alloy",
@@ -134,6 +176,7 @@ available_setting = {
     "wechatmp_app_id": "",  # 微信公众平台的appID
     "wechatmp_app_secret": "",  # 微信公众平台的appsecret
     "wechatmp_aes_key": "",  # 微信公众平台的EncodingAESKey，加密模式需要
+    "wechatmp_upload_workers": 4,  # 并发上传素材的线程数
     # wechatcom的通用配置
     "wechatcom_corp_id": "",  # 企业微信公司的corpID
     # wechatcomapp的配置
@@ -183,6 +226,17 @@ available_setting = {
     "Minimax_group_id": "",
     "Minimax_base_url": "",
     "web_port": 9899,
+    "web_session_expires_in_seconds": 3600,  # web channel会话空闲多久后释放回复队列
+    "web_session_max_count": 10000,  # web channel最多保留的会话数，超出时淘汰最久未访问的会话
+    "web_session_queue_size": 100,  # 每个会话最多缓存的未读回复数，超出时丢弃最旧的回复
+    "web_max_hold_connections": 0,  # 同时保持的SSE和长轮询连接数上限，超出的页面改为每3秒轮询一次，0表示HTTP服务线程数的3/4
+    # web、公众号、企微自建应用、飞书等channel的HTTP服务配置
+    "http_server": "threaded",  # simple: web.py自带服务器, threaded: 可配置的线程池服务器, asgi: uvicorn(需安装uvicorn和a2wsgi)
+    "http_server_threads": 32,  # 处理请求的线程数，web channel每个打开的页面会占用一个线程接收回复，数量受web_max_hold_connections限制
+    "http_server_backlog": 128,  # 等待处理的连接队列长度
+    "http_keepalive_timeout": 10,  # keep-alive连接的空闲超时秒数
+    "http_shutdown_timeout": 5,  # 退出时等待处理中请求的最长秒数
+    "http_slow_request_seconds": 5,  # 超过该耗时的请求打印警告日志
 }
 
 
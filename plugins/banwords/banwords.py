@@ -9,7 +9,7 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from plugins import *
 
-from .lib.WordsSearch import WordsSearch
+from .lib.ArrayWordsSearch import ArrayWordsSearch
 
 
 @plugins.register(
@@ -35,7 +35,7 @@ class Banwords(Plugin):
                     with open(config_path, "w") as f:
                         json.dump(conf, f, indent=4)
 
-            self.searchr = WordsSearch()
+            self.searchr = ArrayWordsSearch()
             self.action = conf["action"]
             banwords_path = os.path.join(curdir, "banwords.txt")
             with open(banwords_path, "r", encoding="utf-8") as f:
@@ -44,7 +44,14 @@ class Banwords(Plugin):
                     word = line.strip()
                     if word:
                         words.append(word)
-            self.searchr.SetKeywords(words)
+            # 词库未变化时直接mmap加载上次构建的自动机，变化后重新构建并覆盖缓存
+            cache_path = os.path.join(curdir, "banwords.cache")
+            if not self.searchr.LoadCache(cache_path, words):
+                self.searchr.SetKeywords(words)
+                try:
+                    self.searchr.SaveCache(cache_path)
+                except Exception as e:
+                    logger.warn("[Banwords] save cache failed: {}".format(e))
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             if conf.get("reply_filter", True):
                 self.handlers[Event.ON_DECORATE_REPLY] = self.on_decorate_reply
@@ -77,6 +84,9 @@ class Banwords(Plugin):
                 return
 
     def on_decorate_reply(self, e_context: EventContext):
+        if e_context["reply"].type == ReplyType.TEXT_STREAM:
+            # 流式回复需要完整内容才能过滤，等待生成完毕后按普通文本处理
+            e_context["reply"] = Reply(ReplyType.TEXT, "".join(e_context["reply"].content))
         if e_context["reply"].type not in [ReplyType.TEXT]:
             return
 
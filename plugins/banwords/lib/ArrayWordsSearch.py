@@ -0,0 +1,318 @@
+# -*- coding:utf-8 -*-
+"""
+基于扁平array的AC自动机，接口和匹配结果与WordsSearch一致
+WordsSearch的每个节点都是带dict和list的Python对象，10万级词库构建需要数秒、占用数百MB内存；
+这里所有状态保存在几个uint32数组中，构建后可以写成二进制缓存文件，下次启动直接mmap加载
+
+状态按层(BFS)编号，根节点为0，每个节点的子节点编号连续且按字符排序：
+    _chars[s]:               进入状态s的字符
+    _first[s], _first[s+1]:  状态s的子节点编号区间，查找转移时在_chars的这个区间内二分
+    _fail[s]:                失败指针
+    _out_first[s], _out_first[s+1]: 状态s命中的关键词序号在_outs中的区间，顺序与WordsSearch的Results一致
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+
+__all__ = ["ArrayWordsSearch"]
+
+_MAGIC = b"BWAC"
+_VERSION = 1
+# magic, version, 字节序校验值, 词库摘要, 状态数, 命中数, 关键词数
+_HEADER = struct.Struct("=4sII32sIII")
+
+
+def _digest(keywords):
+    h = hashlib.sha256()
+    for word in keywords:
+        h.update(word.encode("utf-8", "surrogatepass"))
+        h.update(b"\0")
+    return h.digest()
+
+
+class ArrayWordsSearch(object):
+    def __init__(self):
+        self._keywords = []
+        self._indexs = []
+        self._root = {}  # 根节点的转移，大部分字符都从根节点出发，用dict查找更快
+        self._chars = array("I", [0])
+        self._fail = array("I", [0])
+        self._first = array("I", [1, 1])
+        self._out_first = array("I", [0, 0])
+        self._outs = array("I")
+        self._mmap = None
+        self._view = None
+
+    def SetKeywords(self, keywords):
+        self._close()
+        self._keywords = keywords
+        self._indexs = list(range(len(keywords)))
+        own = {}  # 关键词 -> 序号列表，重复的关键词都会出现在结果中
+        for i, word in enumerate(keywords):
+            if word:
+                own.setdefault(word, []).append(i)
+
+        chars = array("I", [0])
+        fail = array("I", [0])
+        first = array("I", [1])
+        root = {}
+        node_own = {}  # 状态 -> 以该状态结尾的关键词序号
+        words = sorted(own)
+        prev = {"": 0}  # 上一层的前缀 -> 状态
+        prev_start, n, depth = 0, 1, 1
+        while True:
+            words = [w for w in words if len(w) >= depth]
+            # 上一层第一个节点的子节点从本层第一个状态开始，先写入以便计算本层失败指针时查找区间
+            counts = [0] * len(prev)
+            if depth > 1:
+                first[prev_start] = n
+            cur = {}
+            last = None
+            for w in words:
+                p = w[:depth]
+                if p == last:
+                    continue
+                last = p
+                parent = prev[p[:-1]]
+                c = ord(p[-1])
+                counts[parent - prev_start] += 1
+                if parent == 0:
+                    root[c] = n
+                    f = 0
+                else:
+                    f = self._goto(root, chars, fail, first, fail[parent], c)
+                cur[p] = n
+                chars.append(c)
+                fail.append(f)
+                first.append(0)
+                if p in own:
+                    node_own[n] = own[p]
+                n += 1
+            # 上一层节点的子节点区间，本层节点按父节点顺序排列
+            pos = prev_start + len(prev)
+            for i, count in enumerate(counts):
+                first[prev_start + i] = pos
+                pos += count
+            if not cur:
+                break
+            prev_start += len(prev)
+            prev = cur
+            depth += 1
+        first.append(n)
+
+        # 命中结果 = 自身的关键词 + 失败指针的命中结果(去重)，失败指针的层数更小，已经算好
+        out_first = array("I", [0, 0])
+        outs = array("I")
+        for s in range(1, n):
+            f = fail[s]
+            items = node_own.get(s, [])
+            if out_first[f] != out_first[f + 1]:
+                items = list(items)
+                for item in outs[out_first[f]:out_first[f + 1]]:
+                    if item not in items:
+                        items.append(item)
+            outs.extend(items)
+            out_first.append(len(outs))
+
+        self._root = root
+        self._chars, self._fail, self._first = chars, fail, first
+        self._out_first, self._outs = out_first, outs
+
+    @staticmethod
+    def _goto(root, chars, fail, first, state, c):
+        while state:
+            lo, hi = first[state], first[state + 1]
+            if lo != hi:
+                j = bisect_left(chars, c, lo, hi)
+                if j != hi and chars[j] == c:
+                    return j
+            state = fail[state]
+        return root.get(c, 0)
+
+    def SaveCache(self, path):
+        """
+        保存为二进制缓存文件，先写临时文件再替换，避免其它进程读到不完整的文件
+        """
+        header = _HEADER.pack(_MAGIC, _VERSION, 1, _digest(self._keywords), len(self._chars), len(self._outs), len(self._keywords))
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            for arr in (self._chars, self._fail, self._first, self._out_first, self._outs):
+                f.write(arr.tobytes() if isinstance(arr, array) else bytes(arr))
+        os.replace(tmp_path, path)
+
+    def LoadCache(self, path, keywords):
+        """
+        mmap加载缓存文件，文件不存在、格式不符或与keywords不一致时返回False
+        缓存中只保存自动机，关键词由调用方传入并用于校验
+        """
+        if not os.path.exists(path) or os.path.getsize(path) < _HEADER.size:
+            return False
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, order, digest, n, n_outs, n_keywords = _HEADER.unpack_from(mm)
+        if magic != _MAGIC or version != _VERSION or order != 1 or n_keywords != len(keywords) or len(mm) != _HEADER.size + (4 * n + 2) * 4 + n_outs * 4 or digest != _digest(keywords):
+            mm.close()
+            return False
+
+        self._close()
+        view = memoryview(mm)
+        pos = _HEADER.size
+        arrays = []
+        for size in (n, n, n + 1, n + 1, n_outs):
+            arrays.append(view[pos:pos + size * 4].cast("I"))
+            pos += size * 4
+        self._chars, self._fail, self._first, self._out_first, self._outs = arrays
+        self._mmap, self._view = mm, view
+        self._keywords = keywords
+        self._indexs = list(range(len(keywords)))
+        chars, first = self._chars, self._first
+        self._root = {chars[s]: s for s in range(first[0], first[1])}
+        return True
+
+    def _close(self):
+        # 切换词库时释放旧的mmap，memoryview需要先释放才能关闭
+        if self._mmap is None:
+            return
+        for arr in (self._chars, self._fail, self._first, self._out_first, self._outs, self._view):
+            arr.release()
+        self._mmap.close()
+        self._mmap = None
+
+    def _scan(self, text, first_only=False):
+        """
+        :return: [(结束位置, 状态)]，只包含有命中结果的位置
+        """
+        root_get = self._root.get
+        chars, fail, first, out_first = self._chars, self._fail, self._first, self._out_first
+        matches = []
+        state = 0
+        for index, ch in enumerate(text):
+            c = ord(ch)
+            while state:
+                lo, hi = first[state], first[state + 1]
+                if lo != hi:
+                    j = bisect_left(chars, c, lo, hi)
+                    if j != hi and chars[j] == c:
+                        state = j
+                        break
+                state = fail[state]
+            else:
+                state = root_get(c, 0)
+            if out_first[state] != out_first[state + 1]:
+                matches.append((index, state))
+                if first_only:
+                    break
+        return matches
+
+    def _result(self, index, item):
+        keyword = self._keywords[item]
+        return {"Keyword": keyword, "Success": True, "End": index, "Start": index + 1 - len(keyword), "Index": self._indexs[item]}
+
+    def FindFirst(self, text):
+        for index, state in self._scan(text, True):
+            return self._result(index, self._outs[self._out_first[state]])
+        return None
+
+    def FindAll(self, text):
+        outs, out_first = self._outs, self._out_first
+        result = []
+        for index, state in self._scan(text):
+            for item in outs[out_first[state]:out_first[state + 1]]:
+                result.append(self._result(index, item))
+        return result
+
+    def ContainsAny(self, text):
+        return bool(self._scan(text, True))
+
+    def Replace(self, text, replaceChar="*"):
+        matches = self._scan(text)
+        if not matches:
+            return text
+        result = list(text)
+        for index, state in matches:
+            # 与WordsSearch一致，按该位置命中的最长关键词替换
+            length = len(self._keywords[self._outs[self._out_first[state]]])
+            for j in range(index + 1 - length, index + 1):
+                result[j] = replaceChar
+        return "".join(result)
+
+    def FindFirstBatch(self, texts):
+        """
+        一次调用检查多段文本，如同时检查提问和回复，返回每段文本的FindFirst结果
+        """
+        return [self.FindFirst(text) if text else None for text in texts]
+
+    def FindAllBatch(self, texts):
+        return [self.FindAll(text) if text else [] for text in texts]
+
+
+if __name__ == "__main__":
+    # 基准测试: python plugins/banwords/lib/ArrayWordsSearch.py [词数] [文本长度]
+    # 作为脚本运行，避免导入plugins包时注册插件
+    # 比较WordsSearch和ArrayWordsSearch的构建耗时、内存占用、扫描速度，并校验结果一致
+    import random
+    import sys
+    import tempfile
+    import time
+    import tracemalloc
+
+    from WordsSearch import WordsSearch
+
+    word_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    text_len = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rnd = random.Random(42)
+    # 常用汉字范围内取字，包含少量英文和扩展区字符，关键词之间有大量公共前缀和包含关系
+    alphabet = [chr(c) for c in range(0x4E00, 0x4E00 + 5000)] + list("abcdefg") + ["\U00020000", "\U00020001"]
+    words = ["".join(rnd.choice(alphabet) for _ in range(rnd.randint(2, 6))) for _ in range(word_count)]
+    words += [w[1:] for w in words[:1000] if len(w) > 2] + words[:100]  # 子串和重复关键词
+    texts = ["".join(rnd.choice(alphabet) for _ in range(text_len)) for _ in range(20)]
+    texts += [t[:text_len // 2] + rnd.choice(words) + t[text_len // 2:] for t in texts[:10]]
+
+    def build(cls):
+        # 耗时和内存分开测，tracemalloc会明显拖慢构建
+        start = time.perf_counter()
+        cls().SetKeywords(words)
+        cost = time.perf_counter() - start
+        tracemalloc.start()
+        searcher = cls()
+        searcher.SetKeywords(words)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return searcher, cost, memory
+
+    def scan_speed(searcher):
+        start = time.perf_counter()
+        for text in texts:
+            searcher.FindAll(text)
+        return sum(len(t) for t in texts) / (time.perf_counter() - start)
+
+    print("words={}, texts={}x{} chars".format(len(words), len(texts), text_len))
+    old, old_cost, old_mem = build(WordsSearch)
+    new, new_cost, new_mem = build(ArrayWordsSearch)
+    for text in texts + ["", words[0], "".join(words[:50])]:
+        assert old.FindAll(text) == new.FindAll(text)
+        assert old.FindFirst(text) == new.FindFirst(text)
+        assert old.ContainsAny(text) == new.ContainsAny(text)
+        assert old.Replace(text) == new.Replace(text)
+    print("results identical")
+
+    cache_path = os.path.join(tempfile.mkdtemp(), "banwords.cache")
+    new.SaveCache(cache_path)
+    start = time.perf_counter()
+    cached = ArrayWordsSearch()
+    assert cached.LoadCache(cache_path, words)
+    load_cost = time.perf_counter() - start
+    tracemalloc.start()
+    assert ArrayWordsSearch().LoadCache(cache_path, words)
+    load_mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert all(cached.FindAll(t) == new.FindAll(t) for t in texts)
+
+    print("{:<16} build={:>7.2f}s  memory={:>8.1f}MB  scan={:>10.0f} chars/s".format("WordsSearch", old_cost, old_mem / 1e6, scan_speed(old)))
+    print("{:<16} build={:>7.2f}s  memory={:>8.1f}MB  scan={:>10.0f} chars/s".format("ArrayWordsSearch", new_cost, new_mem / 1e6, scan_speed(new)))
+    print("{:<16} load={:>8.3f}s  memory={:>8.1f}MB  scan={:>10.0f} chars/s  file={:.1f}MB".format("mmap cache", load_cost, load_mem / 1e6, scan_speed(cached), os.path.getsize(cache_path) / 1e6))
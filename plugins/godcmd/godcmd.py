@@ -9,9 +9,15 @@ from typing import Tuple
 
 import bridge.bridge
 import plugins
+from bot.retry import all_retry_policies
+from bot.upstream_pool import all_upstream_pools
 from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from bridge.reply_cache import get_reply_cache
+from channel.handler_pool import all_handler_pools
+from channel.http_server import all_http_stats
+from channel.outbox import all_outboxes
 from common import const
 from config import conf, load_config, global_config
 from plugins import *
@@ -131,6 +137,24 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "pool": {
+        "alias": ["pool", "线程池"],
+        "desc": "查看消息处理线程池、HTTP服务、出站队列和bot重试状态",
+    },
+    "pstats": {
+        "alias": ["pstats", "插件耗时"],
+        "args": ["reset(可选)"],
+        "desc": "查看各插件处理事件的耗时统计",
+    },
+    "rcache": {
+        "alias": ["rcache", "回复缓存"],
+        "args": ["clear(可选)"],
+        "desc": "查看bot回复缓存的命中率和节省的token、耗时",
+    },
+    "upstream": {
+        "alias": ["upstream", "上游"],
+        "desc": "查看OpenAI接口各上游的延迟、冷却状态和用量",
+    },
 }
 
 
@@ -353,6 +377,53 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "pool":
+                            ok = True
+                            result = "线程池状态：\n"
+                            for pool_name, pool in all_handler_pools().items():
+                                for lane_name, stats in pool.stats().items():
+                                    result += f"{pool_name}/{lane_name}: 线程{stats['workers']} 运行{stats['active']} 排队{stats['queued']} 完成{stats['completed']} "
+                                    result += f"平均等待{stats['avg_wait_ms']}ms 最大等待{stats['max_wait_ms']}ms\n"
+                            for server_name, stats in all_http_stats().items():
+                                result += f"http/{server_name}: 处理中{stats['active']} 请求数{stats['count']} "
+                                result += f"平均耗时{stats['avg_ms']:.1f}ms 最大耗时{stats['max_ms']:.1f}ms\n"
+                            for outbox_name, outbox in all_outboxes().items():
+                                stats = outbox.stats()
+                                result += f"outbox/{outbox_name}: 待发送{stats['pending']} 接收者{stats['receivers']} 已发送{stats['sent']} 重试{stats['retried']} 丢弃{stats['dropped']}\n"
+                            for policy_name, policy in all_retry_policies().items():
+                                stats = policy.stats()
+                                result += f"retry/{policy_name}: 请求{stats['requests']} 重试{stats['retries']} 重试后成功{stats['recovered']} 换上游{stats['failovers']} 放弃{stats['gave_up']} 累计等待{stats['waited']:.1f}s\n"
+                        elif cmd == "pstats":
+                            ok = True
+                            if args and args[0] == "reset":
+                                PluginManager().reset_handler_stats()
+                                result = "插件耗时统计已清空"
+                            else:
+                                result = "插件耗时统计(按累计耗时排序)：\n"
+                                for name, event, stats in PluginManager().get_handler_stats():
+                                    result += f"{name}/{event.name}: 次数{stats['count']} 累计{stats['total_ms']:.0f}ms 平均{stats['avg_ms']:.1f}ms "
+                                    result += f"P50 {stats['p50_ms']:.1f}ms P95 {stats['p95_ms']:.1f}ms P99 {stats['p99_ms']:.1f}ms 最大{stats['max_ms']:.1f}ms\n"
+                        elif cmd == "rcache":
+                            ok, cache = True, get_reply_cache()
+                            if cache is None:
+                                result = "未开启回复缓存，请在配置中设置reply_cache为true"
+                            elif args and args[0] == "clear":
+                                cache.clear()
+                                result = "回复缓存已清空"
+                            else:
+                                stats = cache.stats()
+                                result = f"回复缓存：{stats['size']}条\n命中{stats['hits']}次 未命中{stats['misses']}次 跳过{stats['bypassed']}次\n"
+                                result += f"命中率{stats['hit_rate']:.1%}\n节省token约{stats['saved_tokens']} 节省耗时{stats['saved_seconds']:.1f}s"
+                        elif cmd == "upstream":
+                            ok = True
+                            result = "上游状态：\n"
+                            for pool_name, pool in all_upstream_pools().items():
+                                for stats in pool.stats():
+                                    result += f"{pool_name}/{stats['name']}: 权重{stats['weight']} 处理中{stats['outstanding']} 延迟{stats['latency']:.2f}s "
+                                    if stats["cooldown"]:
+                                        result += f"冷却剩余{stats['cooldown']:.0f}s "
+                                    result += f"请求{stats['requests']} 失败{stats['errors']} 冷却{stats['cooldowns']}次 "
+                                    result += f"token {stats['prompt_tokens']}+{stats['completion_tokens']}={stats['total_tokens']}\n"
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
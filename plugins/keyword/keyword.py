@@ -1,14 +1,23 @@
 # encoding:utf-8
 
+import io
 import json
 import os
-import requests
 import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.media_cache import MediaCache
+from common.tmp_dir import TmpDir
+from config import conf as global_conf
 from plugins import *
 
+from .matcher import KeywordMatcher
+
+FILE_EXTS = [".pdf", ".doc", ".docx", ".xls", "xlsx", ".zip", ".rar"]
+# 支持直接发送本地视频的channel，其它channel仍然发送视频URL
+VIDEO_FILE_CHANNELS = ["wx", "wechatmp", "wechatmp_service"]
+
 
 @plugins.register(
     name="Keyword",
@@ -36,6 +45,20 @@ class Keyword(Plugin):
                     conf = json.load(f)
             # 加载关键词
             self.keyword = conf["keyword"]
+            self.matcher = KeywordMatcher(
+                exact=self.keyword,
+                prefix=conf.get("prefix_keyword"),
+                contains=conf.get("contains_keyword"),
+                regex=conf.get("regex_keyword"),
+            )
+            cache_conf = conf.get("media_cache", {})
+            self.media_cache = MediaCache(
+                os.path.join(TmpDir().path(), "keyword_media"),
+                ttl=cache_conf.get("ttl", 86400),
+                max_size=cache_conf.get("max_size_mb", 512) * 1024 * 1024,
+            )
+            # 启动时在后台下载回复中的文件和视频，第一次命中也不需要等待下载
+            self.media_cache.prefetch([url for url in self.matcher.urls() if self._is_file(url) or (self._is_video(url) and self._local_video())])
 
             logger.info("[keyword] {}".format(self.keyword))
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
@@ -50,9 +73,10 @@ class Keyword(Plugin):
 
         content = e_context["context"].content.strip()
         logger.debug("[keyword] on_handle_context. content: %s" % content)
-        if content in self.keyword:
-            logger.info(f"[keyword] 匹配到关键字【{content}】")
-            reply_text = self.keyword[content]
+        matched = self.matcher.match(content)
+        if matched:
+            kind, key, reply_text = matched
+            logger.info(f"[keyword] 匹配到关键字【{key}】, type={kind}")
 
             # 判断匹配内容的类型
             if (reply_text.startswith("http://") or reply_text.startswith("https://")) and any(reply_text.endswith(ext) for ext in [".jpg", ".webp", ".jpeg", ".png", ".gif", ".img"]):
@@ -61,26 +85,31 @@ class Keyword(Plugin):
                 reply.type = ReplyType.IMAGE_URL
                 reply.content = reply_text
                 
-            elif (reply_text.startswith("http://") or reply_text.startswith("https://")) and any(reply_text.endswith(ext) for ext in [".pdf", ".doc", ".docx", ".xls", "xlsx",".zip", ".rar"]):
-            # 如果是以 http:// 或 https:// 开头，且".pdf", ".doc", ".docx", ".xls", "xlsx",".zip", ".rar"结尾，则下载文件到tmp目录并发送给用户
-                file_path = "tmp"
-                if not os.path.exists(file_path):
-                    os.makedirs(file_path)
-                file_name = reply_text.split("/")[-1]  # 获取文件名
-                file_path = os.path.join(file_path, file_name)
-                response = requests.get(reply_text)
-                with open(file_path, "wb") as f:
-                    f.write(response.content)
+            elif self._is_file(reply_text):
+            # 如果是以 http:// 或 https:// 开头，且".pdf", ".doc", ".docx", ".xls", "xlsx",".zip", ".rar"结尾，则从本地缓存发送文件，缓存没有时才下载
+                file_path = self.media_cache.fetch(reply_text)
                 #channel/wechat/wechat_channel.py和channel/wechat_channel.py中缺少ReplyType.FILE类型。
                 reply = Reply()
-                reply.type = ReplyType.FILE
-                reply.content = file_path
+                if file_path:
+                    reply.type = ReplyType.FILE
+                    reply.content = file_path
+                else:
+                    reply.type = ReplyType.TEXT
+                    reply.content = reply_text
             
-            elif (reply_text.startswith("http://") or reply_text.startswith("https://")) and any(reply_text.endswith(ext) for ext in [".mp4"]):
-            # 如果是以 http:// 或 https:// 开头，且".mp4"结尾，则下载视频到tmp目录并发送给用户
+            elif self._is_video(reply_text):
+            # 如果是以 http:// 或 https:// 开头，且".mp4"结尾，已缓存且channel支持时发送本地视频，否则发送视频URL
                 reply = Reply()
-                reply.type = ReplyType.VIDEO_URL
-                reply.content = reply_text
+                video_path = self.media_cache.get(reply_text) if self._local_video() else None
+                if video_path:
+                    with open(video_path, "rb") as f:
+                        reply.type = ReplyType.VIDEO
+                        reply.content = io.BytesIO(f.read())
+                else:
+                    reply.type = ReplyType.VIDEO_URL
+                    reply.content = reply_text
+                    if self._local_video():
+                        self.media_cache.prefetch([reply_text])
                 
             else:
             # 否则认为是普通文本
@@ -90,6 +119,18 @@ class Keyword(Plugin):
             
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS  # 事件结束，并跳过处理context的默认逻辑
+
+    @staticmethod
+    def _is_file(url):
+        return (url.startswith("http://") or url.startswith("https://")) and any(url.endswith(ext) for ext in FILE_EXTS)
+
+    @staticmethod
+    def _is_video(url):
+        return (url.startswith("http://") or url.startswith("https://")) and url.endswith(".mp4")
+
+    @staticmethod
+    def _local_video():
+        return global_conf().get("channel_type", "wx") in VIDEO_FILE_CHANNELS
             
     def get_help_text(self, **kwargs):
         help_text = "关键词过滤"
@@ -0,0 +1,69 @@
+# encoding:utf-8
+
+import re
+
+from common.log import logger
+
+
+class KeywordMatcher(object):
+    """
+    关键词匹配，按以下顺序查找，找到即返回：
+        exact:    完全匹配，dict查找
+        prefix:   以关键词开头，所有关键词合并为一个正则，命中多个时取最长的
+        contains: 包含关键词，所有关键词合并为一个正则，取最先出现的，同一位置取最长的
+        regex:    正则匹配，所有规则合并为一个正则，取最先出现的，同一位置按配置顺序
+    每条消息每种规则只扫描一遍，不随关键词数量线性增加
+    """
+
+    def __init__(self, exact=None, prefix=None, contains=None, regex=None):
+        self.exact = exact or {}
+        self.prefix = prefix or {}
+        self.contains = contains or {}
+        self.regex = list((regex or {}).items())
+        self.prefix_pattern = self._compile_literals(self.prefix)
+        self.contains_pattern = self._compile_literals(self.contains)
+        self.regex_pattern = None
+        self.regex_list = []
+        if self.regex:
+            try:
+                # 每条规则包在命名分组中，lastgroup即为命中的规则序号
+                self.regex_pattern = re.compile("|".join("(?P<_{}>{})".format(i, p) for i, (p, _) in enumerate(self.regex)))
+            except re.error as e:
+                # 规则之间有重名分组等冲突时，逐条匹配
+                logger.warn("[keyword] combine regex failed: {}, match one by one".format(e))
+                self.regex_list = [(re.compile(p), reply) for p, reply in self.regex]
+
+    @staticmethod
+    def _compile_literals(keywords):
+        keywords = [k for k in keywords if k]
+        if not keywords:
+            return None
+        # 长的关键词排在前面，同一位置优先匹配最长的
+        return re.compile("|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True)))
+
+    def match(self, content):
+        """
+        :return: (规则类型, 命中的关键词或正则, 回复内容)，未命中时返回None
+        """
+        if content in self.exact:
+            return "exact", content, self.exact[content]
+        if self.prefix_pattern:
+            m = self.prefix_pattern.match(content)
+            if m:
+                return "prefix", m.group(), self.prefix[m.group()]
+        if self.contains_pattern:
+            m = self.contains_pattern.search(content)
+            if m:
+                return "contains", m.group(), self.contains[m.group()]
+        if self.regex_pattern:
+            m = self.regex_pattern.search(content)
+            if m:
+                pattern, reply = self.regex[int(m.lastgroup[1:])]
+                return "regex", pattern, reply
+        for pattern, reply in self.regex_list:
+            if pattern.search(content):
+                return "regex", pattern.pattern, reply
+        return None
+
+    def urls(self):
+        return [reply for reply in list(self.exact.values()) + list(self.prefix.values()) + list(self.contains.values()) + [r for _, r in self.regex] if reply.startswith("http://") or reply.startswith("https://")]
@@ -5,6 +5,9 @@ import importlib.util
 import json
 import os
 import sys
+import threading
+import time
+from collections import deque
 
 from common.log import logger
 from common.singleton import singleton
@@ -14,11 +17,59 @@ from config import conf, remove_plugin_config, write_plugin_config
 from .event import *
 
 
+class HandlerStats(object):
+    """
+    单个插件处理某个事件的耗时统计，保留最近SAMPLES次耗时用于计算分位数
+    """
+
+    SAMPLES = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+            self.samples = deque(maxlen=self.SAMPLES)
+
+    def record(self, cost):
+        with self.lock:
+            self.count += 1
+            self.total += cost
+            self.max = max(self.max, cost)
+            self.samples.append(cost)
+
+    def stats(self) -> dict:
+        with self.lock:
+            samples = sorted(self.samples)
+            count, total, max_cost = self.count, self.total, self.max
+
+        def percentile(p):
+            return samples[min(int(len(samples) * p), len(samples) - 1)] * 1000 if samples else 0
+
+        return {
+            "count": count,
+            "total_ms": total * 1000,
+            "avg_ms": total / count * 1000 if count else 0,
+            "p50_ms": percentile(0.5),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": max_cost * 1000,
+        }
+
+
 @singleton
 class PluginManager:
     def __init__(self):
         self.plugins = SortedDict(lambda k, v: v.priority, reverse=True)
         self.listening_plugins = {}
+        # event -> ((插件名, 处理函数, 耗时统计), ...)，只包含已启用的插件并按优先级排好序
+        # 插件启用、禁用、重载或调整优先级时整体重建，emit_event只读取不加锁
+        self.dispatch = {}
+        self.handler_stats = {}  # (插件名, event) -> HandlerStats
         self.instances = {}
         self.pconf = {}
         self.current_plugin_path = None
@@ -136,6 +187,21 @@ class PluginManager:
     def refresh_order(self):
         for event in self.listening_plugins.keys():
             self.listening_plugins[event].sort(key=lambda name: self.plugins[name].priority, reverse=True)
+        self._rebuild_dispatch()
+
+    def _rebuild_dispatch(self):
+        dispatch = {}
+        for event, names in self.listening_plugins.items():
+            chain = []
+            for name in names:
+                instance = self.instances.get(name)
+                if name in self.plugins and self.plugins[name].enabled and instance and event in instance.handlers:
+                    stats = self.handler_stats.get((name, event))
+                    if stats is None:
+                        stats = self.handler_stats[(name, event)] = HandlerStats()
+                    chain.append((name, instance.handlers[event], stats))
+            dispatch[event] = tuple(chain)
+        self.dispatch = dispatch
 
     def activate_plugins(self):  # 生成新开启的插件实例
         failed_plugins = []
@@ -157,7 +223,8 @@ class PluginManager:
                 for event in instance.handlers:
                     if event not in self.listening_plugins:
                         self.listening_plugins[event] = []
-                    self.listening_plugins[event].append(name)
+                    if name not in self.listening_plugins[event]:  # 重新激活已有插件时不重复添加
+                        self.listening_plugins[event].append(name)
         self.refresh_order()
         return failed_plugins
 
@@ -188,17 +255,33 @@ class PluginManager:
         self.activate_plugins()
 
     def emit_event(self, e_context: EventContext, *args, **kwargs):
-        if e_context.event in self.listening_plugins:
-            for name in self.listening_plugins[e_context.event]:
-                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
-                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
-                    instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
-                    if e_context.is_break():
-                        e_context["breaked_by"] = name
-                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        for name, handler, stats in self.dispatch.get(e_context.event, ()):
+            if e_context.action != EventAction.CONTINUE:
+                break
+            logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
+            start = time.perf_counter()
+            try:
+                handler(e_context, *args, **kwargs)
+            finally:
+                stats.record(time.perf_counter() - start)
+            if e_context.is_break():
+                e_context["breaked_by"] = name
+                logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
         return e_context
 
+    def get_handler_stats(self) -> list:
+        """
+        :return: [(插件名, event, 统计)]，按累计耗时从高到低排列
+        """
+        result = [(name, event, stats.stats()) for (name, event), stats in list(self.handler_stats.items())]
+        result = [item for item in result if item[2]["count"]]
+        result.sort(key=lambda item: item[2]["total_ms"], reverse=True)
+        return result
+
+    def reset_handler_stats(self):
+        for stats in list(self.handler_stats.values()):
+            stats.reset()
+
     def set_plugin_priority(self, name: str, priority: int):
         name = name.upper()
         if name not in self.plugins:
@@ -238,6 +321,7 @@ class PluginManager:
             rawname = self.plugins[name].name
             self.pconf["plugins"][rawname]["enabled"] = False
             self.save_config()
+            self._rebuild_dispatch()
             return True
         return True
 
@@ -336,6 +420,7 @@ class PluginManager:
                 if name in self.listening_plugins[event]:
                     self.listening_plugins[event].remove(name)
             del self.plugins[name]
+            self._rebuild_dispatch()
             del self.pconf["plugins"][rawname]
             self.loaded[dirname] = None
             self.save_config()
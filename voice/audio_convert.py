@@ -1,17 +1,73 @@
+"""
+音频格式转换，所有转换都由ffmpeg进程完成，音频数据通过文件或管道流式传递，不在Python内存中解码整段音频
+silk格式由pysilk编解码，与ffmpeg之间通过管道传递原始pcm，不产生中间文件
+同时运行的ffmpeg进程数由audio_convert_workers限制，语音消息很多时不会占满CPU，超出时调用方的处理线程阻塞等待
+"""
+
+import os
 import shutil
+import subprocess
+import threading
 import wave
 
 from common.log import logger
+from config import conf
 
 try:
     import pysilk
 except ImportError:
     logger.debug("import pysilk failed, wechaty voice message will not be supported.")
 
-from pydub import AudioSegment
-
 sil_supports = [8000, 12000, 16000, 24000, 32000, 44100, 48000]  # slk转wav时，支持的采样率
 
+ASR_SAMPLE_RATE = 16000  # 百度、阿里、讯飞语音识别要求16000采样率、pcm_s16le、单声道，其它引擎也推荐使用
+SIL_SAMPLE_RATE = 24000  # 微信语音使用的silk采样率
+FFMPEG_TIMEOUT = 120
+
+_slots = None
+_slots_lock = threading.Lock()
+
+
+def _get_slots():
+    global _slots
+    with _slots_lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(conf().get("audio_convert_workers") or os.cpu_count() or 2)
+        return _slots
+
+
+def _ffmpeg(args, input=None):
+    """
+    运行一个ffmpeg进程，输入数据通过stdin传入
+    :return: stdout的内容
+    """
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y"]
+    if input is None:
+        cmd.append("-nostdin")
+    with _get_slots():
+        try:
+            result = subprocess.run(cmd + args, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=FFMPEG_TIMEOUT)
+        except FileNotFoundError:
+            raise RuntimeError("ffmpeg not found, please install ffmpeg first")
+    if result.returncode != 0:
+        raise RuntimeError("ffmpeg failed: {}".format(result.stderr.decode("utf-8", errors="ignore").strip()))
+    return result.stdout
+
+
+def _progress_ms(output):
+    # -progress输出的最后一个out_time_us即为输出音频的时长
+    for line in reversed(output.decode("utf-8", errors="ignore").splitlines()):
+        if line.startswith("out_time_us="):
+            try:
+                return int(line.split("=", 1)[1]) / 1000
+            except ValueError:
+                return 0
+    return 0
+
+
+def _is_sil(path):
+    return path.endswith(".sil") or path.endswith(".silk") or path.endswith(".slk")
+
 
 def find_closest_sil_supports(sample_rate):
     """
@@ -36,8 +92,27 @@ def get_pcm_from_wav(wav_path):
     :param wav_path: wav 文件路径
     :returns: pcm 数据
     """
-    wav = wave.open(wav_path, "rb")
-    return wav.readframes(wav.getnframes())
+    try:
+        with wave.open(wav_path, "rb") as wav:
+            return wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError) as e:  # 非pcm编码的wav，wave模块无法读取，交给ffmpeg解码
+        logger.debug("[audio_convert] read {} by wave failed, use ffmpeg: {}".format(wav_path, e))
+        return to_pcm(wav_path)
+
+
+def to_pcm(any_path, sample_rate=ASR_SAMPLE_RATE):
+    """
+    把任意格式解码为单声道pcm_s16le数据
+    """
+    if _is_sil(any_path):
+        return pysilk.decode_file(any_path, to_wav=False, sample_rate=find_closest_sil_supports(sample_rate))
+    return _ffmpeg(["-i", any_path, "-vn", "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"])
+
+
+def _from_sil(sil_path, dst_path):
+    # silk解码得到的pcm直接通过管道交给ffmpeg编码
+    pcm = pysilk.decode_file(sil_path, to_wav=False, sample_rate=SIL_SAMPLE_RATE)
+    return _ffmpeg(["-f", "s16le", "-ar", str(SIL_SAMPLE_RATE), "-ac", "1", "-i", "pipe:0", dst_path], input=pcm)
 
 
 def any_to_mp3(any_path, mp3_path):
@@ -47,89 +122,98 @@ def any_to_mp3(any_path, mp3_path):
     if any_path.endswith(".mp3"):
         shutil.copy2(any_path, mp3_path)
         return
-    if any_path.endswith(".sil") or any_path.endswith(".silk") or any_path.endswith(".slk"):
-        sil_to_wav(any_path, any_path)
-        any_path = mp3_path
-    audio = AudioSegment.from_file(any_path)
-    audio.export(mp3_path, format="mp3")
+    if _is_sil(any_path):
+        _from_sil(any_path, mp3_path)
+        return
+    _ffmpeg(["-i", any_path, "-vn", mp3_path])
 
 
-def any_to_wav(any_path, wav_path):
+def any_to_wav(any_path, wav_path, sample_rate=None):
     """
-    把任意格式转成wav文件
+    把任意格式转成语音识别使用的wav文件：pcm_s16le、单声道、sample_rate采样率
+    :param sample_rate: 默认使用voice_sample_rate配置
     """
+    sample_rate = sample_rate or conf().get("voice_sample_rate") or ASR_SAMPLE_RATE
     if any_path.endswith(".wav"):
-        shutil.copy2(any_path, wav_path)
-        return
-    if any_path.endswith(".sil") or any_path.endswith(".silk") or any_path.endswith(".slk"):
-        return sil_to_wav(any_path, wav_path)
-    audio = AudioSegment.from_file(any_path)
-    audio.set_frame_rate(8000)    # 百度语音转写支持8000采样率, pcm_s16le, 单通道语音识别
-    audio.set_channels(1)
-    audio.export(wav_path, format="wav", codec='pcm_s16le')
+        try:
+            with wave.open(any_path, "rb") as wav:
+                if wav.getframerate() == sample_rate and wav.getnchannels() == 1 and wav.getsampwidth() == 2:
+                    shutil.copy2(any_path, wav_path)
+                    return
+        except (wave.Error, EOFError) as e:  # 非pcm编码的wav，由下面的ffmpeg转换
+            logger.debug("[audio_convert] read {} by wave failed, use ffmpeg: {}".format(any_path, e))
+    if _is_sil(any_path):
+        return sil_to_wav(any_path, wav_path, find_closest_sil_supports(sample_rate))
+    _ffmpeg(["-i", any_path, "-vn", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(sample_rate), wav_path])
 
 
 def any_to_sil(any_path, sil_path):
     """
     把任意格式转成sil文件
+    :return: 语音时长，单位毫秒
     """
-    if any_path.endswith(".sil") or any_path.endswith(".silk") or any_path.endswith(".slk"):
+    if _is_sil(any_path):
         shutil.copy2(any_path, sil_path)
         return 10000
-    audio = AudioSegment.from_file(any_path)
-    rate = find_closest_sil_supports(audio.frame_rate)
-    # Convert to PCM_s16
-    pcm_s16 = audio.set_sample_width(2)
-    pcm_s16 = pcm_s16.set_frame_rate(rate)
-    wav_data = pcm_s16.raw_data
-    silk_data = pysilk.encode(wav_data, data_rate=rate, sample_rate=rate)
+    pcm = to_pcm(any_path, SIL_SAMPLE_RATE)
+    silk_data = pysilk.encode(pcm, data_rate=SIL_SAMPLE_RATE, sample_rate=SIL_SAMPLE_RATE)
     with open(sil_path, "wb") as f:
         f.write(silk_data)
-    return audio.duration_seconds * 1000
+    return len(pcm) / 2 / SIL_SAMPLE_RATE * 1000
 
 
 def any_to_amr(any_path, amr_path):
     """
     把任意格式转成amr文件
+    :return: 语音时长，单位毫秒
     """
     if any_path.endswith(".amr"):
         shutil.copy2(any_path, amr_path)
         return
-    if any_path.endswith(".sil") or any_path.endswith(".silk") or any_path.endswith(".slk"):
+    if _is_sil(any_path):
         raise NotImplementedError("Not support file type: {}".format(any_path))
-    audio = AudioSegment.from_file(any_path)
-    audio = audio.set_frame_rate(8000)  # only support 8000
-    audio.export(amr_path, format="amr")
-    return audio.duration_seconds * 1000
+    # amr_nb只支持8000采样率、单声道
+    output = _ffmpeg(["-i", any_path, "-vn", "-ar", "8000", "-ac", "1", "-progress", "pipe:1", amr_path])
+    return _progress_ms(output)
 
 
 def sil_to_wav(silk_path, wav_path, rate: int = 24000):
     """
     silk 文件转 wav
     """
-    wav_data = pysilk.decode_file(silk_path, to_wav=True, sample_rate=rate)
-    with open(wav_path, "wb") as f:
-        f.write(wav_data)
+    # pysilk生成的wav头不一定使用指定的采样率，解码为pcm后自行写入
+    pcm = pysilk.decode_file(silk_path, to_wav=False, sample_rate=rate)
+    with wave.open(wav_path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm)
 
 
 def split_audio(file_path, max_segment_length_ms=60000):
     """
-    分割音频文件
+    分割音频文件，直接按帧复制，不重新编码
+    :return: (音频时长毫秒, 分割后的文件列表)，不超过最大长度时返回原文件
     """
-    audio = AudioSegment.from_file(file_path)
-    audio_length_ms = len(audio)
-    if audio_length_ms <= max_segment_length_ms:
-        return audio_length_ms, [file_path]
-    segments = []
-    for start_ms in range(0, audio_length_ms, max_segment_length_ms):
-        end_ms = min(audio_length_ms, start_ms + max_segment_length_ms)
-        segment = audio[start_ms:end_ms]
-        segments.append(segment)
     file_prefix = file_path[: file_path.rindex(".")]
     format = file_path[file_path.rindex(".") + 1 :]
+    # segment_list输出每段的"文件名,开始时间,结束时间"，最后一段的结束时间即为总时长
+    output = _ffmpeg(
+        [
+            "-i", file_path, "-vn", "-c", "copy",
+            "-f", "segment", "-segment_time", str(max_segment_length_ms / 1000), "-segment_start_number", "1",
+            "-segment_list", "pipe:1", "-segment_list_type", "csv",
+            f"{file_prefix}_%d.{format}",
+        ]
+    )
     files = []
-    for i, segment in enumerate(segments):
-        path = f"{file_prefix}_{i+1}" + f".{format}"
-        segment.export(path, format=format)
-        files.append(path)
+    audio_length_ms = 0
+    for line in output.decode("utf-8", errors="ignore").splitlines():
+        name, start, end = line.rsplit(",", 2)
+        files.append(os.path.join(os.path.dirname(file_path), os.path.basename(name)))
+        audio_length_ms = int(float(end) * 1000)
+    if len(files) <= 1:
+        for path in files:
+            os.remove(path)
+        return audio_length_ms, [file_path]
     return audio_length_ms, files
@@ -4,14 +4,14 @@ baidu voice service with thread-safe token caching
 import json
 import os
 import time
-import threading
-import requests
+from common import http_client
 
 from aip import AipSpeech
 
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from common.tmp_dir import TmpDir
+from common.token_manager import baidu_token_manager
 from config import conf
 from voice.audio_convert import get_pcm_from_wav
 from voice.voice import Voice
@@ -44,36 +44,12 @@ class BaiduVoice(Voice):
 
             # 百度 SDK 客户端（短文本合成 & 语音识别）
             self.client = AipSpeech(self.app_id, self.api_key, self.secret_key)
-
-            # access_token 缓存与锁
-            self._access_token    = None
-            self._token_expire_ts = 0
-            self._token_lock      = threading.Lock()
         except Exception as e:
             logger.warn("BaiduVoice init failed: %s, ignore" % e)
 
     def _get_access_token(self):
-        # 多线程安全获取 token
-        with self._token_lock:
-            now = time.time()
-            if self._access_token and now < self._token_expire_ts:
-                return self._access_token
-            url = "https://aip.baidubce.com/oauth/2.0/token"
-            params = {
-                "grant_type":    "client_credentials",
-                "client_id":     self.api_key,
-                "client_secret": self.secret_key,
-            }
-            resp = requests.post(url, params=params).json()
-            token = resp.get("access_token")
-            expires_in = resp.get("expires_in", 2592000)
-            if token:
-                self._access_token    = token
-                self._token_expire_ts = now + expires_in - 60  # 提前 1 分钟过期
-                return token
-            else:
-                logger.error("BaiduVoice _get_access_token failed: %s", resp)
-                return None
+        # 与文心一言共用 token 缓存，过期前由后台提前刷新
+        return baidu_token_manager(self.api_key, self.secret_key).get()
 
     def voiceToText(self, voice_file):
         logger.debug("[Baidu] recognize voice file=%s", voice_file)
@@ -106,7 +82,7 @@ class BaiduVoice(Voice):
             "enable_subtitle": 0,
         }
         headers = {"Content-Type": "application/json"}
-        create_resp = requests.post(create_url, headers=headers, json=payload).json()
+        create_resp = http_client.post(create_url, headers=headers, json=payload).json()
         task_id = create_resp.get("task_id")
         if not task_id:
             logger.error("[Baidu] 长文本合成创建任务失败: %s", create_resp)
@@ -117,7 +93,7 @@ class BaiduVoice(Voice):
         query_url = f"https://aip.baidubce.com/rpc/2.0/tts/v1/query?access_token={token}"
         for _ in range(100):
             time.sleep(3)
-            resp = requests.post(query_url, headers=headers, json={"task_ids":[task_id]})
+            resp = http_client.post(query_url, headers=headers, json={"task_ids":[task_id]})
             result = resp.json()
             infos = result.get("tasks_info") or result.get("tasks") or []
             if not infos:
@@ -137,7 +113,7 @@ class BaiduVoice(Voice):
             return Reply(ReplyType.ERROR, "长文本合成超时，请稍后重试")
 
         # 下载并保存音频
-        audio_data = requests.get(audio_url).content
+        audio_data = http_client.get(audio_url).content
         fn = TmpDir().path() + f"reply-long-{int(time.time())}-{hash(text)&0x7FFFFFFF}.mp3"
         with open(fn, "wb") as f:
             f.write(audio_data)
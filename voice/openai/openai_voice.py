@@ -5,11 +5,12 @@ import json
 
 import openai
 
+from bot.upstream_pool import get_upstream_pool
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from config import conf
 from voice.voice import Voice
-import requests
+from common import http_client
 from common import const
 import datetime, random
 
@@ -21,19 +22,20 @@ class OpenaiVoice(Voice):
         logger.debug("[Openai] voice file name={}".format(voice_file))
         try:
             file = open(voice_file, "rb")
-            api_base = conf().get("open_ai_api_base") or "https://api.openai.com/v1"
-            url = f'{api_base}/audio/transcriptions'
-            headers = {
-                'Authorization': 'Bearer ' + conf().get("open_ai_api_key"),
-                # 'Content-Type': 'multipart/form-data' # 加了会报错，不知道什么原因
-            }
-            files = {
-                "file": file,
-            }
             data = {
                 "model": "whisper-1",
             }
-            response = requests.post(url, headers=headers, files=files, data=data)
+
+            def send(kwargs):
+                file.seek(0)
+                url = f'{kwargs.get("api_base") or "https://api.openai.com/v1"}/audio/transcriptions'
+                headers = {
+                    'Authorization': 'Bearer ' + kwargs["api_key"],
+                    # 'Content-Type': 'multipart/form-data' # 加了会报错，不知道什么原因
+                }
+                return http_client.post(url, headers=headers, files={"file": file}, data=data)
+
+            response = get_upstream_pool("openai").request(data["model"], send)
             response_data = response.json()
             text = response_data['text']
             reply = Reply(ReplyType.TEXT, text)
@@ -46,18 +48,22 @@ class OpenaiVoice(Voice):
 
     def textToVoice(self, text):
         try:
-            api_base = conf().get("open_ai_api_base") or "https://api.openai.com/v1"
-            url = f'{api_base}/audio/speech'
-            headers = {
-                'Authorization': 'Bearer ' + conf().get("open_ai_api_key"),
-                'Content-Type': 'application/json'
-            }
             data = {
                 'model': conf().get("text_to_voice_model") or const.TTS_1,
                 'input': text,
                 'voice': conf().get("tts_voice_id") or "alloy"
             }
-            response = requests.post(url, headers=headers, json=data)
+
+            def send(kwargs):
+                url = f'{kwargs.get("api_base") or "https://api.openai.com/v1"}/audio/speech'
+                headers = {
+                    'Authorization': 'Bearer ' + kwargs["api_key"],
+                    'Content-Type': 'application/json'
+                }
+                return http_client.post(url, headers=headers, json=data)
+
+            response = get_upstream_pool("openai").request(data["model"], send)
+            response.raise_for_status()
             file_name = "tmp/" + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + str(random.randint(0, 1000)) + ".mp3"
             logger.debug(f"[OPENAI] text_to_Voice file_name={file_name}, input={text}")
             with open(file_name, 'wb') as f: